@@ -0,0 +1,304 @@
+import numpy as np
+import pandas as pd
+import nibabel as nib
+import scipy
+import scipy.ndimage
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import parse_args
+from utils import read_nii, generate_binary_masks, generate_HU_channels, generate_tissue_channels, save_all_nii, generate_MIPs_PET, generate_MIPs_CT, generate_SUV_CT_collage, generate_all_MIPs_SUV, generate_all_MIPs_CT, get_projection_stack, generate_all_MIPs, generate_multi_channel_projections, preprocess_CT_HU_values, PROJECTION_CHANNELS, get_quantization, is_integral, quantize, dequantize, quantize_projections, get_compute_dtype, compare_to_baseline, generate_tissue_channels_slabs
+from scan_runner import run_scans
+from nifti_writer import NiftiWriter
+
+#Benchmark of the Data Preparation hot paths on synthetic PET/CT/SEG volumes (no patient data needed).
+#Every stage is timed --benchmark_repeats times and run once more under tracemalloc for its peak memory; the results are written to --benchmark_output.
+#The dtype report compares the channels, projection stacks and projections of every dtype in --benchmark_dtypes with their float64 baseline.
+
+def generate_synthetic_scan(shape, seed=0, num_lesions=6):
+	"""
+	Synthetic whole-body CT (HU), SUV and SEG volumes of the given (X, Y, Z) shape (head at the top slices), with realistic value distributions:
+	air, subcutaneous fat, lean tissue, lungs, spine, liver, brain and bladder, plus num_lesions hot spherical lesions labelled in SEG.
+	"""
+	rng = np.random.default_rng(seed)
+	X, Y, Z = shape
+	x, y = np.meshgrid(np.arange(X) - X/2, np.arange(Y) - Y/2, indexing="ij")
+
+	def ellipse(cx, cy, a, b):
+		return ((x - cx)/a)**2 + ((y - cy)/b)**2 < 1
+
+	body, inner, neck = ellipse(0, 0, 0.38*X, 0.25*Y), ellipse(0, 0, 0.33*X, 0.21*Y), ellipse(0, 0.05*Y, 0.07*X, 0.07*Y)
+	head, brain = ellipse(0, 0, 0.11*X, 0.13*Y), ellipse(0, 0, 0.1*X, 0.12*Y) #Skull as bone around the brain
+	spine = ellipse(0, 0.13*Y, 0.035*X, 0.035*Y)
+	lungs = ellipse(-0.15*X, -0.02*Y, 0.1*X, 0.14*Y) | ellipse(0.15*X, -0.02*Y, 0.1*X, 0.14*Y)
+	liver = ellipse(-0.14*X, -0.02*Y, 0.13*X, 0.12*Y)
+	bladder = ellipse(0, -0.08*Y, 0.05*X, 0.05*Y)
+
+	#(CT, SUV) of every axial slice template
+	def template(outline, organs=()):
+		CT_slice, SUV_slice = np.full((X, Y), -1000, np.float32), np.zeros((X, Y), np.float32)
+		CT_slice[outline], SUV_slice[outline] = -100, 0.4 #Adipose tissue
+		CT_slice[outline & inner], SUV_slice[outline & inner] = 40, 1.0 #Lean tissue
+		CT_slice[outline & spine], SUV_slice[outline & spine] = 700, 1.2 #Bone
+		if outline is head:
+			CT_slice[head], SUV_slice[head] = 900, 1.2 #Skull
+		for organ, organ_HU, organ_SUV in organs:
+			CT_slice[outline & organ], SUV_slice[outline & organ] = organ_HU, organ_SUV
+		return CT_slice, SUV_slice
+
+	regions = [(0.0, 0.1, template(body, [(bladder, 0, 15.)])), #Pelvis
+		(0.1, 0.45, template(body)), #Abdomen
+		(0.45, 0.58, template(body, [(liver, 55, 2.3)])),
+		(0.58, 0.82, template(body, [(lungs, -850, 0.3)])), #Chest
+		(0.82, 0.86, template(neck)),
+		(0.86, 1.0, template(head, [(brain, 35, 7.5)]))]
+	CT, SUV = np.empty(shape, np.float32), np.empty(shape, np.float32)
+	for start, end, (CT_slice, SUV_slice) in regions:
+		CT[:, :, int(start*Z):int(end*Z)] = CT_slice[:, :, None]
+		SUV[:, :, int(start*Z):int(end*Z)] = SUV_slice[:, :, None]
+
+	SEG = np.zeros(shape, np.uint8)
+	candidates = np.argwhere(inner)
+	for k in range(num_lesions):
+		cx, cy = candidates[rng.integers(len(candidates))]
+		cz, r = rng.integers(int(0.1*Z), int(0.8*Z)), rng.uniform(0.01, 0.03)*X
+		box = tuple(slice(max(int(c - r), 0), int(c + r) + 1) for c in (cx, cy, cz))
+		gx, gy, gz = np.ogrid[box]
+		sphere = (gx - cx)**2 + (gy - cy)**2 + (gz - cz)**2 <= r**2
+		SEG[box][sphere] = 1
+		SUV[box][sphere] = rng.uniform(4, 20)
+		CT[box][sphere] = 30
+
+	CT += rng.standard_normal(shape, dtype=np.float32)*20
+	SUV *= 1 + 0.15*rng.standard_normal(shape, dtype=np.float32)
+	np.clip(SUV, 0, None, out=SUV)
+	return CT, SUV, SEG
+
+def save_synthetic_scans(path, shape, num_scans):
+	"""
+	Save num_scans synthetic scans in the autoPET layout (pat_ID/scan_date/CTres.nii.gz, SUV.nii.gz, SEG.nii.gz) and return their df_final.csv style DataFrame.
+	"""
+	rows = []
+	affine = np.diag([2.0364, 2.0364, 3., 1.])
+	for k in range(num_scans):
+		pat_ID, scan_date = "PETCT_synthetic_{:04d}".format(k), "01-01-2000-NA-PET-CT-{}".format(k)
+		save_path = os.path.join(path, pat_ID, scan_date)
+		os.makedirs(save_path, exist_ok=True)
+		for name, arr in zip(("CTres", "SUV", "SEG"), generate_synthetic_scan(shape, seed=k)):
+			nib.save(nib.Nifti1Image(arr, affine), os.path.join(save_path, name + ".nii.gz"))
+		rows.append({"pat_ID": pat_ID, "scan_date": scan_date, "CT": os.path.join(save_path, "CTres.nii.gz"), "SUV": os.path.join(save_path, "SUV.nii.gz"),
+			"SEG": os.path.join(save_path, "SEG.nii.gz"), "diagnosis": "LYMPHOMA", "age": "050Y", "sex": "M"})
+	return pd.DataFrame(rows)
+
+def get_stages(args):
+	"""
+	Benchmarked stages: name -> (fn(ctx, out_dir), depends on the rotation interval, depends on the number of workers).
+	ctx holds the args, the synthetic volumes of one size and their paths; out_dir is a new empty folder for every run.
+	"""
+	def masks(ctx, out_dir):
+		return generate_binary_masks(ctx["CT"], args)
+
+	def HU_channels(ctx, out_dir):
+		masks = ctx["masks"]
+		return generate_HU_channels(ctx["CT"], *masks), generate_HU_channels(ctx["SUV"], *masks)
+
+	def all_MIPs_SUV(ctx, out_dir):
+		for name in PROJECTION_CHANNELS:
+			os.makedirs(os.path.join(out_dir, name))
+		generate_all_MIPs_SUV(out_dir, ctx["SUV"], *ctx["channels"][:4], ctx["SEG"], args.SUV_min, args.SUV_max, -90, 90, ctx["rotation_interval"], order=args.projection_order)
+
+	def all_MIPs_CT(ctx, out_dir):
+		for name in PROJECTION_CHANNELS:
+			os.makedirs(os.path.join(out_dir, name))
+		CT_B, CT_LT, CT_AT, CT_A = ctx["channels"][4:]
+		generate_all_MIPs_CT(out_dir, ctx["CT"], CT_B, preprocess_CT_HU_values(CT_LT), preprocess_CT_HU_values(CT_AT), preprocess_CT_HU_values(CT_A), ctx["SEG"], args.CT_min, args.CT_max, -90, 90, ctx["rotation_interval"], order=args.projection_order)
+
+	def all_MIPs(ctx, out_dir):
+		SUV_B, SUV_LT, SUV_AT, SUV_A, CT_B, CT_LT, CT_AT, CT_A = ctx["channels"]
+		stack = get_projection_stack(ctx["SUV"], SUV_B, SUV_LT, SUV_AT, SUV_A, ctx["CT"], CT_B, preprocess_CT_HU_values(CT_LT), preprocess_CT_HU_values(CT_AT), preprocess_CT_HU_values(CT_A), ctx["SEG"])
+		generate_all_MIPs(out_dir, stack, args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, -90, 90, ctx["rotation_interval"], order=args.projection_order)
+
+	def rotate(ctx, out_dir):
+		for angle in range(-90, 91, ctx["rotation_interval"]):
+			scipy.ndimage.rotate(ctx["CT"], angle, axes=(0,1))
+
+	def channels_slabs(ctx, out_dir):
+		#Channels and collage projections out of core (--slab_size, 16 z planes by default)
+		with NiftiWriter.from_args(args) as writer:
+			generate_tissue_channels_slabs(args, ctx["paths"]["CT"], ctx["paths"]["SUV"], ctx["paths"]["SEG"], args.slab_size or 16, writer, save_path=out_dir)
+
+	def end_to_end(ctx, out_dir):
+		from multi_channel_3D_SUV_CT_generation import process_scan
+		run_args = copy_args(args, path_multi_channel_3D_CT_SUV=out_dir)
+		run_scans(process_scan, ctx["df"], run_args, num_workers=ctx["workers"])
+
+	return {
+		"read_nii": (lambda ctx, out_dir: (read_nii(ctx["paths"]["CT"]), read_nii(ctx["paths"]["SUV"]), read_nii(ctx["paths"]["SEG"])), False, False),
+		"generate_binary_masks": (masks, False, False),
+		"generate_HU_channels": (HU_channels, False, False),
+		"generate_tissue_channels": (lambda ctx, out_dir: generate_tissue_channels(ctx["CT"], ctx["SUV"], args), False, False),
+		"save_all_nii": (lambda ctx, out_dir: save_all_nii(ctx["paths"]["CT"], out_dir, *ctx["channels"][4:], "CT"), False, False),
+		"generate_MIPs_PET": (lambda ctx, out_dir: [generate_MIPs_PET(ctx["SUV"], i, "max", "negative") for i in args.MIP_types], False, False),
+		"generate_MIPs_CT": (lambda ctx, out_dir: [generate_MIPs_CT(ctx["CT"], i, "sum", "negative") for i in args.MIP_types], False, False),
+		"generate_tissue_channels_slabs": (channels_slabs, False, False),
+		"generate_SUV_CT_collage": (lambda ctx, out_dir: generate_SUV_CT_collage(args, ctx["SEG"], ctx["SUV"], *ctx["channels"][:4], ctx["CT"], *ctx["channels"][4:], out_dir, "PETCT_synthetic", "01-01-2000", "LYMPHOMA"), False, False),
+		"generate_all_MIPs_SUV": (all_MIPs_SUV, True, False),
+		"generate_all_MIPs_CT": (all_MIPs_CT, True, False),
+		"generate_all_MIPs": (all_MIPs, True, False),
+		"scipy.ndimage.rotate": (rotate, True, False),
+		"run_scans": (end_to_end, False, True)}
+
+def get_dtype_report(ctx, args, dtypes, rotation_interval):
+	"""
+	Numerical difference from the float64 baseline (see utils.compare_to_baseline) and size of
+	channels - the eight tissue channels computed and stored as dtype (integer dtypes with a scale per volume, as saved to NIfTI),
+	projection_stack - the projection stack held as dtype (--volume_dtype), compared on its projections,
+	projections - the projections stored as dtype (integer dtypes with a scale per image), generated from a --volume_dtype projection stack.
+	"""
+	angles = list(range(-90, 91, rotation_interval))
+	def get_stack(channels, dtype):
+		SUV_B, SUV_LT, SUV_AT, SUV_A, CT_B, CT_LT, CT_AT, CT_A = channels
+		return get_projection_stack(ctx["SUV"], SUV_B, SUV_LT, SUV_AT, SUV_A, ctx["CT"], CT_B, preprocess_CT_HU_values(CT_LT), preprocess_CT_HU_values(CT_AT), preprocess_CT_HU_values(CT_A), ctx["SEG"], dtype=dtype)
+	def get_projections(stack):
+		return [MIPs for _, MIPs in generate_multi_channel_projections(stack, angles, args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, order=args.projection_order)]
+	def flatten(projections):
+		#The projections of the angles have different widths
+		return np.concatenate([MIPs.reshape(len(MIPs), -1) for MIPs in projections], axis=1)
+	def get_row(artifact, dtype, baseline, values, nbytes, nbytes_64):
+		return dict({"artifact": artifact, "dtype": dtype, "MB": nbytes / 2**20, "size_ratio": nbytes_64 / nbytes}, **compare_to_baseline(baseline, values))
+
+	rows = []
+	channels_64 = generate_tissue_channels(ctx["CT"], ctx["SUV"], args, dtype=np.float64)
+	for dtype in dtypes:
+		channels = generate_tissue_channels(ctx["CT"], ctx["SUV"], args, dtype=get_compute_dtype(dtype, args.volume_dtype))
+		scales = [get_quantization(dtype, np.min(channel), np.max(channel), integral=is_integral(channel)) for channel in channels]
+		stored = [quantize(channel, dtype, scale) for channel, scale in zip(channels, scales)]
+		values = np.stack([dequantize(q, scale, np.float64) for q, scale in zip(stored, scales)])
+		rows.append(get_row("channels", dtype, channels_64, values, sum(q.nbytes for q in stored), channels_64.nbytes))
+		del channels, stored, values
+
+	stack_64 = get_stack(channels_64, np.float64)
+	projections_64 = flatten(get_projections(stack_64))
+	for dtype in [dtype for dtype in dtypes if np.dtype(dtype).kind == "f"]:
+		stack = get_stack(channels_64, dtype)
+		rows.append(get_row("projection_stack", dtype, projections_64, flatten(get_projections(stack)), stack.nbytes, stack_64.nbytes))
+		del stack
+	del stack_64
+	projections = get_projections(get_stack(channels_64, args.volume_dtype))
+	for dtype in dtypes:
+		#Projections are generated in the compute dtype of the stored dtype, then stored with a scale per channel and angle
+		stored = [quantize_projections(MIPs.astype(get_compute_dtype(dtype)), dtype) for MIPs in projections]
+		values = flatten([np.stack([dequantize(MIP, scale, np.float64) for MIP, scale in zip(MIPs, scales)]) for MIPs, scales in stored])
+		rows.append(get_row("projections", dtype, projections_64, values, sum(MIPs.nbytes for MIPs, _ in stored), projections_64.nbytes))
+	return rows
+
+def copy_args(args, **kwargs):
+	"""
+	Copy of args with some values replaced.
+	"""
+	new_args = type(args)(**vars(args))
+	for key, value in kwargs.items():
+		setattr(new_args, key, value)
+	return new_args
+
+def time_stage(fn, ctx, repeats, path_tmp, measure_memory=True):
+	"""
+	Run fn repeats times (each in a new output folder) and once more under tracemalloc. Returns the run times and the peak traced memory in MB.
+	"""
+	times = []
+	for _ in range(repeats):
+		out_dir = tempfile.mkdtemp(dir=path_tmp)
+		start = time.perf_counter()
+		fn(ctx, out_dir)
+		times.append(time.perf_counter() - start)
+		shutil.rmtree(out_dir)
+
+	peak_MB = None
+	if measure_memory:
+		out_dir = tempfile.mkdtemp(dir=path_tmp)
+		tracemalloc.start()
+		fn(ctx, out_dir)
+		peak_MB = tracemalloc.get_traced_memory()[1] / 2**20
+		tracemalloc.stop()
+		shutil.rmtree(out_dir)
+	return times, peak_MB
+
+def get_metadata():
+	"""
+	Environment of the benchmark run, so that results of different commits and machines can be told apart.
+	"""
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip() or None
+	except OSError:
+		commit = None
+	return {"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__,
+		"platform": platform.platform(), "cpu_count": os.cpu_count()}
+
+def compare_benchmarks(results, baseline):
+	"""
+	Print the speedup of every stage of results over the same stage (size, angles, workers) of baseline.
+	"""
+	key = lambda result: (result["stage"], result["size"], result["angles"], result["workers"])
+	baseline = {key(result): result for result in baseline["results"]}
+	print("{:<26}{:>14}{:>8}{:>9}{:>12}{:>12}{:>9}".format("stage", "size", "angles", "workers", "baseline_s", "seconds", "speedup"))
+	for result in results["results"]:
+		if key(result) in baseline:
+			old = baseline[key(result)]["seconds"]
+			print("{:<26}{:>14}{:>8}{:>9}{:>12.3f}{:>12.3f}{:>8.2f}x".format(result["stage"], result["size"], str(result["angles"]), str(result["workers"]), old, result["seconds"], old / result["seconds"]))
+
+def main(args):
+	stages = get_stages(args)
+	selected = args.benchmark_stages or list(stages) + ["dtype_report"]
+	path_tmp = args.benchmark_dir or tempfile.mkdtemp(prefix="benchmark_")
+	os.makedirs(path_tmp, exist_ok=True)
+	results = {"metadata": get_metadata(), "args": {key: value for key, value in vars(args).items() if key.startswith("benchmark_") or key in ("projection_order", "channel_storage", "channel_dtype", "volume_dtype", "projection_dtype")}, "results": [], "dtype_report": []}
+
+	for size in args.benchmark_sizes:
+		shape = tuple(int(n) for n in size.split("x"))
+		#Synthetic scans on disk (the first one is also loaded for the in-memory stages)
+		df = save_synthetic_scans(os.path.join(path_tmp, size), shape, max(args.benchmark_scans, 1))
+		row = df.iloc[0]
+		CT, SUV, SEG = read_nii(row["CT"]), read_nii(row["SUV"]), read_nii(row["SEG"])
+		ctx = {"CT": CT, "SUV": SUV, "SEG": SEG, "paths": row, "df": df.iloc[:args.benchmark_scans], "masks": generate_binary_masks(CT, args),
+			"channels": generate_tissue_channels(CT, SUV, args)}
+
+		if "dtype_report" in selected and args.benchmark_dtypes:
+			for row_report in get_dtype_report(ctx, args, args.benchmark_dtypes, args.benchmark_rotation_intervals[0]):
+				results["dtype_report"].append(dict(row_report, size=size))
+				print("{:<18}{:>9}{:>14} {:>9.1f} MB ({:.1f}x smaller), max abs error {:.3g}, RMSE {:.3g}, max rel error {:.3g}, non-finite mismatches {}".format(row_report["artifact"], row_report["dtype"], size,
+					row_report["MB"], row_report["size_ratio"], row_report["max_abs_error"], row_report["rmse"], row_report["max_rel_error"], row_report["non_finite_mismatch"]))
+
+		for name in [name for name in selected if name in stages]:
+			fn, uses_angles, uses_workers = stages[name]
+			for rotation_interval in (args.benchmark_rotation_intervals if uses_angles else [None]):
+				for workers in (args.benchmark_workers if uses_workers else [None]):
+					ctx["rotation_interval"], ctx["workers"] = rotation_interval, workers
+					times, peak_MB = time_stage(fn, ctx, args.benchmark_repeats, path_tmp, measure_memory=not uses_workers)
+					result = {"stage": name, "size": size, "voxels": int(np.prod(shape)), "angles": None if rotation_interval is None else len(range(-90, 91, rotation_interval)),
+						"workers": workers, "repeats": len(times), "seconds": min(times), "seconds_median": float(np.median(times)), "seconds_all": times, "peak_MB": peak_MB}
+					if uses_workers:
+						result["seconds_per_scan"] = min(times) / len(ctx["df"])
+					results["results"].append(result)
+					print("{:<26}{:>14} angles={} workers={}: {:.3f}s (median {:.3f}s), peak {}".format(name, size, result["angles"], workers, result["seconds"], result["seconds_median"],
+						"-" if peak_MB is None else "{:.0f} MB".format(peak_MB)))
+
+	with open(args.benchmark_output, "w") as f:
+		json.dump(results, f, indent=1)
+	if args.benchmark_baseline:
+		with open(args.benchmark_baseline) as f:
+			compare_benchmarks(results, json.load(f))
+	if args.benchmark_dir is None:
+		shutil.rmtree(path_tmp)
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
+	print("Done")
@@ -0,0 +1,47 @@
+#Quantitative lesion features for outcome prediction: the lesions of every scan are labelled as connected components of SEG and quantified
+#(SUVmax/mean/peak, MTV, TLG, tissue composition, dissemination). Writes lesion_features.csv (one row per scan) and lesion_table.csv
+#(one row per lesion) next to df_final.csv.
+import pandas as pd
+import os
+
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import parse_args
+from utils import read_nii, get_voxel_spacing, quantify_lesions
+from scan_runner import run_scans
+from volume_cache import init_volume_cache
+from profiling import init_profiler
+
+def process_scan(row, args):
+	"""
+	Quantify the lesions of a single scan (one row of df).
+	"""
+	init_volume_cache(args) #No-op unless --volume_cache_dir is set (runs in every worker process)
+	#Load Image
+	CT_arr, SUV_arr, SEG_arr = read_nii(row["CT"]), read_nii(row["SUV"]), read_nii(row["SEG"])
+	features, lesions = quantify_lesions(SUV_arr, CT_arr, SEG_arr, args, get_voxel_spacing(row["SEG"]))
+	return {"features": features, "lesions": lesions.to_dict("records")}
+
+def main(args):
+	df = pd.read_csv(args.path_df)
+	output_path = os.path.dirname(os.path.abspath(args.path_df))
+	args.profile_dir = args.profile_dir or output_path
+	init_profiler(args) #No-op unless --profile is set
+
+	#Process the scans (in parallel if num_workers > 1), a failing scan is reported and skipped
+	df_status = run_scans(process_scan, df, args, num_workers=args.num_workers, max_in_flight=args.max_in_flight)
+	done = df_status[df_status["status"] == "done"]
+	df_features = pd.DataFrame([dict({"pat_ID": row["pat_ID"], "scan_date": row["scan_date"]}, **row["features"]) for _, row in done.iterrows()])
+	df_lesions = pd.DataFrame([dict({"pat_ID": row["pat_ID"], "scan_date": row["scan_date"]}, **lesion) for _, row in done.iterrows() for lesion in row["lesions"]])
+	#Clinical information of the scans next to their features
+	df_features = df_features.merge(df.drop(columns=["CT", "SUV", "SEG"] + [column for column in df.columns if column.startswith("Unnamed")], errors="ignore"), on=["pat_ID", "scan_date"], how="left")
+	df_features.to_csv(os.path.join(output_path, "lesion_features.csv"), index=False)
+	df_lesions.to_csv(os.path.join(output_path, "lesion_table.csv"), index=False)
+	if args.profile:
+		init_profiler(args).report(os.path.join(args.profile_dir, "run_report"))
+
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
+	print("Done")
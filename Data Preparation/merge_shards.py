@@ -0,0 +1,47 @@
+#Merge the outputs of a sharded run (--num_shards N, one run per --shard_index) of one of the Data Preparation scripts (--shard_step) into the indexes of the dataset:
+#fails if a shard is missing or unfinished, if a scan was processed by several shards or by none, and if a shard index misses scans of its shard.
+import pandas as pd
+import os
+
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import parse_args
+from utils import get_bbox_index_path, get_statistics_paths
+from sharding import merge_shards
+
+def get_shard_outputs(args):
+	"""
+	Output folder (with the shard records), indexes with one row per scan and indexes updated by the shards of the step args.shard_step (see sharding.merge_shards).
+	"""
+	updates = [get_bbox_index_path(args)] + list(get_statistics_paths(args))
+	path_projection_index = os.path.join(args.path_multi_angled_multi_channel_2D_projections, "projection_index.csv")
+	if args.shard_step == "channels":
+		return args.path_multi_channel_3D_CT_SUV, [os.path.join(args.path_multi_channel_3D_CT_SUV, "scan_status.csv")], updates
+	if args.shard_step == "statistics":
+		path_output = os.path.dirname(os.path.abspath(args.path_df))
+		return path_output, [os.path.join(path_output, "statistics_status.csv")], list(get_statistics_paths(args))
+	if args.shard_step == "projections":
+		return args.path_multi_angled_multi_channel_2D_projections, [path_projection_index] if args.projection_format == "tensor" else [], []
+	#The projections of the failed scans of the pipeline are not indexed
+	if "projections" in args.pipeline_outputs and args.projection_format == "tensor":
+		updates.append(path_projection_index)
+	return args.path_multi_channel_3D_CT_SUV, [os.path.join(args.path_multi_channel_3D_CT_SUV, "pipeline_status.csv")], updates
+
+def main(args):
+	if args.num_shards <= 1:
+		raise ValueError("--num_shards must be the number of shards of the run to merge")
+	df = pd.read_csv(args.path_df)
+	path_output, indexes, updates = get_shard_outputs(args)
+	shards = merge_shards(df, path_output, args.shard_step, args, indexes=indexes, updates=updates, report=os.path.join(args.profile_dir or path_output, "run_report"))
+	counts = pd.Series(list(shards.values())).value_counts().sort_index()
+	print("Merged {} shards of {}: {} scans ({}).".format(args.num_shards, args.shard_step, len(shards), ", ".join("shard {}: {}".format(k, n) for k, n in counts.items())))
+	for path in indexes:
+		df_index = pd.read_csv(path, keep_default_na=False)
+		if "status" in df_index:
+			print("{}: {}".format(os.path.basename(path), ", ".join("{} {}".format(n, status) for status, n in df_index["status"].value_counts().items())))
+
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
+	print("Done")
@@ -1,77 +1,78 @@
-import numpy as np
 import pandas as pd
-import SimpleITK as sitk
-from tqdm import tqdm
-import scipy.ndimage
-import cv2
 import os
+import json
 
 import sys
-sys.path.insert(0, '/media/sambit/HDD/Sambit/Projects/Project_5/GitHub/Tumor-segmentation-from-PET-CT-followed-by-outcome-prediction')
-from utils import preprocess_df, read_nii, preprocess_CT_HU_values, generate_all_MIPs_SUV, generate_all_MIPs_CT
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import tqdm, load_projection_stack, generate_all_MIPs, get_stale_angles, get_projection_params, get_projection_inputs, load_bbox_index, get_stack_bbox, ScanStatistics
 from config import parse_args
+from projection_store import save_projection_tensor, save_projection_index, get_projection_tensor_path
+from volume_cache import init_volume_cache
+from profiling import init_profiler, profile_scan, profile_single_scan
+from manifest import BuildManifest, get_fingerprints
+from sharding import select_shard, get_shard_path, save_shard_record
 
 def main(args):
 	#path_data = args.data_path
+	init_volume_cache(args) #Read the volumes through the decoded volume cache if --volume_cache_dir is set
 	path_output = args.path_multi_angled_multi_channel_2D_projections
-	df = pd.read_csv(args.path_df) #DataFrame containing all the original tumorous scans.
+	args.profile_dir = args.profile_dir or path_output
+	init_profiler(args) #No-op unless --profile is set
+	df_all = pd.read_csv(args.path_df) #DataFrame containing all the original tumorous scans.
+	df = select_shard(df_all, args) #Scans of shard --shard_index of --num_shards (all the scans if the run is not sharded)
 	#df = df[df["diagnosis"]=="NEGATIVE"].reset_index(drop=True)
-	df = preprocess_df(df, args)
-	#print("151 to end")
-	#df = df[151:].reset_index(drop=True)
 
+	#Parameters the projections depend on, recorded in the manifest of every scan (a change regenerates the affected projections only)
+	params = get_projection_params(args)
+	angles = list(range(args.rotation_min, args.rotation_max+1, args.rotation_interval))
+	#Body bounding boxes indexed by the 3D channel generation (computed here for the scans that are not indexed)
+	bboxes = load_bbox_index(args) if args.roi_crop else None
+	stats = ScanStatistics(args) if args.scan_statistics else None
+
+	records = [] #Index of the projection tensors
 	for idx, row in tqdm(df.iterrows(), total=len(df)):
 		pat_ID = row["pat_ID"]
 		scan_date = row["scan_date"]
+		with profile_scan(pat_ID, scan_date), profile_single_scan(args, pat_ID, scan_date):
+			#Generate different multi-directional SUV channels based on CT HU values
+			save_path = os.path.join(path_output, pat_ID, scan_date)
+			if not os.path.exists(save_path):
+				os.makedirs(save_path)
+			manifest = BuildManifest(save_path)
+			inputs = get_fingerprints(get_projection_inputs(row))
 
-		SUV = read_nii(row["SUV"])
-		SUV_B = read_nii(row["SUV_bone"])
-		SUV_LT = read_nii(row["SUV_lean"])
-		SUV_AT = read_nii(row["SUV_adipose"])
-		SUV_A = read_nii(row["SUV_air"])
-
-		CT = read_nii(row["CT"])
-		CT_B = read_nii(row["CT_bone"])
-		CT_LT = read_nii(row["CT_lean"])
-		CT_AT = read_nii(row["CT_adipose"])
-		CT_A = read_nii(row["CT_air"])
-
-		CT_LT, CT_AT, CT_A = preprocess_CT_HU_values(CT_LT), preprocess_CT_HU_values(CT_AT), preprocess_CT_HU_values(CT_A)
-
-		SEG = read_nii(row["SEG"])
-
-		#Generate different multi-directional SUV channels based on CT HU values
-		save_path = os.path.join(path_output, pat_ID, scan_date)
-		if not os.path.exists(save_path):
-			os.makedirs(save_path)
-
-		if not os.path.exists(os.path.join(save_path, "SUV_MIP")): #SUV_MIP, SUV_bone, SUV_lean, SUV_adipose, SUV_air
-			os.makedirs(os.path.join(save_path, "SUV_MIP"))
-		if not os.path.exists(os.path.join(save_path, "SUV_bone")):
-			os.makedirs(os.path.join(save_path, "SUV_bone"))
-		if not os.path.exists(os.path.join(save_path, "SUV_lean")):
-			os.makedirs(os.path.join(save_path, "SUV_lean"))
-		if not os.path.exists(os.path.join(save_path, "SUV_adipose")):
-			os.makedirs(os.path.join(save_path, "SUV_adipose"))
-		if not os.path.exists(os.path.join(save_path, "SUV_air")):
-			os.makedirs(os.path.join(save_path, "SUV_air"))
+			if args.projection_format == "tensor":
+				params_tensor = dict(params, angles=angles, projection_compression=args.projection_compression)
+				path_tensor = get_projection_tensor_path(save_path, args.projection_compression)
+				if manifest.is_done("projection_tensor", inputs, params_tensor, [path_tensor, os.path.join(save_path, "projections.json")]):
+					with open(os.path.join(save_path, "projections.json")) as f:
+						records.append(dict(json.load(f), pat_ID=pat_ID, scan_date=scan_date))
+					continue
+				#Angles of the previous tensor generated from the same inputs and parameters are copied
+				reuse_angles = []
+				previous = manifest.get("projection_tensor")
+				if previous is not None and os.path.isfile(path_tensor) and manifest.entry(inputs, dict(params_tensor, angles=previous["params"]["angles"])) == previous:
+					reuse_angles = [angle for angle in angles if angle in previous["params"]["angles"]]
+				stack, round_channels = load_projection_stack(row, args, stats) if len(reuse_angles) < len(angles) else (None, ())
+				bbox = get_stack_bbox(stack, args, bboxes.get((pat_ID, scan_date))) if bboxes is not None and stack is not None else None
+				metadata = save_projection_tensor(save_path, stack, angles, args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, order=args.projection_order, round_channels=round_channels, compression=args.projection_compression, dtype=args.projection_dtype, reuse_angles=reuse_angles, bbox=bbox)
+				manifest.record("projection_tensor", inputs, params_tensor)
+				manifest.save()
+				records.append(dict(metadata, pat_ID=pat_ID, scan_date=scan_date))
+				continue
 
-		if not os.path.exists(os.path.join(save_path, "CT_MIP")): #SUV_MIP, SUV_bone, SUV_lean, SUV_adipose, SUV_air
-			os.makedirs(os.path.join(save_path, "CT_MIP"))
-		if not os.path.exists(os.path.join(save_path, "CT_bone")):
-			os.makedirs(os.path.join(save_path, "CT_bone"))
-		if not os.path.exists(os.path.join(save_path, "CT_lean")):
-			os.makedirs(os.path.join(save_path, "CT_lean"))
-		if not os.path.exists(os.path.join(save_path, "CT_adipose")):
-			os.makedirs(os.path.join(save_path, "CT_adipose"))
-		if not os.path.exists(os.path.join(save_path, "CT_air")):
-			os.makedirs(os.path.join(save_path, "CT_air"))
+			if not get_stale_angles(save_path, angles, manifest, inputs, params):
+				continue
 
-		if not os.path.exists(os.path.join(save_path, "SEG")):
-			os.makedirs(os.path.join(save_path, "SEG"))
+			stack, round_channels = load_projection_stack(row, args, stats)
+			bbox = get_stack_bbox(stack, args, bboxes.get((pat_ID, scan_date))) if bboxes is not None else None
+			generate_all_MIPs(save_path, stack, args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, args.rotation_min, args.rotation_max, args.rotation_interval, order=args.projection_order, round_channels=round_channels, manifest=manifest, inputs=inputs, params=params, bbox=bbox, dtype=args.projection_dtype)
 
-		generate_all_MIPs_SUV(save_path, SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, SEG, args.SUV_min, args.SUV_max, args.rotation_min, args.rotation_max, args.rotation_interval)
-		generate_all_MIPs_CT(save_path, CT, CT_B, CT_LT, CT_AT, CT_A, SEG, args.CT_min, args.CT_max, args.rotation_min, args.rotation_max, args.rotation_interval)
+	if args.projection_format == "tensor":
+		save_projection_index(path_output, records, args)
+	if args.profile:
+		init_profiler(args).report(get_shard_path(os.path.join(args.profile_dir, "run_report"), args))
+	save_shard_record(path_output, "projections", args, df_all, df)
 
 if __name__ == "__main__":
 	args = parse_args()
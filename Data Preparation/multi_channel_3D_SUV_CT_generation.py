@@ -1,57 +1,140 @@
-import SimpleITK as sitk
 import os
-import numpy as np
-import matplotlib.pyplot as plt
-import nibabel as nib
-from PIL import Image
 import pandas as pd
-from tqdm import tqdm
 
 import sys
-sys.path.insert(0, '/media/sambit/HDD/Sambit/Projects/Project_5/GitHub/Tumor-segmentation-from-PET-CT-followed-by-outcome-prediction')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import parse_args
-from utils import read_nii, generate_binary_masks, generate_HU_channels, save_all_nii, generate_SUV_CT_collage, generate_SUV_CT_collage
+from utils import read_nii, generate_tissue_channels, save_all_nii, save_npy_nii, get_nii_extension, get_compute_dtype, get_label_map_path, load_lesions, is_negative, generate_SUV_CT_collage, get_scan_artifacts, get_body_bbox, save_bbox_index, generate_tissue_channels_slabs, get_collage_frame, save_SUV_CT_collage, compute_scan_statistics, save_scan_statistics, ScanStatistics
+from scan_runner import run_scans
+from volume_cache import init_volume_cache
+from profiling import init_profiler
+from manifest import BuildManifest, get_fingerprints
+from nifti_writer import NiftiWriter
+from sharding import select_shard, get_shard_path, save_shard_record
 
-def main(args):
-	df = pd.read_csv(args.path_df)
-	#df = df[df["diagnosis"]=="NEGATIVE"].reset_index(drop=True)
-	#df = df[df["pat_ID"]=="PETCT_0223010e46"].reset_index(drop=True)
-	#print("start to 250")
-	#df = df[10:250].reset_index(drop=True)
-	#df_new = df[df.pat_ID.isin(args.include_ids)].reset_index(drop=True)
+def process_scan(row, args):
+	"""
+	Generate the multi-channel 3D SUV/CT volumes and the visualization collage for a single scan (one row of df).
+	Returns the body bounding box ({"bbox": ...}, --roi_crop) and the statistics ({"statistics": ...}, --scan_statistics) of the scan if they were computed.
+	"""
+	init_volume_cache(args) #No-op unless --volume_cache_dir is set (runs in every worker process)
 	output_path = args.path_multi_channel_3D_CT_SUV
+	path_CT, path_SUV = row["CT"], row["SUV"]
+	pat_ID, scan_date = row["pat_ID"], row["scan_date"]
+	disease_type = row["diagnosis"]
+
+	save_path_nii = os.path.join(output_path, "3D_CT_SUV_Data", pat_ID, scan_date)
+	os.makedirs(save_path_nii, exist_ok=True)
 
-	for index, row in tqdm(df.iterrows(), total=df.shape[0]):
-		path_CT, path_SUV, path_SEG = row["CT"], row["SUV"], row["SEG"]
-		pat_ID, scan_date = row["pat_ID"], row["scan_date"]
-		print(pat_ID)
-		disease_type = row["diagnosis"]
+	save_path_visualizations = os.path.join(output_path, "Visualization")
+	os.makedirs(save_path_visualizations, exist_ok=True)
 
-		save_path_nii = os.path.join(output_path, "3D_CT_SUV_Data", pat_ID, scan_date)
-		if not os.path.exists(save_path_nii):
-			os.makedirs(save_path_nii)
+	#Skip the artifacts that are up to date with the inputs and the parameters they were generated with
+	manifest = BuildManifest(save_path_nii)
+	artifacts = get_scan_artifacts(args, row)
+	inputs_channels, params_channels, outputs_channels = artifacts["channels"]
+	inputs_channels = get_fingerprints(inputs_channels)
+	inputs_collage, params_collage, outputs_collage = artifacts["collage"]
+	inputs_collage = get_fingerprints(inputs_collage)
 
-		save_path_visualizations = os.path.join(output_path, "Visualization")
-		if not os.path.exists(save_path_visualizations):
-			os.makedirs(save_path_visualizations)
+	channels_done = manifest.is_done("channels", inputs_channels, params_channels, outputs_channels)
+	collage_done = manifest.is_done("collage", inputs_collage, params_collage, outputs_collage)
+	compute_statistics = args.scan_statistics and row.get("compute_statistics", True)
+	if channels_done and collage_done and not compute_statistics:
+		return
 
-		#Load Image
-		CT_arr, SUV_arr, SEG_arr = read_nii(path_CT), read_nii(path_SUV), read_nii(path_SEG)
-		#Generate binary masks for different tissues, corresponding to different HU windows
-		bone_mask, lean_mask, adipose_mask, air_mask = generate_binary_masks(CT_arr, args)
+	if args.slab_size:
+		return process_scan_slabs(row, args, manifest, None if channels_done else (inputs_channels, params_channels), None if collage_done else (inputs_collage, params_collage))
 
-		#Generate SUV channels corresponding to different masks
-		SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A = generate_HU_channels(SUV_arr, bone_mask, lean_mask, adipose_mask, air_mask)
-		#Get CT channels corresponding to different masks
-		CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A = generate_HU_channels(CT_arr, bone_mask, lean_mask, adipose_mask, air_mask)
+	#Load Image, SEG as its lesion voxels (not read for NEGATIVE scans)
+	CT_arr, SUV_arr = read_nii(path_CT), read_nii(path_SUV)
+	lesions = load_lesions(row, CT_arr.shape)
+	#Bounding box of the body, everything outside of it is air
+	bbox = get_body_bbox(CT_arr, args, lesions=lesions) if args.roi_crop else None
+	#Generate SUV and CT channels for the different tissues, corresponding to different HU windows (single pass over CT and SUV)
+	channels, label_map = generate_tissue_channels(CT_arr, SUV_arr, args, dtype=get_compute_dtype(args.channel_dtype, args.volume_dtype), return_label_map=True, bbox=bbox)
+	SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A = channels
+	#Statistics of the scan, also used for the collage
+	stats = compute_scan_statistics(CT_arr, SUV_arr, None, args, label_map, lesions) if args.scan_statistics else None
 
-		#Save all the nii Images for CT and SUV
-		save_all_nii(path_CT, save_path_nii, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, "CT")
-		save_all_nii(path_SUV, save_path_nii, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, "SUV")
+	if not channels_done:
+		#The volumes are written concurrently with the headers of CT and SUV
+		with NiftiWriter.from_args(args) as writer:
+			if args.channel_storage == "label_map":
+				#Save only the tissue label map, the channels are rebuilt from CT/SUV when needed (see utils.TissueChannels)
+				save_npy_nii(path_CT, label_map, get_label_map_path(args, pat_ID, scan_date), writer)
+			else:
+				#Save all the nii Images for CT and SUV
+				save_all_nii(path_CT, save_path_nii, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, "CT", writer, get_nii_extension(args), dtype=args.channel_dtype)
+				save_all_nii(path_SUV, save_path_nii, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, "SUV", writer, get_nii_extension(args), dtype=args.channel_dtype)
+		manifest.record("channels", inputs_channels, params_channels)
+		manifest.save()
 
+	if not collage_done:
 		#Generate Collages for visualization
-		generate_SUV_CT_collage(args, SEG_arr, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, save_path_visualizations, pat_ID, scan_date, disease_type)
-		#break
+		generate_SUV_CT_collage(args, None, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, save_path_visualizations, pat_ID, scan_date, disease_type, save_intermediates=args.save_collage_intermediates, bbox=bbox, stats=stats, lesions=lesions)
+		manifest.record("collage", inputs_collage, params_collage)
+		manifest.save()
+	outputs = {"bbox": bbox, "statistics": stats}
+	return {key: value for key, value in outputs.items() if value is not None}
+
+def process_scan_slabs(row, args, manifest, channels, collage):
+	"""
+	process_scan out of core (--slab_size): the volumes of the scan are read, masked and written slab by slab along z (see utils.generate_tissue_channels_slabs).
+	channels, collage - (inputs, params) recorded in the manifest for the artifacts to generate, None for the ones that are up to date.
+	"""
+	pat_ID, scan_date = row["pat_ID"], row["scan_date"]
+	save_path_nii = os.path.join(args.path_multi_channel_3D_CT_SUV, "3D_CT_SUV_Data", pat_ID, scan_date)
+	save_path_visualizations = os.path.join(args.path_multi_channel_3D_CT_SUV, "Visualization")
+	label_map = args.channel_storage == "label_map"
+	with NiftiWriter.from_args(args) as writer:
+		projections, bbox = generate_tissue_channels_slabs(args, row["CT"], row["SUV"], None if is_negative(row) else row["SEG"], args.slab_size, writer,
+			save_path=save_path_nii if channels is not None and not label_map else None, path_label_map=get_label_map_path(args, pat_ID, scan_date) if channels is not None and label_map else None,
+			dtype=get_compute_dtype(args.channel_dtype, args.volume_dtype), save_dtype=args.channel_dtype, collage=collage is not None, roi=args.roi_crop)
+	if channels is not None:
+		manifest.record("channels", *channels)
+		manifest.save()
+	if collage is not None:
+		frames = {i: {name: get_collage_frame(MIP) for name, MIP in P.items()} for i, P in projections.items()}
+		save_SUV_CT_collage(frames, save_path_visualizations, pat_ID, scan_date, row["diagnosis"], save_intermediates=args.save_collage_intermediates)
+		manifest.record("collage", *collage)
+		manifest.save()
+	if bbox is not None:
+		return {"bbox": bbox}
+
+def main(args):
+	if args.slab_size and args.scan_statistics:
+		raise ValueError("--scan_statistics needs the whole volumes (percentiles, histograms) and is not computed with --slab_size")
+	df_all = pd.read_csv(args.path_df)
+	df = select_shard(df_all, args) #Scans of shard --shard_index of --num_shards (all the scans if the run is not sharded)
+	#df = df[df["diagnosis"]=="NEGATIVE"].reset_index(drop=True)
+	#df = df[df["pat_ID"]=="PETCT_0223010e46"].reset_index(drop=True)
+	#print("start to 250")
+	#df = df[10:250].reset_index(drop=True)
+	#df_new = df[df.pat_ID.isin(args.include_ids)].reset_index(drop=True)
+	output_path = args.path_multi_channel_3D_CT_SUV
+	os.makedirs(output_path, exist_ok=True)
+	args.profile_dir = args.profile_dir or output_path
+	init_profiler(args) #No-op unless --profile is set
+	if args.scan_statistics:
+		#Scans that are up to date are only processed if their statistics are missing
+		stats = ScanStatistics(args)
+		df["compute_statistics"] = [stats.get(row["pat_ID"], row["scan_date"]) is None for _, row in df.iterrows()]
+
+	#Process the scans (in parallel if num_workers > 1), a failing scan is reported and skipped
+	df_status = run_scans(process_scan, df, args, num_workers=args.num_workers, max_in_flight=args.max_in_flight)
+	if "bbox" in df_status:
+		#Index of the body bounding boxes, reused by the projections
+		save_bbox_index(args, df_status[df_status["bbox"].notna()].to_dict("records"))
+		df_status = df_status.drop(columns="bbox")
+	if "statistics" in df_status:
+		#Index of the scan statistics, looked up by the projections and dataset-level queries (see utils.ScanStatistics)
+		save_scan_statistics(args, df_status[df_status["statistics"].notna()].to_dict("records"))
+		df_status = df_status.drop(columns="statistics")
+	df_status.to_csv(get_shard_path(os.path.join(output_path, "scan_status.csv"), args), index=False)
+	if args.profile:
+		init_profiler(args).report(get_shard_path(os.path.join(args.profile_dir, "run_report"), args))
+	save_shard_record(output_path, "channels", args, df_all, df)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+#Fast QC collages: the collage of every scan is rendered from a downsampled level (--preview_level) of its preview pyramid (Previews/<pat_ID>/<scan_date>/preview.npz,
+#generated once per scan) instead of the full-resolution volumes, to Visualization/QC_<level>x/Collages. With --qc_changed_only only the scans whose inputs changed are rendered.
+import pandas as pd
+import os
+
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import parse_args
+from utils import read_nii, generate_tissue_channels, render_collage_projections, get_collage_frame, save_SUV_CT_collage, get_scan_artifacts, get_preview_path, get_QC_collage_path, build_preview_pyramid, save_preview_pyramid, load_preview_level
+from scan_runner import run_scans
+from volume_cache import init_volume_cache
+from profiling import init_profiler
+from manifest import BuildManifest, get_fingerprints
+
+def process_scan(row, args):
+	"""
+	Render the QC collage of a single scan (one row of df) from its preview pyramid, generated first if it is missing or stale.
+	"""
+	init_volume_cache(args) #No-op unless --volume_cache_dir is set (runs in every worker process)
+	pat_ID, scan_date = row["pat_ID"], row["scan_date"]
+	level = args.preview_level
+	path_preview = get_preview_path(args, pat_ID, scan_date)
+	os.makedirs(os.path.dirname(path_preview), exist_ok=True)
+
+	#The previews and QC collages are recorded in the manifest of the preview folder, apart from the full-resolution outputs
+	manifest = BuildManifest(os.path.dirname(path_preview))
+	artifacts = get_scan_artifacts(args, row)
+	inputs_preview, params_preview, outputs_preview = artifacts["preview"]
+	inputs_preview = get_fingerprints(inputs_preview)
+	inputs_QC, params_QC, outputs_QC = artifacts["QC_collage_{}x".format(level)]
+	inputs_QC = get_fingerprints(inputs_QC)
+	if args.qc_changed_only and manifest.is_done("QC_collage_{}x".format(level), inputs_QC, params_QC, outputs_QC):
+		return {"rendered": False}
+
+	if manifest.is_done("preview", inputs_preview, params_preview, outputs_preview):
+		CT_arr, SUV_arr, SEG_arr = load_preview_level(path_preview, level)
+	else:
+		#Load Image (once per scan) and build all the levels of the pyramid
+		pyramid = build_preview_pyramid(read_nii(row["CT"]), read_nii(row["SUV"]), read_nii(row["SEG"]), args.preview_factors)
+		save_preview_pyramid(path_preview, pyramid)
+		manifest.record("preview", inputs_preview, params_preview)
+		manifest.save()
+		CT_arr, SUV_arr, SEG_arr = pyramid[level]
+
+	#Same projections as the full-resolution collage, on the downsampled volumes
+	channels = generate_tissue_channels(CT_arr, SUV_arr, args)
+	projections = render_collage_projections(args, SEG_arr, SUV_arr, *channels[:4], CT_arr, *channels[4:])
+	frames = {i: {name: get_collage_frame(MIP, crop=85 // level) for name, MIP in P.items()} for i, P in projections.items()}
+	save_SUV_CT_collage(frames, get_QC_collage_path(args), pat_ID, scan_date, row["diagnosis"])
+	manifest.record("QC_collage_{}x".format(level), inputs_QC, params_QC)
+	manifest.save()
+	return {"rendered": True}
+
+def main(args):
+	if args.preview_level not in args.preview_factors:
+		raise ValueError("--preview_level {} is not one of --preview_factors {}".format(args.preview_level, args.preview_factors))
+	df = pd.read_csv(args.path_df)
+	output_path = get_QC_collage_path(args)
+	os.makedirs(output_path, exist_ok=True)
+	args.profile_dir = args.profile_dir or output_path
+	init_profiler(args) #No-op unless --profile is set
+
+	#Process the scans (in parallel if num_workers > 1), a failing scan is reported and skipped
+	df_status = run_scans(process_scan, df, args, num_workers=args.num_workers, max_in_flight=args.max_in_flight)
+	if "rendered" in df_status:
+		print("Rendered {} QC collages.".format(int(df_status["rendered"].fillna(False).sum())))
+	df_status.to_csv(os.path.join(output_path, "qc_status.csv"), index=False)
+	if args.profile:
+		init_profiler(args).report(os.path.join(args.profile_dir, "run_report"))
+
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
+	print("Done")
@@ -0,0 +1,52 @@
+#Compute the statistics of every scan (see utils.compute_scan_statistics) without generating the channels, projections or collages,
+#indexed in scan_statistics.csv/scan_histograms.npz next to df_final.csv (the index --scan_statistics of the other scripts reads and updates).
+import os
+import pandas as pd
+
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import parse_args
+from utils import read_nii, load_lesions, generate_tissue_label_map, compute_scan_statistics, save_scan_statistics, ScanStatistics
+from scan_runner import run_scans
+from volume_cache import init_volume_cache
+from profiling import init_profiler
+from sharding import select_shard, get_shard_path, save_shard_record
+
+def process_scan(row, args):
+	"""
+	Compute the statistics of a single scan (one row of df), returns {"statistics": ...}.
+	"""
+	init_volume_cache(args) #No-op unless --volume_cache_dir is set (runs in every worker process)
+	if not row.get("compute_statistics", True):
+		return
+	#Load Image, SEG as its lesion voxels (not read for NEGATIVE scans)
+	CT_arr, SUV_arr = read_nii(row["CT"]), read_nii(row["SUV"])
+	lesions = load_lesions(row, CT_arr.shape)
+	label_map = generate_tissue_label_map(CT_arr, args)
+	return {"statistics": compute_scan_statistics(CT_arr, SUV_arr, None, args, label_map, lesions)}
+
+def main(args):
+	df_all = pd.read_csv(args.path_df)
+	df = select_shard(df_all, args) #Scans of shard --shard_index of --num_shards (all the scans if the run is not sharded)
+	output_path = os.path.dirname(os.path.abspath(args.path_df))
+	args.profile_dir = args.profile_dir or output_path
+	init_profiler(args) #No-op unless --profile is set
+	#Only the scans whose statistics are missing (or were computed with other HU windows) are processed
+	stats = ScanStatistics(args)
+	df["compute_statistics"] = [stats.get(row["pat_ID"], row["scan_date"]) is None for _, row in df.iterrows()]
+
+	#Process the scans (in parallel if num_workers > 1), a failing scan is reported and skipped
+	df_status = run_scans(process_scan, df, args, num_workers=args.num_workers, max_in_flight=args.max_in_flight)
+	if "statistics" in df_status:
+		save_scan_statistics(args, df_status[df_status["statistics"].notna()].to_dict("records"))
+		df_status = df_status.drop(columns="statistics")
+	df_status.to_csv(get_shard_path(os.path.join(output_path, "statistics_status.csv"), args), index=False)
+	if args.profile:
+		init_profiler(args).report(get_shard_path(os.path.join(args.profile_dir, "run_report"), args))
+	save_shard_record(output_path, "statistics", args, df_all, df)
+
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
+	print("Done")
@@ -0,0 +1,178 @@
+#Single pass version of multi_channel_3D_SUV_CT_generation.py followed by multi-angled_multi-channel_2D_projections_generation.py:
+#every scan is read once, split into the tissue channels in memory, projected at all the angles and rendered for the collage,
+#and only the artifacts in --pipeline_outputs are saved (the projections no longer need the 3D channels on disk).
+import pandas as pd
+import os
+import json
+
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import parse_args
+from utils import read_nii, load_lesions, generate_tissue_channels, save_all_nii, save_npy_nii, get_nii_extension, get_compute_dtype, get_label_map_path, preprocess_CT_HU_values, get_projection_stack, get_round_channels, generate_multi_channel_projections, save_projections, render_collage_projections, get_collage_frame, save_SUV_CT_collage, get_scan_artifacts, get_projection_params, get_projection_inputs, get_stale_angles, get_channel_min, get_body_bbox, save_bbox_index, compute_scan_statistics, save_scan_statistics, ScanStatistics
+from projection_store import save_projection_tensor, save_projection_index, get_projection_tensor_path
+from volume_cache import init_volume_cache
+from profiling import init_profiler
+from manifest import BuildManifest, get_fingerprints
+from scan_runner import run_pipeline
+from nifti_writer import NiftiWriter
+from sharding import select_shard, get_shard_path, save_shard_record
+
+def load_scan(item, args):
+	"""
+	Find the artifacts of the scan that are missing or stale and read its CT and SUV volumes and its lesion voxels (see utils.LesionVoxels).
+	"""
+	row = item["row"]
+	pat_ID, scan_date = row["pat_ID"], row["scan_date"]
+	item["manifest"] = BuildManifest(os.path.join(args.path_multi_channel_3D_CT_SUV, "3D_CT_SUV_Data", pat_ID, scan_date))
+	item["todo"] = []
+	artifacts = get_scan_artifacts(args, row)
+	for artifact in ("channels", "collage"):
+		inputs, params, outputs = artifacts[artifact]
+		if artifact in args.pipeline_outputs and not item["manifest"].is_done(artifact, get_fingerprints(inputs), params, outputs):
+			item["todo"].append(artifact)
+
+	if "projections" in args.pipeline_outputs:
+		save_path = os.path.join(args.path_multi_angled_multi_channel_2D_projections, pat_ID, scan_date)
+		os.makedirs(save_path, exist_ok=True)
+		item["manifest_projections"] = BuildManifest(save_path)
+		item["inputs_projections"] = get_fingerprints(get_projection_inputs(row)) #Same inputs as the projection script
+		item["params_projections"] = get_projection_params(args)
+		angles = list(range(args.rotation_min, args.rotation_max+1, args.rotation_interval))
+		if args.projection_format == "tensor":
+			item["params_projections"] = dict(item["params_projections"], angles=angles, projection_compression=args.projection_compression)
+			outputs = [get_projection_tensor_path(save_path, args.projection_compression), os.path.join(save_path, "projections.json")]
+			item["angles"] = [] if item["manifest_projections"].is_done("projection_tensor", item["inputs_projections"], item["params_projections"], outputs) else angles
+		else:
+			item["angles"] = get_stale_angles(save_path, angles, item["manifest_projections"], item["inputs_projections"], item["params_projections"])
+		if item["angles"]:
+			item["todo"].append("projections")
+	if args.scan_statistics and row.get("compute_statistics", True):
+		item["todo"].append("statistics")
+
+	if not item["todo"]:
+		return None
+
+	#Load Image, SEG as its lesion voxels (not read for NEGATIVE scans)
+	item["CT"], item["SUV"] = read_nii(row["CT"]), read_nii(row["SUV"])
+	item["lesions"] = load_lesions(row, item["CT"].shape)
+	return item
+
+def save_scan_projections(item, stack, bbox, lesions, round_channels, args):
+	"""
+	Generate the projections of the scan angle by angle and save every angle as soon as it is projected, so that only one angle is held in memory
+	(the projections of all the angles are as large as the stack, they would double the memory of every scan waiting for the writer).
+	"""
+	row = item["row"]
+	save_path = os.path.join(args.path_multi_angled_multi_channel_2D_projections, row["pat_ID"], row["scan_date"])
+	if args.projection_format == "tensor":
+		save_projection_tensor(save_path, stack, item["angles"], args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, order=args.projection_order, round_channels=round_channels, compression=args.projection_compression, dtype=args.projection_dtype, bbox=bbox, lesions=lesions)
+		item["manifest_projections"].record("projection_tensor", item["inputs_projections"], item["params_projections"])
+		item["manifest_projections"].save()
+	else:
+		projections = generate_multi_channel_projections(stack, item["angles"], args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, order=args.projection_order, round_channels=round_channels, bbox=bbox, dtype=get_compute_dtype(args.projection_dtype), lesions=lesions)
+		save_projections(save_path, projections, item["manifest_projections"], item["inputs_projections"], item["params_projections"], dtype=args.projection_dtype)
+
+def compute_scan(item, args):
+	"""
+	Generate the tissue channels and the collage frames of the scan in memory, and save its multi-angle projections as they are generated (see save_scan_projections).
+	"""
+	CT_arr, SUV_arr, lesions = item.pop("CT"), item.pop("SUV"), item.pop("lesions")
+	#Bounding box of the body, everything outside of it is air
+	bbox = get_body_bbox(CT_arr, args, lesions=lesions) if args.roi_crop else None
+	if bbox is not None:
+		item["outputs"] = {"bbox": bbox}
+	#Generate SUV and CT channels for the different tissues, corresponding to different HU windows (single pass over CT and SUV)
+	channels, label_map = generate_tissue_channels(CT_arr, SUV_arr, args, dtype=get_compute_dtype(args.channel_dtype, args.volume_dtype), return_label_map=True, bbox=bbox)
+	SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A = channels
+	#Statistics of the scan, also used for the projections and the collage
+	stats = compute_scan_statistics(CT_arr, SUV_arr, None, args, label_map, lesions) if args.scan_statistics else None
+	if stats is not None:
+		item["outputs"] = dict(item.get("outputs", {}), statistics=stats)
+	lows = [get_channel_min(stats, name) for name in ("CT_lean_tissue", "CT_adipose_tissue", "CT_air")]
+
+	if "channels" in item["todo"]:
+		item["channels"] = label_map if args.channel_storage == "label_map" else channels
+
+	if "projections" in item["todo"]:
+		stack = get_projection_stack(SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, preprocess_CT_HU_values(CT_arr_LT, lows[0]), preprocess_CT_HU_values(CT_arr_AT, lows[1]), preprocess_CT_HU_values(CT_arr_A, lows[2]), lesions, dtype=args.volume_dtype)
+		save_scan_projections(item, stack, bbox, lesions, get_round_channels(CT_arr.dtype, SUV_arr.dtype, lesions.dtype), args)
+		del stack
+
+	if "collage" in item["todo"]:
+		projections = render_collage_projections(args, None, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, bbox=bbox, stats=stats, lesions=lesions)
+		item["frames"] = {i: {name: get_collage_frame(MIP) for name, MIP in P.items()} for i, P in projections.items()}
+	return item
+
+def write_scan(item, args):
+	"""
+	Save the requested artifacts of the scan (the projections are already saved by compute_scan) and record them in its manifests.
+	"""
+	row = item["row"]
+	pat_ID, scan_date = row["pat_ID"], row["scan_date"]
+	manifest = item["manifest"]
+	artifacts = get_scan_artifacts(args, row)
+
+	if "channels" in item["todo"]:
+		save_path_nii = os.path.join(args.path_multi_channel_3D_CT_SUV, "3D_CT_SUV_Data", pat_ID, scan_date)
+		os.makedirs(save_path_nii, exist_ok=True)
+		channels = item.pop("channels")
+		with NiftiWriter.from_args(args) as writer:
+			if args.channel_storage == "label_map":
+				save_npy_nii(row["CT"], channels, get_label_map_path(args, pat_ID, scan_date), writer)
+			else:
+				save_all_nii(row["CT"], save_path_nii, *channels[4:], "CT", writer, get_nii_extension(args), dtype=args.channel_dtype)
+				save_all_nii(row["SUV"], save_path_nii, *channels[:4], "SUV", writer, get_nii_extension(args), dtype=args.channel_dtype)
+		inputs, params, _ = artifacts["channels"]
+		manifest.record("channels", get_fingerprints(inputs), params)
+		manifest.save()
+
+	if "collage" in item["todo"]:
+		os.makedirs(os.path.join(args.path_multi_channel_3D_CT_SUV, "3D_CT_SUV_Data", pat_ID, scan_date), exist_ok=True)
+		save_SUV_CT_collage(item.pop("frames"), os.path.join(args.path_multi_channel_3D_CT_SUV, "Visualization"), pat_ID, scan_date, row["diagnosis"], save_intermediates=args.save_collage_intermediates)
+		inputs, params, _ = artifacts["collage"]
+		manifest.record("collage", get_fingerprints(inputs), params)
+		manifest.save()
+	return item
+
+def main(args):
+	init_volume_cache(args) #Read the volumes through the decoded volume cache if --volume_cache_dir is set
+	df_all = pd.read_csv(args.path_df)
+	df = select_shard(df_all, args) #Scans of shard --shard_index of --num_shards (all the scans if the run is not sharded)
+	os.makedirs(args.path_multi_channel_3D_CT_SUV, exist_ok=True)
+	args.profile_dir = args.profile_dir or args.path_multi_channel_3D_CT_SUV
+	init_profiler(args) #No-op unless --profile is set
+	if args.scan_statistics:
+		#Scans that are up to date are only processed if their statistics are missing
+		stats = ScanStatistics(args)
+		df["compute_statistics"] = [stats.get(row["pat_ID"], row["scan_date"]) is None for _, row in df.iterrows()]
+
+	#Reading, computing (on num_workers threads) and writing of consecutive scans overlap, with at most queue_size scans waiting between two stages
+	stages = [("load", load_scan, 1), ("compute", compute_scan, max(args.num_workers, 1)), ("write", write_scan, 1)]
+	df_status = run_pipeline(stages, df, args, queue_size=args.queue_size)
+	if "bbox" in df_status:
+		#Index of the body bounding boxes, reused by the projections
+		save_bbox_index(args, df_status[df_status["bbox"].notna()].to_dict("records"))
+		df_status = df_status.drop(columns="bbox")
+	if "statistics" in df_status:
+		#Index of the scan statistics, looked up by the projections and dataset-level queries (see utils.ScanStatistics)
+		save_scan_statistics(args, df_status[df_status["statistics"].notna()].to_dict("records"))
+		df_status = df_status.drop(columns="statistics")
+	df_status.to_csv(get_shard_path(os.path.join(args.path_multi_channel_3D_CT_SUV, "pipeline_status.csv"), args), index=False)
+	if args.profile:
+		init_profiler(args).report(get_shard_path(os.path.join(args.profile_dir, "run_report"), args))
+
+	if "projections" in args.pipeline_outputs and args.projection_format == "tensor":
+		#Index of the projection tensors of all the scans (also the ones that were up to date)
+		records = []
+		for _, row in df.iterrows():
+			path_metadata = os.path.join(args.path_multi_angled_multi_channel_2D_projections, row["pat_ID"], row["scan_date"], "projections.json")
+			if os.path.isfile(path_metadata):
+				with open(path_metadata) as f:
+					records.append(dict(json.load(f), pat_ID=row["pat_ID"], scan_date=row["scan_date"]))
+		save_projection_index(args.path_multi_angled_multi_channel_2D_projections, records, args)
+	save_shard_record(args.path_multi_channel_3D_CT_SUV, "pipeline", args, df_all, df)
+
+if __name__ == "__main__":
+	args = parse_args()
+	main(args)
+	print("Done")
@@ -0,0 +1,61 @@
+#Single entry point of the Data Preparation scripts: python cli.py <command> [options], e.g. python cli.py channels --config run.json --num_workers 8.
+#Only the script of the command is imported, so every command (and every worker process) only loads the dependencies it uses.
+import argparse
+import importlib
+import os
+import sys
+
+from config import get_parser, read_config
+
+PATH_SCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Data Preparation")
+
+#Command: (script in Data Preparation, description)
+COMMANDS = {
+    "channels": ("multi_channel_3D_SUV_CT_generation", "Generate the multi-channel 3D SUV/CT volumes (or tissue label maps) and the collages."),
+    "projections": ("multi-angled_multi-channel_2D_projections_generation", "Generate the multi-angle projections of all the channels."),
+    "pipeline": ("streaming_pipeline", "Generate the channels, projections and collages in a single pass over the scans."),
+    "collages": ("qc_collages", "Render the QC collages from the preview pyramids."),
+    "stats": ("scan_statistics", "Compute the scan statistics index."),
+    "lesions": ("lesion_quantification", "Compute the lesion features."),
+    "merge": ("merge_shards", "Merge the outputs of a sharded run."),
+    "benchmarks": ("benchmark_data_preparation", "Benchmark the hot paths on synthetic volumes."),
+}
+
+def get_cli_parser():
+    """
+    Parser with one subcommand per script, each with all the options of config.py. Returns the parser and the subparsers by command.
+    """
+    parser = argparse.ArgumentParser(description="Data Preparation of the autoPET PET/CT scans.")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+    commands = {name: subparsers.add_parser(name, parents=[get_parser(add_help=False)], help=description, description=description) for name, (_, description) in COMMANDS.items()}
+    return parser, commands
+
+def parse_cli_args(argv=None):
+    """
+    Parse the command and its options, with the values of the --config file as defaults.
+    """
+    parser, commands = get_cli_parser()
+    args = parser.parse_args(argv)
+    if args.config is not None:
+        commands[args.command].set_defaults(**read_config(args.config))
+        args = parser.parse_args(argv)
+    return args
+
+def run(command, args):
+    """
+    Run the script of command with the options args (e.g. config.load_config("run.json", num_workers=8)), without parsing sys.argv.
+    """
+    if PATH_SCRIPTS not in sys.path:
+        sys.path.insert(0, PATH_SCRIPTS)
+    module = importlib.import_module(COMMANDS[command][0])
+    return module.main(args)
+
+def main(argv=None):
+    args = parse_cli_args(argv)
+    run(args.command, args)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 import argparse
+import json
 
-def parse_args():
-    parser = argparse.ArgumentParser()
+def get_parser(add_help=True):
+    """
+    Parser of all the options of the Data Preparation steps (see parse_args and cli.py).
+    """
+    parser = argparse.ArgumentParser(add_help=add_help)
+    parser.add_argument("--config", default=None, help="JSON file of option values (e.g. written by config.save_config), used instead of the defaults; options given on the command line override it.")
 
     #################################Common
 
@@ -18,17 +23,117 @@ def parse_args():
     parser.add_argument("--adipose_HU", default=[-190, -30], help="Adipose tissue HU limit (-190 < x < -30)")
     parser.add_argument("--air_HU", default=[-191], help="Air HU limit (< -191)")
 
+    parser.add_argument("--channel_storage", default="channels", choices=["channels", "label_map"], help="Output of the 3D channel generation: eight masked SUV/CT volumes per scan (channels) or a single uint8 tissue label map (label_map) from which the channels are rebuilt on demand.")
+    parser.add_argument("--volume_dtype", default="float32", choices=["float64", "float32", "float16"], help="Data type the SUV/CT channels and the projection stacks are computed in (unless --channel_dtype is a float type, which the channels are then computed in).")
+    parser.add_argument("--channel_dtype", default="float32", choices=["float64", "float32", "float16", "uint16", "uint8"], help="Data type of the generated multi-channel SUV and CT volumes. uint16/uint8 volumes are stored with their scale (scl_slope/scl_inter) in the NIfTI header.")
+    parser.add_argument("--nifti_format", default="nii.gz", choices=["nii.gz", "nii"], help="Format of the generated NIfTI volumes (tissue channels or label map): gzip-compressed or uncompressed.")
+    parser.add_argument("--nifti_compression_level", default=1, type=int, help="gzip compression level (1-9) of the generated .nii.gz volumes.")
+    parser.add_argument("--slab_size", default=None, type=int, help="Generate the 3D channels, the collage and the body bounding box out of core: the volumes are read, masked and written slab by slab of this many z planes, with a bounded memory (identical outputs). Not combined with --scan_statistics.")
+    parser.add_argument("--nifti_threads", default=4, type=int, help="Number of threads writing and compressing the NIfTI volumes of a scan.")
+
     parser.add_argument("--SUV_max_collage", default=14, help="Maximum SUV threshold to be used during generation of collages for the purpose of visualization")
+    parser.add_argument("--save_collage_intermediates", action="store_true", help="Also save the projections of every view and the per-projection collages under Visualization/MIPs (only the final collage under Visualization/Collages is saved by default).")
+
+    parser.add_argument("--preview_factors", default=[2, 4], type=int, nargs="+", help="Downsampling factors of the preview pyramid of every scan (CT averaged, SUV and SEG max-pooled), generated once per scan by qc_collages.py.")
+    parser.add_argument("--preview_level", default=4, type=int, help="Level (one of --preview_factors) of the preview pyramid the QC collages are rendered from.")
+    parser.add_argument("--qc_changed_only", action="store_true", help="Render the QC collages of the scans whose inputs (or collage parameters) changed since their last QC collage only.")
+
+    parser.add_argument("--rotation_min", default=-90, type=int, help="Starting angle of multi-angle multi-channel 2D projections.")
+    parser.add_argument("--rotation_max", default=90, type=int, help="Ending angle of multi-angle multi-channel 2D projections.")
+    parser.add_argument("--rotation_interval", default=90, type=int, help="Interval angle by which each of the projections will be rotated.")
+    parser.add_argument("--projection_format", default="npy_files", choices=["npy_files", "tensor"], help="Output of the multi-angle projections: one .npy file per channel and angle (npy_files) or one (angle, channel, H, W) tensor per scan plus projection_index.csv (tensor).")
+    parser.add_argument("--projection_compression", default=None, choices=["gzip", "lzf"], help="Chunked compression of the projection tensors (stored as HDF5, needs h5py). Uncompressed tensors are memory-mappable .npy files.")
+    parser.add_argument("--projection_dtype", default="float32", choices=["float64", "float32", "float16", "uint16", "uint8"], help="Data type of the saved multi-angle projections. uint16/uint8 projections are stored with the scale of every image (projection_scales.json, or \"scales\" in projections.json for tensors) and dequantized by the readers.")
+    parser.add_argument("--projection_order", default=3, type=int, help="Interpolation order of the rotations of the multi-angle projections. 3 (default) reproduces scipy.ndimage.rotate's cubic spline exactly and still rotates every slab of the volumes with it, at the cost of the original scripts; 0/1 are much faster (computed directly without rotating the volumes) but differ from it at sharp edges (see utils.project_channels for the bounds).")
+
+    parser.add_argument("--roi_crop", action="store_true", help="Restrict masking, projections and collage rendering to the bounding box of the body (non-air voxels and lesions, indexed in body_bbox.csv next to df_final.csv). Outputs keep the full-volume shapes.")
+    parser.add_argument("--roi_margin", default=2, type=int, help="Margin (in voxels, at least 1) added around the body bounding box.")
+
+    parser.add_argument("--scan_statistics", action="store_true", help="Compute the statistics of every scan (min/max/percentiles of CT and SUV, per-tissue and lesion voxel counts and ranges, CT/SUV histograms) once, index them in scan_statistics.csv/scan_histograms.npz next to df_final.csv and look them up instead of reducing the volumes again.")
+
+    parser.add_argument("--CT_min", default=-100, type=float, help="Dummy.")
+    parser.add_argument("--CT_max", default=250, type=float, help="Dummy.")
+    parser.add_argument("--SUV_min", default=0, type=float, help="Minimum SUV ScaleIntensityRanged.")
+    parser.add_argument("--SUV_max", default=15, type=float, help="Maximum SUV ScaleIntensityRanged.")
 
-    parser.add_argument("--rotation_min", default=-90, help="Starting angle of multi-angle multi-channel 2D projections.")
-    parser.add_argument("--rotation_max", default=90, help="Ending angle of multi-angle multi-channel 2D projections.")
-    parser.add_argument("--rotation_interval", default=90, help="Interval angle by which each of the projections will be rotated.")
+    #On-demand projections (projection_service.ProjectionService)
+    parser.add_argument("--resident_scans", default=4, type=int, help="Number of scans whose volumes the projection service keeps in memory (least recently used scans are evicted).")
+    parser.add_argument("--projection_cache_MB", default=1024, type=float, help="Size of the LRU cache of the projections computed by the projection service.")
+    parser.add_argument("--service_workers", default=2, type=int, help="Number of localhost server processes of projection_service.ProjectionServicePool, each serving a share of the scans.")
+
+    #Lesion quantification
+    parser.add_argument("--lesion_connectivity", default=3, type=int, choices=[1, 2, 3], help="Connectivity of the lesions labelled in SEG: 1, 2 or 3 for 6-, 18- or 26-connected voxels.")
+    parser.add_argument("--SUV_peak_ml", default=1., type=float, help="Volume (ml) of the sphere SUVpeak is averaged over.")
+
+    #Execution
+    parser.add_argument("--volume_cache_dir", default=None, help="Directory of the persistent cache of decoded NIfTI volumes shared by both Data Preparation scripts (disabled if not set).")
+    parser.add_argument("--volume_cache_GB", default=100, type=float, help="Maximum size of the volume cache, least recently used volumes are deleted beyond it.")
+    parser.add_argument("--num_workers", default=1, type=int, help="Number of worker processes used to process the scans in parallel (1 runs everything in the main process).")
+    parser.add_argument("--max_in_flight", default=None, type=int, help="Maximum number of scans queued to the workers at once (defaults to 2 x num_workers).")
+    parser.add_argument("--pipeline_outputs", default=["projections", "collage"], nargs="+", choices=["channels", "projections", "collage"], help="Artifacts saved by the streaming pipeline (streaming_pipeline.py): 3D tissue channels (as set by --channel_storage), multi-angle projections (as set by --projection_format) and/or collages.")
+    parser.add_argument("--queue_size", default=2, type=int, help="Maximum number of scans waiting between two stages of the streaming pipeline.")
+    parser.add_argument("--num_shards", default=1, type=int, help="Split the scans of df_final.csv into this many shards balanced by estimated cost (voxels, and lesions if df has a \"n_lesions\" column), e.g. one per node; every shard writes its own indexes and run report, combined by merge_shards.py.")
+    parser.add_argument("--shard_index", default=0, type=int, help="Shard (0 to num_shards - 1) processed by this run. The assignment of the scans to the shards is deterministic, so every node computes the same one.")
+    parser.add_argument("--shard_step", default="channels", choices=["channels", "projections", "pipeline", "statistics"], help="Sharded script whose shards merge_shards.py merges: the 3D channel generation, the multi-angle projections, the streaming pipeline or the scan statistics.")
+    parser.add_argument("--profile", action="store_true", help="Record the wall/CPU time, peak RSS and file I/O of every stage (load, mask, save, render, rotate, project, encode) of every scan and write a run report (run_report.json/.csv).")
+    parser.add_argument("--profile_scan", default=None, help="Run this scan (\"pat_ID\" or \"pat_ID/scan_date\") under cProfile and save its statistics (profile_<pat_ID>_<scan_date>.prof).")
+    parser.add_argument("--profile_dir", default=None, help="Folder of the run report and cProfile statistics (defaults to the output folder of the script).")
+
+    #Benchmark
+    parser.add_argument("--benchmark_sizes", default=["200x200x163", "400x400x326"], nargs="+", help="Shapes (XxYxZ, as returned by read_nii) of the synthetic PET/CT/SEG volumes used by benchmark_data_preparation.py.")
+    parser.add_argument("--benchmark_rotation_intervals", default=[90, 10], type=int, nargs="+", help="Rotation intervals (from -90 to +90 degrees) of the benchmarked projection stages, i.e. 3 and 19 angles by default.")
+    parser.add_argument("--benchmark_workers", default=[1, 2], type=int, nargs="+", help="Worker counts of the benchmarked end-to-end runs of the 3D channel generation.")
+    parser.add_argument("--benchmark_scans", default=4, type=int, help="Number of synthetic scans of the end-to-end runs.")
+    parser.add_argument("--benchmark_repeats", default=3, type=int, help="Number of timed runs of every stage (the minimum and the median are reported).")
+    parser.add_argument("--benchmark_stages", default=None, nargs="+", help="Benchmark only these stages (default: all, and the dtype report).")
+    parser.add_argument("--benchmark_dtypes", default=["float64", "float32", "float16", "uint16", "uint8"], nargs="+", help="Dtypes of the dtype report (stage \"dtype_report\"): the difference of the channels, projection stacks and projections of every dtype from their float64 baseline.")
+    parser.add_argument("--benchmark_dir", default=None, help="Folder of the synthetic scans and of the outputs written by the benchmarked stages (default: a temporary folder).")
+    parser.add_argument("--benchmark_output", default="benchmark_results.json", help="JSON file the benchmark results are written to.")
+    parser.add_argument("--benchmark_baseline", default=None, help="Results of an earlier benchmark run (e.g. another commit) to compare against.")
+
+    return parser
+
+def parse_args(argv=None, parser=None):
+    """
+    Parse the options of argv (default: sys.argv), with the values of the --config file as defaults.
+    """
+    parser = get_parser() if parser is None else parser
+    args = parser.parse_args(argv)
+    if args.config is not None:
+        parser.set_defaults(**read_config(args.config, parser))
+        args = parser.parse_args(argv)
+    return args
 
-    parser.add_argument("--CT_min", default=-100, help="Dummy.")
-    parser.add_argument("--CT_max", default=250, help="Dummy.")
-    parser.add_argument("--SUV_min", default=0, help="Minimum SUV ScaleIntensityRanged.")
-    parser.add_argument("--SUV_max", default=15, help="Maximum SUV ScaleIntensityRanged.")
+def read_config(path, parser=None):
+    """
+    Option values of a JSON config file, checked against the options of the parser.
+    """
+    with open(path) as f:
+        values = json.load(f)
+    parser = get_parser() if parser is None else parser
+    unknown = sorted(set(values) - {action.dest for action in parser._actions})
+    if unknown:
+        raise ValueError("Unknown options in {}: {}".format(path, ", ".join(unknown)))
+    return values
 
-    args = parser.parse_args()
+def load_config(path=None, **overrides):
+    """
+    Options with their defaults, the values of the JSON config file at path and overrides, without parsing sys.argv, e.g. in worker processes or
+    array jobs: load_config("run.json", shard_index=k).
+    """
+    parser = get_parser()
+    args = parser.parse_args([])
+    values = dict(read_config(path, parser) if path is not None else {}, **overrides)
+    unknown = sorted(set(values) - set(vars(args)))
+    if unknown:
+        raise ValueError("Unknown options: {}".format(", ".join(unknown)))
+    vars(args).update(values)
+    args.config = path
     return args
 
+def save_config(args, path):
+    """
+    Save the options of args as a JSON config file (see load_config and --config).
+    """
+    with open(path, "w") as f:
+        json.dump({key: value for key, value in vars(args).items() if key not in ("config", "command")}, f, indent=1)
@@ -0,0 +1,64 @@
+#Per-scan manifest of the generated artifacts, with the fingerprints of their inputs and their parameters, so that a rerun only regenerates
+#the stale artifacts (see BuildManifest), and atomic writes of the outputs (see get_temp_path).
+import os
+import json
+import numpy as np
+
+from profiling import profiled, profile_io
+
+def get_temp_path(path):
+    """
+    Temporary path in the same folder (and with the same extension) as path, for atomic writes with os.replace.
+    """
+    return os.path.join(os.path.dirname(path), ".tmp{}_{}".format(os.getpid(), os.path.basename(path)))
+
+@profiled("save")
+def save_npy_atomic(path, arr):
+    path_temp = get_temp_path(path)
+    with open(path_temp, "wb") as f:
+        np.save(f, arr)
+    os.replace(path_temp, path)
+    profile_io(path, "written")
+
+def get_fingerprints(paths):
+    """
+    Cheap fingerprints (size and mtime) of input files, used by BuildManifest to detect changed inputs.
+    """
+    fingerprints = {}
+    for path in paths:
+        stat = os.stat(path)
+        fingerprints[os.path.abspath(path)] = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+    return fingerprints
+
+class BuildManifest:
+    """
+    Per-scan record of the generated artifacts ("manifest.json" in the output folder of the scan).
+
+    Every artifact is recorded with the fingerprints of its input files and the config parameters it depends on,
+    so that a rerun only regenerates the artifacts whose inputs or parameters changed or whose outputs are missing.
+    """
+    def __init__(self, save_path):
+        self.path = os.path.join(save_path, "manifest.json")
+        self.artifacts = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.artifacts = json.load(f)
+
+    def entry(self, inputs, params):
+        #Round trip through json so that e.g. tuples and lists compare equal
+        return json.loads(json.dumps({"inputs": inputs, "params": params}))
+
+    def is_done(self, artifact, inputs, params, outputs=()):
+        return self.artifacts.get(artifact) == self.entry(inputs, params) and all(os.path.exists(path) for path in outputs)
+
+    def get(self, artifact):
+        return self.artifacts.get(artifact)
+
+    def record(self, artifact, inputs, params):
+        self.artifacts[artifact] = self.entry(inputs, params)
+
+    def save(self):
+        path_temp = get_temp_path(self.path)
+        with open(path_temp, "w") as f:
+            json.dump(self.artifacts, f, indent=1)
+        os.replace(path_temp, self.path)
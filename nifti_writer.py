@@ -0,0 +1,149 @@
+#NIfTI volumes written with the header of a reference volume, concurrently and with parallel block compression (see NiftiWriter),
+#or slab by slab along z for the out-of-core channel generation (see NiftiSlabFile).
+import os
+import io
+import gzip
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import get_quantization, is_integral, quantize
+from profiling import profile_scan, profile_stage, profile_io, get_profiled_scan
+from manifest import get_temp_path
+
+class NiftiWriter:
+    """
+    Writes NIfTI volumes with the header (affine, orientation, units) of a reference volume, which is read once per reference and reused.
+
+    The volumes are written concurrently on num_threads threads, as the dtype of their array or the one passed to write; integer dtypes of float volumes are stored
+    with their scale in the NIfTI header (scl_slope/scl_inter, see get_quantization), applied by nibabel and SimpleITK on read. ".nii.gz" files are gzip-compressed at
+    compression_level in independent blocks of block_MB compressed in parallel (a multi-member gzip file, read as usual by nibabel and SimpleITK);
+    ".nii" files are written uncompressed. Every file is written atomically; wait() (or leaving the with block) returns once all are written.
+    """
+    def __init__(self, compression_level=1, num_threads=4, block_MB=4):
+        self.compression_level = compression_level
+        self.block_size = int(block_MB * 2**20)
+        self.files = ThreadPoolExecutor(max_workers=max(num_threads, 1))
+        self.blocks = ThreadPoolExecutor(max_workers=max(num_threads, 1))
+        self.headers = {}
+        self.pending = []
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(compression_level=getattr(args, "nifti_compression_level", 1), num_threads=getattr(args, "nifti_threads", 4))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_header(self, ref_path):
+        if ref_path not in self.headers:
+            image = nib.load(ref_path)
+            self.headers[ref_path] = (image.affine, image.header)
+        return self.headers[ref_path]
+
+    def write(self, ref_path, arr, save_path, dtype=None):
+        """
+        Queue arr to be written to save_path with the header of ref_path, stored as dtype (default: the dtype of arr).
+        """
+        affine, header = self.get_header(ref_path)
+        self.pending.append(self.files.submit(self._write, affine, header, arr, save_path, get_profiled_scan(), dtype))
+
+    def _write(self, affine, header, arr, save_path, scan, dtype=None):
+        with profile_scan(*scan), profile_stage("save"):
+            scale = None
+            if dtype is not None and np.dtype(dtype) != arr.dtype:
+                if np.dtype(dtype).kind != "f" and arr.dtype.kind == "f":
+                    scale = get_quantization(dtype, np.min(arr), np.max(arr), integral=is_integral(arr))
+                    arr = quantize(arr, dtype, scale)
+                else:
+                    arr = arr.astype(dtype)
+            image = nib.Nifti1Image(arr, affine, header=header)
+            image.set_data_dtype(arr.dtype)
+            if scale is not None:
+                image.header.set_slope_inter(*scale)
+            path_temp = get_temp_path(save_path)
+            with open(path_temp, "wb") as f:
+                self.write_data(f, image.to_bytes(), save_path.endswith(".gz"))
+            os.replace(path_temp, save_path)
+            profile_io(save_path, "written")
+
+    def write_data(self, f, data, compressed=True):
+        """
+        Write bytes to the open file f, as gzip members of block_MB compressed in parallel if compressed.
+        """
+        data = memoryview(data)
+        if not compressed:
+            f.write(data)
+            return
+        blocks = [data[start:start+self.block_size] for start in range(0, len(data), self.block_size)]
+        for member in self.blocks.map(lambda block: gzip.compress(block, compresslevel=self.compression_level, mtime=0), blocks):
+            f.write(member)
+
+    def open_slabs(self, ref_path, shape, save_path, dtype, scale=None):
+        """
+        Open a NIfTI volume of the given shape to be written slab by slab along z (see NiftiSlabFile), with the header of ref_path.
+        dtype, scale - Stored dtype, and the scale of integer dtypes (see get_quantization) the float slabs are quantized with.
+        """
+        affine, header = self.get_header(ref_path)
+        image = nib.Nifti1Image(np.broadcast_to(np.zeros((), dtype=dtype), shape), affine, header=header)
+        image.set_data_dtype(dtype)
+        image.header.set_slope_inter(*(scale or (1., 0.)))
+        image.update_header()
+        header_bytes = io.BytesIO()
+        image.header.write_to(header_bytes)
+        header_bytes = header_bytes.getvalue()
+        header_bytes += b"\0" * (int(image.header["vox_offset"]) - len(header_bytes))
+        return NiftiSlabFile(self, header_bytes, save_path, dtype, scale)
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.files.shutdown()
+            self.blocks.shutdown()
+
+class NiftiSlabFile:
+    """
+    NIfTI volume written slab by slab along z (see NiftiWriter.open_slabs): the voxels are stored x fastest, so consecutive z slabs are consecutive bytes
+    of the file, appended (and compressed) as they come. The file is written to a temporary path and moved in place by close() once all the slabs are written.
+    """
+    def __init__(self, writer, header_bytes, save_path, dtype, scale=None):
+        self.writer = writer
+        self.save_path = save_path
+        self.dtype = np.dtype(dtype)
+        self.scale = scale
+        self.compressed = save_path.endswith(".gz")
+        self.path_temp = get_temp_path(save_path)
+        self.f = open(self.path_temp, "wb")
+        self.writer.write_data(self.f, header_bytes, self.compressed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.path_temp)
+
+    def write(self, slab):
+        """
+        Append the next (X, Y, z1 - z0) slab.
+        """
+        with profile_stage("save"):
+            slab = slab.astype(self.dtype, copy=False) if self.scale is None else quantize(slab, self.dtype, self.scale)
+            self.writer.write_data(self.f, slab.tobytes(order="F"), self.compressed)
+
+    def close(self):
+        self.f.close()
+        os.replace(self.path_temp, self.save_path)
+        profile_io(self.save_path, "written")
@@ -0,0 +1,182 @@
+#Instrumentation of the Data Preparation steps: per-scan and per-stage wall/CPU time, peak RSS and I/O (see RunProfiler and init_profiler),
+#and cProfile of a single selected scan (see profile_single_scan).
+import os
+import time
+import json
+import contextlib
+import functools
+import threading
+import resource
+import numpy as np
+import pandas as pd
+
+PROFILER = None #RunProfiler of the instrumented stages, see init_profiler.
+
+def profiled(stage):
+    """
+    Decorator timing every call of a function as stage of the current scan (see RunProfiler), with a single check when the instrumentation is disabled.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if PROFILER is None:
+                return fn(*args, **kwargs)
+            with PROFILER.stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class RunProfiler:
+    """
+    Per-scan and per-stage instrumentation of a run: wall time, CPU time (of the calling thread), peak RSS of the process, bytes and files read and written.
+
+    Stages (load, mask, save, render, rotate, project, encode) are marked with profile_stage and the files with profile_io; a stage nested in another one
+    is excluded from the outer stage, so that the stage times of a scan add up. Scans are marked with profile_scan (per thread).
+    """
+    def __init__(self):
+        self.records = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def frames(self):
+        if not hasattr(self.local, "frames"):
+            self.local.frames = []
+            self.local.scan = ("", "")
+        return self.local.frames
+
+    @contextlib.contextmanager
+    def scan(self, pat_ID, scan_date):
+        self.frames()
+        previous, self.local.scan = self.local.scan, (pat_ID, scan_date)
+        try:
+            yield
+        finally:
+            self.local.scan = previous
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        frames = self.frames()
+        now, cpu = time.perf_counter(), time.thread_time()
+        if frames:
+            #Pause the outer stage
+            frames[-1]["wall"] += now - frames[-1]["start"]
+            frames[-1]["cpu"] += cpu - frames[-1]["cpu_start"]
+        frame = {"stage": name, "wall": 0., "cpu": 0., "start": now, "cpu_start": cpu, "bytes_read": 0, "bytes_written": 0, "files_read": 0, "files_written": 0}
+        frames.append(frame)
+        try:
+            yield
+        finally:
+            now, cpu = time.perf_counter(), time.thread_time()
+            frames.pop()
+            if frames:
+                frames[-1]["start"], frames[-1]["cpu_start"] = now, cpu
+            pat_ID, scan_date = self.local.scan
+            with self.lock:
+                self.records.append({"pat_ID": pat_ID, "scan_date": scan_date, "stage": name, "wall": frame["wall"] + now - frame["start"], "cpu": frame["cpu"] + cpu - frame["cpu_start"],
+                    "peak_RSS_MB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "bytes_read": frame["bytes_read"], "bytes_written": frame["bytes_written"],
+                    "files_read": frame["files_read"], "files_written": frame["files_written"]})
+
+    def io(self, path, mode):
+        frames = self.frames()
+        if frames and os.path.isfile(path):
+            frames[-1]["bytes_" + mode] += os.path.getsize(path)
+            frames[-1]["files_" + mode] += 1
+
+    def pop_records(self):
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+    def report(self, save_path):
+        """
+        Write the run report: save_path + ".csv" with one row per scan and stage (summed over the calls of the stage), and save_path + ".json" with
+        the wall/CPU time percentiles, I/O totals and peak RSS of every stage and the slowest scans with their stage breakdown.
+        """
+        df = pd.DataFrame(self.records, columns=["pat_ID", "scan_date", "stage", "wall", "cpu", "peak_RSS_MB", "bytes_read", "bytes_written", "files_read", "files_written"])
+        df = df.groupby(["pat_ID", "scan_date", "stage"], sort=False).agg(calls=("wall", "size"), wall=("wall", "sum"), cpu=("cpu", "sum"), peak_RSS_MB=("peak_RSS_MB", "max"),
+            bytes_read=("bytes_read", "sum"), bytes_written=("bytes_written", "sum"), files_read=("files_read", "sum"), files_written=("files_written", "sum")).reset_index()
+        return save_run_report(df, save_path)
+
+def save_run_report(df, save_path):
+    """
+    Write the run report of RunProfiler.report from its per-scan and per-stage rows (e.g. of the run reports of several shards, see merge_shards).
+    """
+    df.to_csv(save_path + ".csv", index=False)
+
+    stages = {}
+    for stage, df_stage in df.groupby("stage", sort=False):
+        stages[stage] = {"scans": len(df_stage), "calls": int(df_stage["calls"].sum()), "wall_total": float(df_stage["wall"].sum()), "cpu_total": float(df_stage["cpu"].sum()),
+            "bytes_read": int(df_stage["bytes_read"].sum()), "bytes_written": int(df_stage["bytes_written"].sum()), "files_read": int(df_stage["files_read"].sum()),
+            "files_written": int(df_stage["files_written"].sum()), "peak_RSS_MB": float(df_stage["peak_RSS_MB"].max())}
+        for q in (50, 90, 99):
+            stages[stage]["wall_p{}".format(q)] = float(np.percentile(df_stage["wall"], q))
+        stages[stage]["wall_max"] = float(df_stage["wall"].max())
+    df_scans = df.pivot_table(index=["pat_ID", "scan_date"], columns="stage", values="wall", aggfunc="sum", fill_value=0.)
+    df_scans["total"] = df_scans.sum(axis=1)
+    slowest = [dict({"pat_ID": pat_ID, "scan_date": scan_date}, **{key: float(value) for key, value in row.items()}) for (pat_ID, scan_date), row in df_scans.sort_values("total", ascending=False).head(10).iterrows()]
+    report = {"scans": len(df_scans), "stages": stages, "slowest_scans": slowest}
+    with open(save_path + ".json", "w") as f:
+        json.dump(report, f, indent=1)
+    return report
+
+def init_profiler(args):
+    """
+    Enable the instrumentation of the stages (see RunProfiler) if args.profile is set. Safe to call again in every worker process.
+    """
+    global PROFILER
+    if getattr(args, "profile", False) and PROFILER is None:
+        PROFILER = RunProfiler()
+    return PROFILER
+
+NO_PROFILING = contextlib.nullcontext()
+
+def profile_stage(name):
+    """
+    Context manager timing a stage of the current scan (does nothing unless the instrumentation is enabled).
+    """
+    return NO_PROFILING if PROFILER is None else PROFILER.stage(name)
+
+def profile_scan(pat_ID, scan_date):
+    """
+    Context manager attributing the stages run by the current thread to a scan.
+    """
+    return NO_PROFILING if PROFILER is None else PROFILER.scan(pat_ID, scan_date)
+
+def get_profiled_scan():
+    """
+    Scan the stages of the current thread are attributed to (see profile_scan), to carry it over to other threads.
+    """
+    if PROFILER is None:
+        return ("", "")
+    PROFILER.frames() #Initializes the scan of the thread
+    return PROFILER.local.scan
+
+def profile_io(path, mode):
+    """
+    Count a file read (mode "read") or written ("written") by the current stage.
+    """
+    if PROFILER is not None:
+        PROFILER.io(path, mode)
+
+@contextlib.contextmanager
+def profile_single_scan(args, pat_ID, scan_date, suffix=""):
+    """
+    Run a scan under cProfile if it is the one selected by args.profile_scan ("pat_ID" or "pat_ID/scan_date"), saving the statistics to
+    args.profile_dir/profile_<pat_ID>_<scan_date><suffix>.prof and printing the top functions.
+    """
+    selected = getattr(args, "profile_scan", None)
+    if not selected or selected not in (pat_ID, pat_ID + "/" + scan_date):
+        yield
+        return
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        path_stats = os.path.join(getattr(args, "profile_dir", None) or ".", "profile_{}_{}{}.prof".format(pat_ID, scan_date, suffix))
+        profiler.dump_stats(path_stats)
+        print("cProfile of {} {} saved to {}".format(pat_ID, scan_date, path_stats))
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
@@ -0,0 +1,241 @@
+#On-demand multi-angle projections at any angle, computed from the resident volumes of the scans (see ProjectionService), served by several
+#localhost processes (see ProjectionServicePool) and batched at random angles for augmentation (see RandomAngleProjections).
+import os
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+from utils import PROJECTION_CHANNELS, get_nii_shape, load_bbox_index, ScanStatistics, load_projection_stack, get_stack_bbox, get_projection_groups, project_groups, get_projection_width, fit_projection
+
+class ProjectionService:
+    """
+    On-demand multi-angle projections of the scans of a df_final.csv manifest, at any angle (e.g. random angles for augmentation) instead of a fixed set precomputed to disk.
+
+    The volumes of the resident_scans most recently used scans are kept in memory as their projection groups (see get_projection_groups: the tissue channels cropped
+    to the body bounding box with --roi_crop and SEG to the bounding box of the lesions), and the projections of the most recently requested (scan, angle) pairs are kept in an LRU cache
+    of cache_MB. Projections are identical to the ones saved by the projection script with the same args (SUV/CT windows, --projection_order, --channel_storage,
+    --volume_dtype), as dtype. Thread-safe; see ProjectionServicePool to serve the scans from several processes.
+
+    df - Manifest DataFrame (pat_ID, scan_date, CT, SUV, SEG).
+    """
+    def __init__(self, df, args, resident_scans=4, cache_MB=1024, dtype=np.float32):
+        self.rows = {(row["pat_ID"], row["scan_date"]): row for _, row in df.iterrows()}
+        self.args = args
+        self.resident_scans = resident_scans
+        self.cache_size = int(cache_MB * 2**20)
+        self.dtype = np.dtype(dtype)
+        self.bboxes = load_bbox_index(args) if args.roi_crop else None
+        self.stats = ScanStatistics(args) if args.scan_statistics else None
+        self.scans = OrderedDict() #(pat_ID, scan_date) -> (groups, volume shape, round_channels)
+        self.projections = OrderedDict() #(pat_ID, scan_date, angle) -> (C, H, W) projections
+        self.cache_bytes = 0
+        self.counts = {"hits": 0, "misses": 0, "scans_loaded": 0}
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, df, args, dtype=np.float32):
+        return cls(df, args, resident_scans=args.resident_scans, cache_MB=args.projection_cache_MB, dtype=dtype)
+
+    def get_scan(self, pat_ID, scan_date):
+        """
+        Projection groups, volume shape and rounded channels of one scan, loaded if it is not resident (the least recently used scan is then evicted).
+        """
+        key = (pat_ID, scan_date)
+        with self.lock:
+            if key in self.scans:
+                self.scans.move_to_end(key)
+                return self.scans[key]
+        #One scan is loaded at a time, so that concurrent requests of the same scan load it once
+        with self.load_lock:
+            with self.lock:
+                if key in self.scans:
+                    return self.scans[key]
+            stack, round_channels = load_projection_stack(self.rows[key], self.args, self.stats)
+            bbox = get_stack_bbox(stack, self.args, self.bboxes.get(key)) if self.bboxes is not None else None
+            scan = (get_projection_groups(stack, bbox, self.args.projection_order), stack.shape[1:], round_channels)
+            del stack
+            with self.lock:
+                self.scans[key] = scan
+                self.counts["scans_loaded"] += 1
+                while len(self.scans) > max(self.resident_scans, 1):
+                    self.scans.popitem(last=False)
+            return scan
+
+    def get(self, pat_ID, scan_date, angle, channels=None):
+        """
+        (C, H, W) projections of one scan at angle (degrees), ordered as PROJECTION_CHANNELS or as channels (names) if given.
+        """
+        key = (pat_ID, scan_date, angle)
+        with self.lock:
+            projections = self.projections.get(key)
+            if projections is not None:
+                self.projections.move_to_end(key)
+                self.counts["hits"] += 1
+        if projections is None:
+            groups, shape, round_channels = self.get_scan(pat_ID, scan_date)
+            args = self.args
+            projections = project_groups(groups, shape, angle, args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, order=args.projection_order, round_channels=round_channels, dtype=self.dtype)
+            with self.lock:
+                self.counts["misses"] += 1
+                if key not in self.projections and projections.nbytes <= self.cache_size:
+                    self.projections[key] = projections
+                    self.cache_bytes += projections.nbytes
+                    while self.cache_bytes > self.cache_size:
+                        self.cache_bytes -= self.projections.popitem(last=False)[1].nbytes
+        if channels is not None:
+            projections = projections[[PROJECTION_CHANNELS.index(channel) for channel in channels]]
+        return projections
+
+    def get_shape(self, pat_ID, scan_date):
+        """
+        (X, Y, Z) shape of the volumes of one scan, from the header of its CT.
+        """
+        return get_nii_shape(self.rows[(pat_ID, scan_date)]["CT"])
+
+    def get_counts(self):
+        """
+        Cache hits and misses, scans loaded, and the resident scans and cached projections.
+        """
+        with self.lock:
+            return dict(self.counts, resident_scans=len(self.scans), cached_projections=len(self.projections), cache_MB=self.cache_bytes / 2**20)
+
+SERVICE = None #ProjectionService of a server process of ProjectionServicePool
+
+def _init_service(df, args, resident_scans, cache_MB, dtype):
+    global SERVICE
+    SERVICE = ProjectionService(df, args, resident_scans=resident_scans, cache_MB=cache_MB, dtype=dtype)
+
+def _get_service():
+    return SERVICE
+
+class ProjectionManager(BaseManager):
+    pass
+
+ProjectionManager.register("get_service", callable=_get_service, exposed=["get", "get_shape", "get_counts"])
+
+class ProjectionServicePool:
+    """
+    ProjectionService running in num_workers server processes on localhost, each with its own resident scans and projection cache: the requests of a scan always go
+    to the same process (by a hash of pat_ID/scan_date), so that every scan is resident in one process only and the processes compute projections in parallel.
+
+    The pool can be pickled (e.g. to the worker processes of a data loader), which then connect to the same servers. close() (or leaving the with block) stops them.
+    """
+    def __init__(self, df, args, num_workers=2, resident_scans=4, cache_MB=1024, dtype=np.float32):
+        self.authkey = os.urandom(16)
+        self.managers = []
+        for _ in range(max(num_workers, 1)):
+            manager = ProjectionManager(address=("127.0.0.1", 0), authkey=self.authkey)
+            manager.start(_init_service, (df, args, resident_scans, cache_MB, dtype))
+            self.managers.append(manager)
+        self.addresses = [manager.address for manager in self.managers]
+        self.services = None
+
+    @classmethod
+    def from_args(cls, df, args, dtype=np.float32):
+        return cls(df, args, num_workers=args.service_workers, resident_scans=args.resident_scans, cache_MB=args.projection_cache_MB, dtype=dtype)
+
+    def __getstate__(self):
+        return {"authkey": self.authkey, "addresses": self.addresses, "managers": [], "services": None}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        """
+        Connect to the servers (once per process).
+        """
+        if self.services is None:
+            services = []
+            for address in self.addresses:
+                manager = ProjectionManager(address=address, authkey=self.authkey)
+                manager.connect()
+                services.append(manager.get_service())
+            self.services = services
+        return self.services
+
+    def get_service(self, pat_ID, scan_date):
+        self.connect()
+        key = "{}/{}".format(pat_ID, scan_date).encode()
+        return self.services[int(hashlib.sha1(key).hexdigest(), 16) % len(self.services)]
+
+    def get(self, pat_ID, scan_date, angle, channels=None):
+        return self.get_service(pat_ID, scan_date).get(pat_ID, scan_date, angle, channels)
+
+    def get_shape(self, pat_ID, scan_date):
+        return self.get_service(pat_ID, scan_date).get_shape(pat_ID, scan_date)
+
+    def get_counts(self):
+        """
+        Counts of every server (see ProjectionService.get_counts).
+        """
+        return [service.get_counts() for service in self.connect()]
+
+    def close(self):
+        self.services = None
+        for manager in self.managers:
+            manager.shutdown()
+        self.managers = []
+
+class RandomAngleProjections:
+    """
+    Batches of projections of the scans of a df_final.csv manifest at random angles, computed on demand by a ProjectionService (or ProjectionServicePool):
+    angles_per_scan angles per scan and epoch, drawn uniformly from angle_min to angle_max in steps of angle_step degrees (a finer step gives more distinct
+    angles, a coarser one more hits of the projection cache).
+
+    Images are center-cropped/padded (see fit_projection) to image_shape, by default the shape of the first scan at its widest angle in the range.
+    Iterating yields dicts like ProjectionDataset, with "projections" (B, angles_per_scan, channels, H, W), "angles" (B, angles_per_scan) and the manifest columns.
+    """
+    def __init__(self, service, df, angle_min=-90, angle_max=90, angle_step=1, angles_per_scan=1, channels=None, batch_size=8, prefetch=2, num_threads=4, shuffle=True, seed=None, image_shape=None):
+        self.service = service
+        self.df = df.reset_index(drop=True)
+        self.angles = [angle_min + k * angle_step for k in range(int(round((angle_max - angle_min) / angle_step)) + 1)]
+        self.angles_per_scan = angles_per_scan
+        self.channels = list(PROJECTION_CHANNELS) if channels is None else list(channels)
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.num_threads = num_threads
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        if image_shape is None:
+            shape = service.get_shape(self.df["pat_ID"].iloc[0], self.df["scan_date"].iloc[0])
+            image_shape = (shape[2], max(get_projection_width(shape[:2], angle) for angle in self.angles))
+        self.image_shape = tuple(image_shape)
+
+    def __len__(self):
+        return len(self.df)
+
+    def read_sample(self, i, angles, out):
+        row = self.df.iloc[i]
+        for a, angle in enumerate(angles):
+            out[a] = fit_projection(self.service.get(row["pat_ID"], row["scan_date"], angle, self.channels), self.image_shape)
+
+    def __iter__(self):
+        order = self.rng.permutation(len(self.df)) if self.shuffle else np.arange(len(self.df))
+        angles = [[self.angles[k] for k in ks] for ks in self.rng.integers(len(self.angles), size=(len(self.df), self.angles_per_scan))]
+        batches = [order[k:k+self.batch_size] for k in range(0, len(order), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            queue = deque()
+            for indices in batches:
+                batch = np.empty((len(indices), self.angles_per_scan, len(self.channels)) + self.image_shape, dtype=np.float32)
+                queue.append((batch, indices, [executor.submit(self.read_sample, i, angles[i], batch[b]) for b, i in enumerate(indices)]))
+                if len(queue) > self.prefetch:
+                    yield self.collect_batch(angles, *queue.popleft())
+            while queue:
+                yield self.collect_batch(angles, *queue.popleft())
+
+    def collect_batch(self, angles, batch, indices, futures):
+        for future in futures:
+            future.result()
+        rows = self.df.iloc[indices]
+        out = {"projections": batch, "angles": np.array([angles[i] for i in indices])}
+        for column in ("pat_ID", "scan_date", "diagnosis", "age", "sex"):
+            if column in rows:
+                out[column] = rows[column].tolist()
+        return out
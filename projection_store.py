@@ -0,0 +1,262 @@
+#Consolidated projection tensors: one contiguous (angle, channel, H, W) array per scan instead of one .npy file per channel and angle,
+#with a dataset-level index of the tensors (see save_projection_tensor and save_projection_index), and the reader of the projections for training (see ProjectionDataset).
+import os
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+from utils import tqdm, get_compute_dtype, quantize_projections, dequantize, PROJECTION_CHANNELS, generate_multi_channel_projections, get_projection_width, fit_projection, load_projection_scales
+from profiling import profiled, profile_io
+from manifest import get_temp_path
+from sharding import get_shard_path
+
+def get_projection_tensor_path(save_path, compression=None):
+    """
+    Path of the consolidated projection tensor of one scan: "projections.npy" (uncompressed, memory-mappable) or "projections.h5" (chunked compression, needs h5py).
+    """
+    return os.path.join(save_path, "projections.npy" if compression is None else "projections.h5")
+
+@profiled("save")
+def save_projection_tensor(save_path, stack, angles, suv_min, suv_max, ct_min, ct_max, order=3, round_channels=("SEG",), compression=None, dtype=np.float32, reuse_angles=(), bbox=None, lesions=None):
+    """
+    Generate the projections of a projection stack at every angle and save them as one contiguous (angle, channel, H, W) tensor per scan,
+    instead of one .npy file per channel and angle (see generate_all_MIPs). The angles and channel names are saved in "projections.json".
+    The projections get wider with the angle, so every angle is padded (see fit_projection) to the widest one and its own width is saved in "widths".
+
+    compression - None for a memory-mappable .npy file, or an h5py compression filter ("gzip", "lzf") for an HDF5 file chunked per (angle, channel) image.
+    reuse_angles - Angles copied from the existing tensor of the scan instead of being generated (stack may be None if all the angles are reused).
+    bbox, lesions - Optional body bounding box and LesionVoxels of the scan (see generate_multi_channel_projections).
+    dtype - Stored dtype of the tensor. For integer dtypes every (angle, channel) image is stored with its own scale (see get_quantization), saved as "scales" (angle, channel, (slope, intercept)).
+    Returns the metadata of the tensor (as saved in projections.json).
+    """
+    path = get_projection_tensor_path(save_path, compression)
+    path_temp = get_temp_path(path)
+    reused = {}
+    if reuse_angles:
+        with open(os.path.join(save_path, "projections.json")) as f:
+            old_metadata = json.load(f)
+        old_tensor = open_projection_tensor(path)
+        reused = {angle: old_metadata["angles"].index(angle) for angle in reuse_angles}
+        old_widths = dict(zip(old_metadata["angles"], old_metadata["widths"]))
+    widths = [old_widths[angle] if angle in reused else get_projection_width(stack.shape[1:3], angle) for angle in angles]
+    generated = generate_multi_channel_projections(stack, [angle for angle in angles if angle not in reused], suv_min, suv_max, ct_min, ct_max, order=order, round_channels=round_channels, bbox=bbox, dtype=get_compute_dtype(dtype), lesions=lesions)
+    projections = ((angle, fit_projection(old_tensor[reused[angle]], (old_metadata["shape"][2], old_widths[angle])) if angle in reused else next(generated)[1]) for angle in angles)
+    h5_file = None
+    scales = np.tile(np.array([1., 0.]), (len(angles), len(PROJECTION_CHANNELS), 1))
+    for k, (angle, MIPs) in enumerate(tqdm(projections, total=len(angles))):
+        if angle in reused:
+            if "scales" in old_metadata:
+                scales[k] = old_metadata["scales"][reused[angle]]
+        else:
+            MIPs, scales[k] = quantize_projections(MIPs, dtype)
+        if k == 0:
+            shape = (len(angles), MIPs.shape[0], MIPs.shape[1], max(widths))
+            if compression is None:
+                tensor = np.lib.format.open_memmap(path_temp, mode="w+", dtype=dtype, shape=shape)
+            else:
+                import h5py
+                h5_file = h5py.File(path_temp, "w")
+                tensor = h5_file.create_dataset("projections", shape=shape, dtype=dtype, chunks=(1, 1) + shape[2:], compression=compression)
+                h5_file.attrs["angles"] = angles
+                h5_file.attrs["channels"] = PROJECTION_CHANNELS
+        tensor[k] = fit_projection(MIPs, shape[2:])
+    if h5_file is None:
+        tensor.flush()
+        del tensor
+    else:
+        h5_file.close()
+    if reused and compression is not None:
+        old_tensor.file.close()
+    os.replace(path_temp, path)
+    profile_io(path, "written")
+
+    metadata = {"path": path, "angles": [int(angle) for angle in angles], "widths": [int(width) for width in widths], "channels": PROJECTION_CHANNELS, "shape": list(shape), "dtype": np.dtype(dtype).name, "compression": compression}
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        metadata["scales"] = scales.tolist()
+    path_temp = get_temp_path(os.path.join(save_path, "projections.json"))
+    with open(path_temp, "w") as f:
+        json.dump(metadata, f)
+    os.replace(path_temp, os.path.join(save_path, "projections.json"))
+    return metadata
+
+def open_projection_tensor(path):
+    """
+    Open a projection tensor saved by save_projection_tensor without reading it: a read-only memory map for .npy, an h5py dataset for .h5.
+    Both support random access, e.g. open_projection_tensor(path)[angle_index, channel_index].
+    """
+    if path.endswith(".h5"):
+        import h5py
+        return h5py.File(path, "r")["projections"]
+    return np.load(path, mmap_mode="r")
+
+def save_projection_index(path_output, records, args=None):
+    """
+    Save the dataset-level index of the projection tensors ("projection_index.csv" in path_output), one row per scan with
+    pat_ID, scan_date, path, angles, widths, channels, shape, dtype and compression (lists are ";"-separated).
+    args - The index of the shard of a sharded run is saved separately (see get_shard_path).
+    """
+    df_index = pd.DataFrame([{
+        "pat_ID": record["pat_ID"], "scan_date": record["scan_date"], "path": record["path"],
+        "angles": ";".join(str(angle) for angle in record["angles"]), "widths": ";".join(str(width) for width in record["widths"]), "channels": ";".join(record["channels"]),
+        "shape": ";".join(str(n) for n in record["shape"]), "dtype": record["dtype"], "compression": record["compression"] or ""} for record in records],
+        columns=None if records else ["pat_ID", "scan_date", "path", "angles", "widths", "channels", "shape", "dtype", "compression"])
+    df_index.to_csv(get_shard_path(os.path.join(path_output, "projection_index.csv"), args), index=False)
+    return df_index
+
+def load_projection_index(path_output):
+    """
+    Load the index written by save_projection_index, with angles, channels and shape parsed back into lists.
+    """
+    df_index = pd.read_csv(os.path.join(path_output, "projection_index.csv"), keep_default_na=False)
+    df_index["angles"] = df_index["angles"].apply(lambda x: [int(angle) for angle in str(x).split(";")])
+    df_index["widths"] = df_index["widths"].apply(lambda x: [int(width) for width in str(x).split(";")])
+    df_index["channels"] = df_index["channels"].str.split(";")
+    df_index["shape"] = df_index["shape"].apply(lambda x: [int(n) for n in str(x).split(";")])
+    return df_index
+
+def load_tensor_scales(path):
+    """
+    (angle, channel, 2) scales of the projection tensor at path (see save_projection_tensor); None for float tensors.
+    """
+    with open(os.path.join(os.path.dirname(path), "projections.json")) as f:
+        scales = json.load(f).get("scales")
+    return None if scales is None else np.array(scales)
+
+def get_projection(df_index, pat_ID, scan_date, angle, channel, dtype=np.float32):
+    """
+    Read one (H, W) projection of a scan from its projection tensor, cropped to its original width, as dtype (integer projections are dequantized).
+    """
+    record = df_index[(df_index["pat_ID"] == pat_ID) & (df_index["scan_date"] == scan_date)].iloc[0]
+    tensor = open_projection_tensor(record["path"])
+    k, c = record["angles"].index(angle), record["channels"].index(channel)
+    MIP = fit_projection(tensor[k, c], (record["shape"][2], record["widths"][k]))
+    scales = load_tensor_scales(record["path"]) if np.issubdtype(np.dtype(record["dtype"]), np.integer) else None
+    return dequantize(MIP, (1., 0.) if scales is None else scales[k, c], dtype)
+
+class ProjectionDataset:
+    """
+    Reader of the multi-angle projections of the scans listed in a df_final.csv manifest (pat_ID, scan_date, diagnosis, age, sex).
+
+    Works on both output formats of the projection script: the projection tensors indexed by projection_index.csv (--projection_format tensor)
+    and the per channel/angle .npy files. All the files are opened as memory maps and every image is copied once, straight into the batch array.
+    Images are center-cropped/padded (see fit_projection) to the shape of the first scan at its widest requested angle, so that all of them can be batched.
+    Integer (quantized) projections are dequantized with their scales unless dtype is an integer dtype too.
+
+    df - Manifest DataFrame.
+    path_output - Root of the multi-angle projections (args.path_multi_angled_multi_channel_2D_projections).
+    angles - Angles to read (default: all the angles of the first scan).
+    channels - Channel names to read (default: PROJECTION_CHANNELS).
+    batch_size - Number of scans per batch.
+    prefetch - Number of batches read ahead in the background.
+    num_threads - Number of threads reading the scans.
+
+    Iterating yields dicts with "projections" (B, angles, channels, H, W) and the manifest columns of the scans in the batch.
+    """
+    def __init__(self, df, path_output, angles=None, channels=None, batch_size=8, prefetch=2, num_threads=4, shuffle=False, seed=None, dtype=np.float32):
+        self.df = df.reset_index(drop=True)
+        self.path_output = path_output
+        self.channels = list(PROJECTION_CHANNELS) if channels is None else list(channels)
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.num_threads = num_threads
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.dtype = dtype
+
+        self.index = None
+        if os.path.isfile(os.path.join(path_output, "projection_index.csv")):
+            self.index = load_projection_index(path_output).set_index(["pat_ID", "scan_date"])
+        self.tensors = {}
+        self.scales = {}
+
+        row = self.df.iloc[0]
+        if self.index is not None:
+            record = self.index.loc[(row["pat_ID"], row["scan_date"])]
+            self.angles = list(record["angles"]) if angles is None else list(angles)
+            self.image_shape = (record["shape"][2], max(record["widths"][record["angles"].index(angle)] for angle in self.angles))
+        else:
+            save_path = os.path.join(path_output, row["pat_ID"], row["scan_date"])
+            if angles is None:
+                angles = sorted(int(f[:-4]) for f in os.listdir(os.path.join(save_path, self.channels[0])) if f.endswith(".npy"))
+            self.angles = list(angles)
+            shapes = [np.load(os.path.join(save_path, self.channels[0], str(angle) + ".npy"), mmap_mode="r").shape for angle in self.angles]
+            self.image_shape = (shapes[0][0], max(shape[1] for shape in shapes))
+
+    def __len__(self):
+        return len(self.df)
+
+    def get_tensor(self, pat_ID, scan_date):
+        """
+        Memory map of the projection tensor of one scan (opened once and kept).
+        """
+        key = (pat_ID, scan_date)
+        if key not in self.tensors:
+            record = self.index.loc[key]
+            self.tensors[key] = open_projection_tensor(record["path"])
+            self.scales[key] = load_tensor_scales(record["path"]) if np.issubdtype(np.dtype(record["dtype"]), np.integer) else None
+        return self.tensors[key]
+
+    def copy_image(self, out, MIP, scale=None):
+        """
+        Copy one stored image into out, dequantized with scale if the projections are quantized and out is not.
+        """
+        out[...] = fit_projection(MIP, self.image_shape)
+        if scale is not None and np.issubdtype(MIP.dtype, np.integer) and not np.issubdtype(out.dtype, np.integer):
+            out *= scale[0]
+            out += scale[1]
+
+    def read_sample(self, i, out=None):
+        """
+        Read the (angles, channels, H, W) projections of scan i into out (allocated if None).
+        """
+        row = self.df.iloc[i]
+        if out is None:
+            out = np.empty((len(self.angles), len(self.channels)) + self.image_shape, dtype=self.dtype)
+        if self.index is not None:
+            record = self.index.loc[(row["pat_ID"], row["scan_date"])]
+            tensor = self.get_tensor(row["pat_ID"], row["scan_date"])
+            scales = self.scales[(row["pat_ID"], row["scan_date"])]
+            angle_indices = [record["angles"].index(angle) for angle in self.angles]
+            channel_indices = [record["channels"].index(channel) for channel in self.channels]
+            for a, angle_index in enumerate(angle_indices):
+                for c, channel_index in enumerate(channel_indices):
+                    self.copy_image(out[a, c], tensor[angle_index, channel_index], None if scales is None else scales[angle_index, channel_index])
+        else:
+            save_path = os.path.join(self.path_output, row["pat_ID"], row["scan_date"])
+            scales = None
+            for a, angle in enumerate(self.angles):
+                for c, channel in enumerate(self.channels):
+                    MIP = np.load(os.path.join(save_path, channel, str(angle) + ".npy"), mmap_mode="r")
+                    if scales is None and np.issubdtype(MIP.dtype, np.integer):
+                        scales = load_projection_scales(save_path)
+                    self.copy_image(out[a, c], MIP, None if scales is None else scales[channel][angle])
+        return out
+
+    def read_batch(self, executor, indices):
+        batch = np.empty((len(indices), len(self.angles), len(self.channels)) + self.image_shape, dtype=self.dtype)
+        futures = [executor.submit(self.read_sample, i, batch[b]) for b, i in enumerate(indices)]
+        return batch, indices, futures
+
+    def __iter__(self):
+        order = self.rng.permutation(len(self.df)) if self.shuffle else np.arange(len(self.df))
+        batches = [order[k:k+self.batch_size] for k in range(0, len(order), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            queue = deque()
+            for indices in batches:
+                queue.append(self.read_batch(executor, indices))
+                if len(queue) > self.prefetch:
+                    yield self.collect_batch(*queue.popleft())
+            while queue:
+                yield self.collect_batch(*queue.popleft())
+
+    def collect_batch(self, batch, indices, futures):
+        for future in futures:
+            future.result()
+        rows = self.df.iloc[indices]
+        out = {"projections": batch}
+        for column in ("pat_ID", "scan_date", "diagnosis", "age", "sex"):
+            if column in rows:
+                out[column] = rows[column].tolist()
+        return out
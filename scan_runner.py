@@ -0,0 +1,200 @@
+#Drivers applying per-scan functions to every row (scan) of a DataFrame: serially or on a pool of worker processes (see run_scans),
+#or as a chain of stages on threads connected by bounded queues (see run_pipeline).
+import time
+import traceback
+import threading
+import queue
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from utils import cv2, tqdm
+from profiling import init_profiler, profile_scan, profile_single_scan
+
+def _init_worker():
+    """
+    Keep every worker process on a single OpenCV thread so that N workers do not oversubscribe the cores.
+    """
+    cv2.setNumThreads(1)
+
+def _run_scan(process_fn, index, row, args):
+    """
+    Run process_fn on one scan and catch any failure, so that one corrupt volume does not stop the whole run.
+    """
+    start = time.time()
+    profiler = init_profiler(args)
+    output = None
+    try:
+        with profile_scan(row["pat_ID"], row["scan_date"]), profile_single_scan(args, row["pat_ID"], row["scan_date"]):
+            output = process_fn(row, args)
+        status, error = "done", ""
+    except Exception:
+        status, error = "failed", traceback.format_exc()
+    #Stage records of the scan, sent back to the main process
+    records = [] if profiler is None else profiler.pop_records()
+    return index, status, error, time.time() - start, records, output or {}
+
+def run_scans(process_fn, df, args, num_workers=1, max_in_flight=None):
+    """
+    Apply process_fn(row, args) to every row (scan) of df, either serially or on a pool of worker processes.
+
+    process_fn - Top-level (picklable) function processing a single scan.
+    num_workers - Number of worker processes (<= 1 runs in the main process).
+    max_in_flight - Maximum number of scans submitted to the pool at once, so that the scans are streamed to the workers (defaults to 2 x num_workers).
+
+    A scan whose worker process dies fails, along with the other scans in flight on the pool, and the remaining scans run on a new pool.
+    Progress is reported in the order of df and a summary is printed at the end. Returns a DataFrame with the status, error and run time of every scan,
+    plus the values of the dict returned by process_fn (if any) as extra columns.
+    """
+    rows = [(index, row.to_dict()) for index, row in df.iterrows()]
+    results = {}
+    next_report = 0
+    start = time.time()
+    pbar = tqdm(total=len(rows))
+
+    def report(result):
+        #Print the finished scans in the order of df, as soon as all the earlier ones are done
+        nonlocal next_report
+        results[result[0]] = result
+        if result[4]:
+            init_profiler(args).records.extend(result[4])
+        while next_report < len(rows) and rows[next_report][0] in results:
+            index, row = rows[next_report]
+            _, status, error, seconds, _, _ = results[index]
+            pbar.write("[{}/{}] {} {} {} ({:.1f}s)".format(next_report + 1, len(rows), row["pat_ID"], row["scan_date"], status, seconds))
+            next_report += 1
+        pbar.update(1)
+
+    if num_workers <= 1:
+        for index, row in rows:
+            report(_run_scan(process_fn, index, row, args))
+    else:
+        if max_in_flight is None:
+            max_in_flight = 2 * num_workers
+        pending = {}
+        executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker)
+
+        def collect(futures):
+            #Report the finished scans, returns whether the pool is broken
+            broken = False
+            for future in futures:
+                index, submitted = pending.pop(future)
+                try:
+                    report(future.result())
+                except BrokenProcessPool as error:
+                    #The exception is shared by all the scans of the pool, only its message is kept (its traceback grows every time it is raised)
+                    report((index, "failed", "".join(traceback.format_exception_only(type(error), error)), time.time() - submitted, [], {}))
+                    broken = True
+            return broken
+
+        def restart():
+            #A worker process that died (e.g. killed by the OOM killer or crashed in native code) breaks the pool and every scan in flight with it:
+            #they are reported as failed and a new pool processes the remaining scans
+            nonlocal executor
+            collect(wait(list(pending))[0])
+            executor.shutdown()
+            executor = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker)
+
+        try:
+            for index, row in rows:
+                if len(pending) >= max_in_flight and collect(wait(list(pending), return_when=FIRST_COMPLETED)[0]):
+                    restart()
+                try:
+                    future = executor.submit(_run_scan, process_fn, index, row, args)
+                except BrokenProcessPool:
+                    restart()
+                    future = executor.submit(_run_scan, process_fn, index, row, args)
+                pending[future] = (index, time.time())
+            collect(wait(list(pending))[0])
+        finally:
+            executor.shutdown()
+    pbar.close()
+
+    df_status = pd.DataFrame([dict({"pat_ID": row["pat_ID"], "scan_date": row["scan_date"], "status": results[index][1], "error": results[index][2], "seconds": results[index][3]}, **results[index][5]) for index, row in rows],
+        columns=None if rows else ["pat_ID", "scan_date", "status", "error", "seconds"])
+    failed = df_status[df_status["status"] == "failed"]
+    print("Processed {} scans in {:.1f}s: {} done, {} failed.".format(len(df_status), time.time() - start, len(df_status) - len(failed), len(failed)))
+    for _, row in failed.iterrows():
+        print("FAILED {} {}\n{}".format(row["pat_ID"], row["scan_date"], row["error"]))
+    return df_status
+
+def run_pipeline(stages, df, args, queue_size=2):
+    """
+    Stream every row (scan) of df through a chain of stages running on threads in the current process, connected by bounded queues of queue_size scans,
+    so that reading, computing and writing of consecutive scans overlap while at most a few scans are held in memory.
+
+    stages - List of (name, fn, num_threads): fn(item, args) takes the item of one scan (a dict with its "row") and returns it for the next stage,
+    or None if the scan needs no further processing (e.g. all its outputs are up to date).
+
+    A failing stage marks the scan as failed and it skips the remaining stages. Progress is reported as the scans finish and a summary is printed at the end.
+    Returns a DataFrame with the status, error, run time and per-stage time of every scan, plus the values of the dict item["outputs"] set by the stages (if any) as extra columns.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    items = [{"index": index, "row": row.to_dict(), "status": "done", "error": ""} for index, row in df.iterrows()]
+    num_items = len(items)
+    order = {item["index"]: k for k, item in enumerate(items)}
+    start = time.time()
+
+    def worker(k, fn):
+        while True:
+            item = queues[k].get()
+            if item is None:
+                return
+            if item["status"] == "done":
+                stage_start = time.time()
+                try:
+                    pat_ID, scan_date = item["row"]["pat_ID"], item["row"]["scan_date"]
+                    with profile_scan(pat_ID, scan_date), profile_single_scan(args, pat_ID, scan_date, suffix="_" + stages[k][0]):
+                        result = fn(item, args)
+                except Exception:
+                    result = dict(item, status="failed", error=traceback.format_exc())
+                item = item if result is None else result
+                item["seconds_" + stages[k][0]] = time.time() - stage_start
+                if result is None:
+                    item["status"] = "skipped"
+            queues[k+1].put(item)
+
+    def close(k, threads):
+        #Signal the end of the scans to the next stage once every thread of stage k is finished
+        for thread in threads:
+            thread.join()
+        for _ in range(stages[k+1][2] if k + 1 < len(stages) else 1):
+            queues[k+1].put(None)
+
+    for k, (name, fn, num_threads) in enumerate(stages):
+        threads = [threading.Thread(target=worker, args=(k, fn), daemon=True) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        threading.Thread(target=close, args=(k, threads), daemon=True).start()
+
+    def feed():
+        while items:
+            item = items.pop(0)
+            item["start"] = time.time()
+            queues[0].put(item)
+        for _ in range(stages[0][2]):
+            queues[0].put(None)
+    threading.Thread(target=feed, daemon=True).start()
+
+    results = []
+    with tqdm(total=num_items) as pbar:
+        while True:
+            item = queues[-1].get()
+            if item is None:
+                break
+            #Keep only the status of the scan, its volumes can be freed
+            item = {key: value for key, value in item.items() if key in ("index", "row", "status", "error", "start", "outputs") or key.startswith("seconds_")}
+            item["seconds"] = time.time() - item["start"]
+            results.append(item)
+            pbar.write("[{}/{}] {} {} {} ({:.1f}s)".format(len(results), num_items, item["row"]["pat_ID"], item["row"]["scan_date"], item["status"], item["seconds"]))
+            pbar.update(1)
+
+    results.sort(key=lambda item: order[item["index"]])
+    df_status = pd.DataFrame([dict({"pat_ID": item["row"]["pat_ID"], "scan_date": item["row"]["scan_date"], "status": item["status"], "error": item["error"], "seconds": item["seconds"]},
+        **{"seconds_" + name: item.get("seconds_" + name, 0.) for name, _, _ in stages}, **item.get("outputs", {})) for item in results],
+        columns=None if results else ["pat_ID", "scan_date", "status", "error", "seconds"] + ["seconds_" + name for name, _, _ in stages])
+    failed = df_status[df_status["status"] == "failed"]
+    print("Processed {} scans in {:.1f}s: {} done, {} skipped, {} failed.".format(len(df_status), time.time() - start, (df_status["status"] == "done").sum(), (df_status["status"] == "skipped").sum(), len(failed)))
+    for _, row in failed.iterrows():
+        print("FAILED {} {}\n{}".format(row["pat_ID"], row["scan_date"], row["error"]))
+    return df_status
@@ -0,0 +1,182 @@
+#Sharded runs over several machines: balanced assignment of the scans to the shards (see select_shard), per-shard output paths and records,
+#and the merge of the outputs of all the shards (see merge_shards).
+import os
+import json
+import heapq
+import hashlib
+import numpy as np
+import pandas as pd
+from collections import Counter
+
+from utils import get_nii_shape
+from profiling import save_run_report
+from manifest import get_temp_path
+
+SHARD_LESION_COST = 0.05 #Cost of every lesion of a scan (column "n_lesions" of df, e.g. merged from lesion_features.csv) relative to the cost of its voxels
+
+def get_scan_costs(df):
+    """
+    Estimated processing cost of every scan of df: the number of voxels of its CT volume (from the header), weighted up by its number of lesions if df has
+    a "n_lesions" column. Depends only on df and the headers of the inputs, so that all the shards of a run compute the same costs.
+    """
+    costs = np.array([float(np.prod(get_nii_shape(path))) for path in df["CT"]])
+    if "n_lesions" in df:
+        costs *= 1 + SHARD_LESION_COST * df["n_lesions"].fillna(0).to_numpy(dtype=float)
+    return costs
+
+def get_shard_assignment(df, num_shards):
+    """
+    Shard (0 to num_shards - 1) of every scan of df, balanced by estimated cost (see get_scan_costs): from the most to the least costly scan (ties broken by
+    pat_ID/scan_date, so the assignment does not depend on the order of df), every scan goes to the shard with the lowest total cost so far.
+    """
+    costs = get_scan_costs(df)
+    keys = list(zip(df["pat_ID"].astype(str), df["scan_date"].astype(str)))
+    loads = [(0., shard) for shard in range(num_shards)]
+    shards = np.zeros(len(df), dtype=int)
+    for k in sorted(range(len(df)), key=lambda k: (-costs[k], keys[k])):
+        load, shards[k] = heapq.heappop(loads)
+        heapq.heappush(loads, (load + costs[k], shards[k]))
+    return shards
+
+def get_dataset_key(df):
+    """
+    Hash of the scans (pat_ID, scan_date) of df, recorded by every shard so that merge_shards can check that all of them were run on the same dataset.
+    """
+    return hashlib.sha1("\n".join(sorted("{}/{}".format(pat_ID, scan_date) for pat_ID, scan_date in zip(df["pat_ID"], df["scan_date"]))).encode()).hexdigest()
+
+def select_shard(df, args):
+    """
+    Scans of df processed by shard --shard_index of --num_shards (see get_shard_assignment), all of them if the run is not sharded.
+    """
+    num_shards = getattr(args, "num_shards", 1)
+    if num_shards <= 1:
+        return df
+    if not 0 <= args.shard_index < num_shards:
+        raise ValueError("--shard_index must be between 0 and {} (--num_shards {}), got {}".format(num_shards - 1, num_shards, args.shard_index))
+    return df[get_shard_assignment(df, num_shards) == args.shard_index]
+
+def get_shard_path(path, args, shard_index=None):
+    """
+    Path of the output index path (e.g. "scan_status.csv" -> "scan_status.shard-0-of-4.csv") written by shard args.shard_index (or shard_index)
+    of a sharded run, path itself if the run is not sharded.
+    """
+    num_shards = getattr(args, "num_shards", 1) if args is not None else 1
+    if num_shards <= 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return "{}.shard-{}-of-{}{}".format(root, args.shard_index if shard_index is None else shard_index, num_shards, extension)
+
+def get_shard_record_path(path_output, step, args, shard_index=None):
+    """
+    Path of the record of a shard of a sharded run of step ("<step>.shard-k-of-N.json" in its output folder, see save_shard_record).
+    """
+    return get_shard_path(os.path.join(path_output, step + ".json"), args, shard_index)
+
+def save_shard_record(path_output, step, args, df, df_shard):
+    """
+    Record that the shard args.shard_index of a sharded run of step (e.g. "channels") over the scans of df is complete, with the scans of the shard (df_shard).
+    Written at the end of the run, so that merge_shards can tell the shards that did not finish. No-op if the run is not sharded.
+    """
+    if getattr(args, "num_shards", 1) <= 1:
+        return
+    record = {"step": step, "num_shards": args.num_shards, "shard_index": args.shard_index, "dataset": get_dataset_key(df),
+        "scans": [[pat_ID, scan_date] for pat_ID, scan_date in zip(df_shard["pat_ID"], df_shard["scan_date"])]}
+    path = get_shard_record_path(path_output, step, args)
+    path_temp = get_temp_path(path)
+    with open(path_temp, "w") as f:
+        json.dump(record, f, indent=1)
+    os.replace(path_temp, path)
+
+def merge_shards(df, path_output, step, args, indexes=(), updates=(), report=None):
+    """
+    Merge the outputs of the args.num_shards shards of a sharded run of step over the scans of df. Raises a ValueError on missing (or unfinished) shards,
+    shards run on another dataset, scans assigned to or indexed by several shards (duplicates) and scans of df missing from all of them (gaps).
+
+    indexes - Output indexes with one row per scan of the shard (e.g. scan_status.csv), concatenated into the index of the dataset (in the order of df).
+    updates - Indexes the shards add or update rows of (body_bbox.csv, scan_statistics.csv, scan_histograms.npz), merged into the existing index.
+    report - Run report (path without extension, see save_run_report) of the shards that were profiled, combined into one.
+    Returns {scan: shard}.
+    """
+    num_shards = args.num_shards
+    keys = list(zip(df["pat_ID"], df["scan_date"]))
+    if len(set(keys)) < len(keys):
+        raise ValueError("Duplicate scans in the dataset: {}".format(sorted(key for key, n in Counter(keys).items() if n > 1)))
+    missing = [k for k in range(num_shards) if not os.path.isfile(get_shard_record_path(path_output, step, args, k))]
+    if missing:
+        raise ValueError("Shards {} of the {} shards of {} are missing (not run or not finished)".format(missing, num_shards, step))
+
+    shards = {}
+    for k in range(num_shards):
+        with open(get_shard_record_path(path_output, step, args, k)) as f:
+            record = json.load(f)
+        if record["dataset"] != get_dataset_key(df):
+            raise ValueError("Shard {} of {} was run on another dataset than {}".format(k, step, args.path_df))
+        for pat_ID, scan_date in record["scans"]:
+            if (pat_ID, scan_date) in shards:
+                raise ValueError("Scan {} {} was processed by shards {} and {}".format(pat_ID, scan_date, shards[(pat_ID, scan_date)], k))
+            shards[(pat_ID, scan_date)] = k
+    gaps = [key for key in keys if key not in shards]
+    if gaps:
+        raise ValueError("{} scans were not processed by any shard: {}".format(len(gaps), gaps))
+
+    def check_rows(rows, k, path):
+        #Scans indexed by shard k must be scans of shard k
+        wrong = [key for key in rows if shards.get(key) != k]
+        if wrong:
+            raise ValueError("{} of shard {} indexes scans of other shards: {}".format(path, k, wrong))
+        if len(set(rows)) < len(rows):
+            raise ValueError("{} of shard {} indexes scans more than once: {}".format(path, k, sorted(key for key, n in Counter(rows).items() if n > 1)))
+
+    def replace(path, save, mode="wb"):
+        path_temp = get_temp_path(path)
+        with open(path_temp, mode, newline=None if "b" in mode else "") as f:
+            save(f)
+        os.replace(path_temp, path)
+
+    order = {key: position for position, key in enumerate(keys)}
+    for path in indexes:
+        frames = []
+        for k in sorted(set(shards.values())):
+            path_shard = get_shard_path(path, args, k)
+            if not os.path.isfile(path_shard):
+                raise ValueError("{} of shard {} is missing".format(path, k))
+            frames.append(pd.read_csv(path_shard, keep_default_na=False))
+            rows = list(zip(frames[-1]["pat_ID"], frames[-1]["scan_date"]))
+            check_rows(rows, k, path)
+            gaps = sorted({key for key, shard in shards.items() if shard == k} - set(rows))
+            if gaps:
+                raise ValueError("{} of shard {} is missing {} scans: {}".format(path, k, len(gaps), gaps))
+        df_index = pd.concat(frames, ignore_index=True)
+        df_index = df_index.iloc[np.argsort([order[key] for key in zip(df_index["pat_ID"], df_index["scan_date"])], kind="stable")]
+        replace(path, lambda f: df_index.to_csv(f, index=False), mode="w")
+
+    for path in updates:
+        paths = [(k, get_shard_path(path, args, k)) for k in range(num_shards)]
+        paths = [(k, path_shard) for k, path_shard in paths if os.path.isfile(path_shard)]
+        if path.endswith(".npz"):
+            #Arrays keyed by "<pat_ID>/<scan_date>/<name>", plus shared arrays (e.g. histogram edges)
+            arrays = {}
+            if os.path.isfile(path):
+                with np.load(path) as f:
+                    arrays = {key: f[key] for key in f.files}
+            for k, path_shard in paths:
+                with np.load(path_shard) as f:
+                    shard_arrays = {key: f[key] for key in f.files}
+                check_rows(list({tuple(key.split("/")[:2]) for key in shard_arrays if key.count("/") == 2}), k, path)
+                arrays.update(shard_arrays)
+            if paths:
+                replace(path, lambda f: np.savez(f, **arrays))
+            continue
+        frames = [pd.read_csv(path)] if os.path.isfile(path) else []
+        for k, path_shard in paths:
+            frames.append(pd.read_csv(path_shard))
+            check_rows(list(zip(frames[-1]["pat_ID"], frames[-1]["scan_date"])), k, path)
+        if paths:
+            df_update = pd.concat(frames).drop_duplicates(["pat_ID", "scan_date"], keep="last")
+            replace(path, lambda f: df_update.to_csv(f, index=False), mode="w")
+
+    if report is not None:
+        frames = [pd.read_csv(get_shard_path(report, args, k) + ".csv") for k in range(num_shards) if os.path.isfile(get_shard_path(report, args, k) + ".csv")]
+        if frames:
+            save_run_report(pd.concat(frames, ignore_index=True), report)
+    return shards
@@ -0,0 +1,50 @@
+import os
+import sys
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import load_config
+
+
+def make_scan(shape=(48, 40, 24), seed=0):
+    """
+    Synthetic CT (HU), SUV and SEG volumes: a body ellipse with values in all the HU windows (and some voxels of exactly 0 HU) surrounded by air,
+    and two separate lesions (SEG labels 1). Returned in the memory layout of read_nii (F order).
+    """
+    rng = np.random.default_rng(seed)
+    X, Y, Z = shape
+    x, y = np.meshgrid(np.linspace(-1, 1, X), np.linspace(-1, 1, Y), indexing="ij")
+    body = np.broadcast_to(((x / 0.8) ** 2 + (y / 0.7) ** 2 < 1)[:, :, None], shape)
+    CT = np.where(body, rng.uniform(-1024, 1500, shape), -1000.).astype(np.float32)
+    CT[body & (rng.random(shape) < 0.02)] = 0
+    SUV = np.where(body, rng.gamma(1.5, 1.0, shape), 0.).astype(np.float32)
+    SEG = np.zeros(shape, dtype=np.uint8)
+    SEG[X // 4:X // 4 + 5, Y // 3:Y // 3 + 4, Z // 4:Z // 4 + 6] = 1
+    SEG[X // 2 + 4:X // 2 + 7, Y // 2:Y // 2 + 5, Z // 2:Z // 2 + 3] = 1
+    SUV[SEG > 0] += 8
+    return np.asfortranarray(CT), np.asfortranarray(SUV), np.asfortranarray(SEG)
+
+
+def write_nii(path, arr):
+    nib.save(nib.Nifti1Image(arr, np.eye(4)), str(path))
+    return str(path)
+
+
+@pytest.fixture
+def args(tmp_path):
+    return load_config(path_df=str(tmp_path / "df_final.csv"), path_multi_channel_3D_CT_SUV=str(tmp_path / "channels"),
+        path_multi_angled_multi_channel_2D_projections=str(tmp_path / "projections"))
+
+
+@pytest.fixture
+def scan():
+    return make_scan()
+
+
+@pytest.fixture
+def scan_files(tmp_path, scan):
+    CT, SUV, SEG = scan
+    return {"CT": write_nii(tmp_path / "CTres.nii.gz", CT), "SUV": write_nii(tmp_path / "SUV.nii.gz", SUV), "SEG": write_nii(tmp_path / "SEG.nii.gz", SEG)}
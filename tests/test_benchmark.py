@@ -0,0 +1,49 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from config import load_config
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data Preparation"))
+import benchmark_data_preparation as benchmark
+
+
+def test_synthetic_scan_covers_the_HU_windows():
+    args = load_config()
+    CT, SUV, SEG = benchmark.generate_synthetic_scan((64, 64, 40), seed=1)
+    assert CT.shape == SUV.shape == SEG.shape == (64, 64, 40)
+    assert CT.dtype == SUV.dtype == np.float32 and SEG.dtype == np.uint8
+    #Voxels of every tissue channel (see config.py)
+    assert (CT > args.bone_HU[0]).any() and (CT < args.air_HU[0]).any()
+    for low, high in (args.lean_HU, args.adipose_HU):
+        assert ((CT > low) & (CT < high)).any()
+    assert set(np.unique(SEG)) == {0, 1} and SUV.min() >= 0
+    assert SUV[SEG > 0].mean() > 2 * SUV[(SEG == 0) & (CT > -500)].mean()
+    #Same scan for the same seed, so that benchmark runs are comparable
+    for a, b in zip(benchmark.generate_synthetic_scan((64, 64, 40), seed=1), (CT, SUV, SEG)):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_benchmark_results_and_comparison(tmp_path, capsys):
+    args = load_config(benchmark_sizes=["32x32x20"], benchmark_scans=2, benchmark_repeats=2, benchmark_stages=["read_nii", "generate_tissue_channels"],
+        benchmark_dir=str(tmp_path / "scans"), benchmark_output=str(tmp_path / "results.json"))
+    benchmark.main(args)
+    with open(args.benchmark_output) as f:
+        results = json.load(f)
+    assert [result["stage"] for result in results["results"]] == ["read_nii", "generate_tissue_channels"]
+    for result in results["results"]:
+        assert result["size"] == "32x32x20" and result["voxels"] == 32 * 32 * 20 and len(result["seconds_all"]) == 2
+        assert result["seconds"] == min(result["seconds_all"]) and result["peak_MB"] > 0
+    assert sorted(os.listdir(tmp_path / "scans" / "32x32x20")) == ["PETCT_synthetic_0000", "PETCT_synthetic_0001"]
+
+    capsys.readouterr()
+    for result in results["results"]:
+        result["seconds"] /= 2
+    benchmark.compare_benchmarks(results, {"results": [dict(result, seconds=2 * result["seconds"]) for result in results["results"]]})
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ["stage", "size", "angles", "workers", "baseline_s", "seconds", "speedup"]
+    assert [line.split()[0] for line in lines[1:]] == ["read_nii", "generate_tissue_channels"]
+    assert all(line.endswith("2.00x") for line in lines[1:])
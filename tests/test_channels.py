@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+import utils
+from nifti_writer import NiftiWriter
+
+CHANNEL_NAMES = ["SUV_" + tissue for tissue in utils.TISSUE_TYPES] + ["CT_" + tissue for tissue in utils.TISSUE_TYPES]
+
+
+def get_baseline_channels(CT, SUV, args):
+    masks = utils.generate_binary_masks(CT, args)
+    return list(utils.generate_HU_channels(SUV, *masks)) + list(utils.generate_HU_channels(CT, *masks))
+
+
+@pytest.mark.parametrize("roi", [False, True])
+def test_fused_channels_equal_baseline_masks(scan, args, roi):
+    CT, SUV, _ = scan
+    bbox = utils.get_body_bbox(CT, args) if roi else None
+    channels = utils.generate_tissue_channels(CT, SUV, args, bbox=bbox)
+    for name, channel, expected in zip(CHANNEL_NAMES, channels, get_baseline_channels(CT, SUV, args)):
+        np.testing.assert_array_equal(channel, expected, err_msg=name)
+        assert channel.dtype == expected.dtype, name
+
+
+def test_boundary_HU_values(args):
+    #HU values on the bounds of the windows (and 0 HU, which the baseline masks by value) land in the same channels as in the baseline masks
+    bounds = sorted({value for window in (args.bone_HU, args.lean_HU, args.adipose_HU, args.air_HU) for value in window} | {0})
+    CT = np.asfortranarray(np.array(bounds + [bound + 0.5 for bound in bounds] + [bound - 0.5 for bound in bounds], dtype=np.float32).reshape(-1, 1, 1))
+    SUV = np.asfortranarray(np.linspace(0.5, 5, CT.size, dtype=np.float32).reshape(CT.shape))
+    for name, channel, expected in zip(CHANNEL_NAMES, utils.generate_tissue_channels(CT, SUV, args), get_baseline_channels(CT, SUV, args)):
+        np.testing.assert_array_equal(channel, expected, err_msg=name)
+
+
+def test_label_map_round_trip(tmp_path, scan, scan_files, args):
+    CT, SUV, _ = scan
+    channels, label_map = utils.generate_tissue_channels(CT, SUV, args, return_label_map=True)
+    np.testing.assert_array_equal(label_map, utils.generate_tissue_label_map(CT, args))
+    path_label_map = str(tmp_path / "tissue_labels.nii.gz")
+    utils.save_npy_nii(scan_files["CT"], label_map, path_label_map)
+    stored = utils.TissueChannels(path_label_map, scan_files["CT"], scan_files["SUV"])
+    for name, channel in zip(CHANNEL_NAMES, channels):
+        np.testing.assert_array_equal(stored[name], channel, err_msg=name)
+
+
+def test_body_bbox(scan, args):
+    CT, _, SEG = scan
+    bbox = utils.get_body_bbox(CT, args, SEG)
+    inside = np.zeros(CT.shape, dtype=bool)
+    inside[tuple(slice(*bounds) for bounds in bbox)] = True
+    #Only air outside the box, and the margin keeps air all around the body
+    assert (CT[~inside] < args.air_HU[0]).all() and not SEG[~inside].any()
+    for axis, (start, end) in enumerate(bbox):
+        body = np.flatnonzero(np.any(CT >= args.air_HU[0], axis=tuple(a for a in range(3) if a != axis)))
+        assert start == max(body[0] - args.roi_margin, 0) and end == min(body[-1] + 1 + args.roi_margin, CT.shape[axis])
+    assert utils.get_body_bbox(np.full(CT.shape, -1000.), args) == tuple((0, n) for n in CT.shape)
+
+
+@pytest.mark.parametrize("outside", [0., -1000.])
+def test_reduce_roi_equals_full_reduction(outside):
+    rng = np.random.default_rng(0)
+    shape, bbox = (12, 10, 8), ((2, 9), (1, 10), (0, 8))
+    arr = np.full(shape, outside)
+    roi = tuple(slice(*bounds) for bounds in bbox)
+    arr[roi] = rng.uniform(-1200, 500, arr[roi].shape)
+    for axis in (0, 1):
+        np.testing.assert_array_equal(utils.reduce_roi(arr[roi], shape, bbox, axis, np.max, outside), np.max(arr, axis=axis))
+        np.testing.assert_allclose(utils.reduce_roi(arr[roi], shape, bbox, axis, np.sum, outside), np.sum(arr, axis=axis), rtol=1e-12)
+
+
+def test_slabs_are_read_in_order(scan, scan_files):
+    CT = scan[0]
+    slabs = list(utils.read_nii_slabs(scan_files["CT"], 5))
+    assert [(z0, z1) for z0, z1, _ in slabs] == [(z, min(z + 5, CT.shape[2])) for z in range(0, CT.shape[2], 5)]
+    assert all(slab.flags.f_contiguous for _, _, slab in slabs)
+    np.testing.assert_array_equal(np.concatenate([slab for _, _, slab in slabs], axis=2), utils.read_nii(scan_files["CT"]))
+
+
+def test_slabs_equal_in_memory(tmp_path, scan, scan_files, args):
+    CT, SUV, SEG = scan
+    save_path = str(tmp_path / "slabs")
+    os.makedirs(save_path)
+    with NiftiWriter() as writer:
+        projections, bbox = utils.generate_tissue_channels_slabs(args, scan_files["CT"], scan_files["SUV"], scan_files["SEG"], 5, writer, save_path=save_path, roi=True)
+
+    channels = utils.generate_tissue_channels(CT, SUV, args)
+    for name, channel in zip(CHANNEL_NAMES, channels):
+        np.testing.assert_array_equal(utils.read_nii(os.path.join(save_path, name + ".nii.gz")), channel, err_msg=name)
+    lesions = utils.LesionVoxels.from_volume(SEG)
+    assert bbox == utils.get_body_bbox(CT, args, lesions=lesions)
+    expected = utils.render_collage_projections(args, None, SUV, *channels[:4], CT, *channels[4:], lesions=lesions)
+    assert projections.keys() == expected.keys()
+    for i in expected:
+        for name, MIP in expected[i].items():
+            np.testing.assert_allclose(projections[i][name], MIP, rtol=1e-5, atol=1e-5, err_msg="{} {}".format(i, name))
+
+
+def test_label_map_slabs_equal_in_memory(tmp_path, scan, scan_files, args):
+    CT, SUV, _ = scan
+    path_label_map = str(tmp_path / "tissue_labels.nii.gz")
+    with NiftiWriter() as writer:
+        projections, bbox = utils.generate_tissue_channels_slabs(args, scan_files["CT"], scan_files["SUV"], None, 7, writer, path_label_map=path_label_map, collage=False)
+    assert projections is None and bbox is None
+    np.testing.assert_array_equal(utils.read_nii(path_label_map), utils.generate_tissue_label_map(CT, args))
+    #No temporary file is left next to the inputs
+    assert sorted(os.listdir(tmp_path)) == ["CTres.nii.gz", "SEG.nii.gz", "SUV.nii.gz", "tissue_labels.nii.gz"]
@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import cli
+from config import parse_args, load_config, save_config
+
+sys.path.insert(0, cli.PATH_SCRIPTS)
+import scan_statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_loaded_modules(statement, modules):
+    """
+    Modules among modules loaded by statement in a fresh interpreter.
+    """
+    code = "import sys; {}; print(','.join(m for m in {!r} if m in sys.modules))".format(statement, list(modules))
+    return subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+
+
+def test_imports_are_lazy():
+    assert get_loaded_modules("import utils", ["SimpleITK", "nibabel", "cv2", "PIL.Image", "scipy.ndimage", "matplotlib", "tqdm"]) == ""
+    assert get_loaded_modules("import cli", ["numpy", "pandas", "utils"]) == ""
+    #A module is imported on its first use
+    assert get_loaded_modules("import utils; utils.scipy.ndimage", ["scipy.ndimage", "cv2"]) == "scipy.ndimage"
+
+
+def test_load_config(tmp_path):
+    assert vars(load_config()) == vars(parse_args([]))
+    path = str(tmp_path / "run.json")
+    with open(path, "w") as f:
+        json.dump({"num_workers": 8, "SUV_max": 5}, f)
+    args = load_config(path, num_workers=2)
+    assert (args.num_workers, args.SUV_max, args.config) == (2, 5, path)
+    #Saved options load back as the same options
+    save_config(args, str(tmp_path / "saved.json"))
+    assert vars(load_config(str(tmp_path / "saved.json"))) == dict(vars(args), config=str(tmp_path / "saved.json"))
+
+
+def test_unknown_options_raise(tmp_path):
+    path = str(tmp_path / "run.json")
+    with open(path, "w") as f:
+        json.dump({"num_worker": 8}, f)
+    with pytest.raises(ValueError, match="num_worker"):
+        load_config(path)
+    with pytest.raises(ValueError, match="num_worker"):
+        parse_args(["--config", path])
+    with pytest.raises(ValueError, match="SUV_maximum"):
+        load_config(SUV_maximum=5)
+
+
+def test_config_file_values_are_defaults(tmp_path):
+    path = str(tmp_path / "run.json")
+    with open(path, "w") as f:
+        json.dump({"num_workers": 8, "rotation_interval": 5}, f)
+    args = parse_args(["--config", path, "--num_workers", "4"])
+    assert (args.num_workers, args.rotation_interval) == (4, 5)
+    args = cli.parse_cli_args(["projections", "--config", path, "--num_workers", "4"])
+    assert (args.command, args.num_workers, args.rotation_interval) == ("projections", 4, 5)
+
+
+def test_every_command_has_all_the_options():
+    options = set(vars(parse_args([])))
+    parser, commands = cli.get_cli_parser()
+    assert set(commands) == set(cli.COMMANDS)
+    for command in cli.COMMANDS:
+        assert os.path.isfile(os.path.join(cli.PATH_SCRIPTS, cli.COMMANDS[command][0] + ".py"))
+        args = cli.parse_cli_args([command])
+        assert args.command == command and options <= set(vars(args))
+    with pytest.raises(SystemExit):
+        cli.parse_cli_args([])
+
+
+def test_run_calls_the_script_main(monkeypatch):
+    args = load_config()
+    monkeypatch.setattr(scan_statistics, "main", lambda args: ("stats", args))
+    assert cli.run("stats", args) == ("stats", args)
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+from conftest import make_scan
+
+
+def get_baseline_projections(SEG, SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, CT_LT, CT_AT, CT_A, view):
+    """
+    Projections of one view as computed by the original generate_SUV_CT_collage, one volume reduction per projection.
+    """
+    min_max = lambda MIP: (MIP - np.min(MIP)) / (np.max(MIP) - np.min(MIP))
+    SUV_L, CT_L = SUV * SEG, utils.preprocess_CT_HU_values(CT * SEG)
+    CT_LT, CT_AT, CT_A = [utils.preprocess_CT_HU_values(arr) for arr in (CT_LT, CT_AT, CT_A)]
+    P = {name: utils.generate_MIPs_PET(arr, view, intensity_type="max", img_type="negative") for name, arr in
+        (("MIP_SUV_bone", SUV_B), ("MIP_SUV_lean", SUV_LT), ("MIP_SUV_adipose", SUV_AT), ("MIP_SUV_air", SUV_A), ("MIP_SUV", SUV), ("MIP_SUV_SEG", SUV_L))}
+    P["SIP_SUV_SEG"] = utils.generate_MIPs_PET(SUV_L, view, intensity_type="sum", img_type="negative")
+    for name, arr, img_type in (("SIP_CT_bone", CT_B, "negative"), ("SIP_CT_lean", CT_LT, "negative"), ("SIP_CT_adipose", CT_AT, "positive"), ("SIP_CT_air", CT_A, "negative")):
+        P[name] = min_max(utils.generate_MIPs_CT(arr, view, intensity_type="sum", img_type=img_type))
+    P["SIP_CT"] = utils.generate_MIPs_CT(CT - np.min(CT), view, intensity_type="sum", img_type="positive")
+    for name, intensity_type in (("SIP_CT_SEG", "sum"), ("MIP_CT_SEG", "max")):
+        MIP = min_max(utils.generate_MIPs_CT(CT_L, view, intensity_type=intensity_type, img_type="negative")) * utils.generate_MIPs_Seg(SEG, view)
+        P[name] = np.absolute(MIP - np.amax(MIP))
+    return P
+
+
+@pytest.fixture(scope="module")
+def volumes():
+    from config import load_config
+    args = load_config()
+    CT, SUV, SEG = make_scan((200, 180, 24))
+    return args, [SEG, SUV, *utils.generate_tissue_channels(CT, SUV, args)[:4], CT, *utils.generate_tissue_channels(CT, SUV, args)[4:]]
+
+
+def test_batched_projections_equal_baseline(volumes):
+    args, arrays = volumes
+    projections = utils.render_collage_projections(args, *arrays)
+    assert list(projections) == args.MIP_types
+    for view in args.MIP_types:
+        expected = get_baseline_projections(*arrays, view)
+        assert projections[view].keys() == expected.keys()
+        for name, MIP in expected.items():
+            np.testing.assert_allclose(projections[view][name], MIP, rtol=1e-5, atol=1e-5, err_msg="{} {}".format(view, name))
+
+
+def test_collage_frame_equals_saved_MIP(volumes):
+    args, arrays = volumes
+    projections = utils.render_collage_projections(args, *arrays)
+    #8-bit image of save_MIP, before the JPEG encoding
+    for view, P in projections.items():
+        for name, MIP in P.items():
+            np.testing.assert_array_equal(utils.get_collage_frame(MIP), (255. * MIP[:,85:-85]).astype(np.uint8))
+
+def test_collage_composed_in_memory(tmp_path, volumes):
+    args, arrays = volumes
+    projections = utils.render_collage_projections(args, *arrays)
+    frames = {view: {name: utils.get_collage_frame(MIP) for name, MIP in P.items()} for view, P in projections.items()}
+    coronal, saggital = frames["coronal"]["MIP_SUV"], frames["saggital"]["MIP_SUV"]
+
+    #Layout of the original collages: the views of every projection side by side in a cell as wide as two coronal images, SUV in the first row and CT in the second one
+    canvas = utils.compose_collage(frames, args.MIP_types)
+    height, width = coronal.shape
+    assert canvas.shape == (2 * height, 7 * 2 * width)
+    for r, row in enumerate(utils.COLLAGE_LAYOUT):
+        for c, name in enumerate(row):
+            cell = canvas[r*height:(r+1)*height, c*2*width:(c+1)*2*width]
+            np.testing.assert_array_equal(cell[:, :width], frames["coronal"][name], err_msg=name)
+            np.testing.assert_array_equal(cell[:, width:width + saggital.shape[1]], frames["saggital"][name], err_msg=name)
+            assert not cell[:, width + saggital.shape[1]:].any()
+
+    utils.save_SUV_CT_collage(frames, str(tmp_path), "PETCT_0", "01-01-2000", "LYMPHOMA")
+    assert os.listdir(tmp_path) == ["Collages"]
+    saved = np.asarray(Image.open(tmp_path / "Collages" / "LYMPHOMA_PETCT_0_01-01-2000.jpg").convert("L"), dtype=np.float64)
+    assert saved.shape == canvas.shape and np.mean(np.abs(saved - canvas)) < 8 #JPEG of a noise phantom
+
+
+def test_roi_collage_equals_full_volume(volumes):
+    args, arrays = volumes
+    bbox = utils.get_body_bbox(arrays[6], args, arrays[0])
+    expected = utils.render_collage_projections(args, *arrays)
+    for view, P in utils.render_collage_projections(args, *arrays, bbox=bbox).items():
+        for name, MIP in P.items():
+            np.testing.assert_allclose(MIP, expected[view][name], rtol=1e-5, atol=1e-5, err_msg="{} {}".format(view, name))
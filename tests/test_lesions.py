@@ -0,0 +1,140 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.ndimage
+
+import utils
+from conftest import make_scan
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data Preparation"))
+import lesion_quantification
+
+
+def test_lesion_features_equal_per_lesion_loop(scan, args):
+    CT, SUV, SEG = scan
+    spacing = (2., 2., 3.)
+    features, lesions = utils.quantify_lesions(SUV, CT, SEG, args, spacing)
+    labels, n = scipy.ndimage.label(SEG != 0, structure=np.ones((3, 3, 3)))
+    assert features["n_lesions"] == n == len(lesions) == 2
+    voxel_ml = np.prod(spacing) / 1000
+    offsets = utils.get_sphere_offsets(spacing, args.SUV_peak_ml)
+    for k, lesion in lesions.iterrows():
+        mask = labels == lesion["lesion"]
+        SUV_lesion = SUV[mask].astype(np.float64)
+        assert lesion["voxels"] == np.count_nonzero(mask)
+        assert lesion["MTV_ml"] == pytest.approx(np.count_nonzero(mask) * voxel_ml)
+        assert lesion["SUVmax"] == pytest.approx(SUV_lesion.max())
+        assert lesion["SUVmean"] == pytest.approx(SUV_lesion.mean())
+        assert lesion["TLG"] == pytest.approx(SUV_lesion.mean() * np.count_nonzero(mask) * voxel_ml)
+        assert lesion["CT_mean"] == pytest.approx(CT[mask].astype(np.float64).mean())
+        #SUVpeak: mean SUV in the sphere around every lesion voxel (clipped to the volume), one voxel at a time
+        peaks = []
+        for point in np.argwhere(mask):
+            shifted = point + offsets
+            shifted = shifted[np.all((shifted >= 0) & (shifted < SUV.shape), axis=1)]
+            peaks.append(SUV[tuple(shifted.T)].astype(np.float64).mean())
+        assert lesion["SUVpeak"] == pytest.approx(max(peaks))
+        assert sum(lesion["fraction_" + tissue] for tissue in ["unassigned"] + utils.TISSUE_TYPES) == pytest.approx(1)
+        centroid = np.mean(np.argwhere(mask) * spacing, axis=0)
+        assert [lesion["centroid_{}_mm".format(name)] for name in "xyz"] == pytest.approx(list(centroid))
+    assert features["MTV_ml"] == pytest.approx(lesions["MTV_ml"].sum())
+    assert features["SUVmax"] == pytest.approx(lesions["SUVmax"].max())
+    centroids = lesions[["centroid_x_mm", "centroid_y_mm", "centroid_z_mm"]].to_numpy()
+    assert features["Dmax_mm"] == pytest.approx(np.linalg.norm(centroids[0] - centroids[1]))
+    assert features["Dspread_mm"] == pytest.approx(np.linalg.norm(centroids[0] - centroids[1]))
+
+
+def test_scan_without_lesion(scan, args):
+    CT, SUV, SEG = scan
+    features, lesions = utils.quantify_lesions(SUV, CT, np.zeros_like(SEG), args, (2., 2., 3.))
+    assert len(lesions) == 0 and features["n_lesions"] == 0
+    assert features["MTV_ml"] == features["SUVmax"] == features["Dmax_mm"] == features["Dbulk_mm"] == 0
+
+
+def test_lesion_quantification_script(tmp_path, scan_files, args):
+    pd.DataFrame([dict(scan_files, pat_ID="PETCT_{}".format(k), scan_date="01-01-2000", diagnosis="LYMPHOMA", age="050Y") for k in range(2)]).to_csv(args.path_df, index=False)
+    lesion_quantification.main(args)
+    df_features = pd.read_csv(tmp_path / "lesion_features.csv")
+    df_lesions = pd.read_csv(tmp_path / "lesion_table.csv")
+    assert list(df_features["pat_ID"]) == ["PETCT_0", "PETCT_1"] and list(df_features["n_lesions"]) == [2, 2]
+    assert list(df_features["diagnosis"]) == ["LYMPHOMA"] * 2 and "CT" not in df_features
+    assert len(df_lesions) == 4 and list(df_lesions["lesion"]) == [1, 2, 1, 2]
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_lesion_voxels_of_any_memory_layout(scan, order):
+    _, _, SEG = scan
+    SEG = np.asarray(SEG, order=order)
+    lesions = utils.LesionVoxels.from_volume(SEG)
+    assert len(lesions) == np.count_nonzero(SEG)
+    for coords, expected in zip(lesions.coords, np.nonzero(np.ascontiguousarray(SEG))):
+        np.testing.assert_array_equal(coords, expected)
+    np.testing.assert_array_equal(lesions.to_volume(), SEG)
+
+
+@pytest.mark.parametrize("axis", [0, 1])
+def test_sparse_projections_equal_dense(scan, axis):
+    CT, SUV, SEG = scan
+    lesions = utils.LesionVoxels.from_volume(SEG)
+    for arr in (SUV, CT):
+        dense = arr * SEG
+        np.testing.assert_array_equal(lesions.gather(arr), dense[SEG != 0])
+        np.testing.assert_array_equal(lesions.project(lesions.gather(arr), axis, np.max), np.max(dense, axis=axis))
+        np.testing.assert_allclose(lesions.project(lesions.gather(arr), axis, np.sum), np.sum(dense, axis=axis), rtol=1e-6)
+        assert lesions.reduce(lesions.gather(arr), np.min) == np.min(dense)
+
+
+@pytest.mark.parametrize("order", [1, 3])
+def test_sparse_rotated_projection_equals_dense(scan, order):
+    _, _, SEG = scan
+    lesions = utils.LesionVoxels.from_volume(SEG)
+    for angle in (-45, 0, 30):
+        expected = utils.project_volume(SEG, utils.get_rotation_plan(SEG.shape[:2], angle, order=order))
+        np.testing.assert_allclose(lesions.rotated_projection(angle, order=order), expected, atol=1e-6)
+
+
+def test_lesion_statistics_equal_dense(scan, args):
+    CT, SUV, SEG = scan
+    stats = utils.compute_scan_statistics(CT, SUV, None, args, lesions=utils.LesionVoxels.from_volume(SEG))
+    dense = utils.compute_scan_statistics(CT, SUV, SEG, args)
+    for key, value in stats.items():
+        np.testing.assert_array_equal(value, dense[key], err_msg=key)
+    assert stats["voxels_lesion"] == np.count_nonzero(SEG)
+    for name, arr in (("CT", CT), ("SUV", SUV)):
+        values = (arr * SEG)[SEG != 0].astype(np.float64)
+        assert stats[name + "_lesion_min"] == pytest.approx(values.min())
+        assert stats[name + "_lesion_max"] == pytest.approx(values.max())
+        assert stats[name + "_lesion_mean"] == pytest.approx(values.mean())
+
+
+def test_negative_scan_has_no_lesion(scan_files):
+    row = dict(scan_files, diagnosis="NEGATIVE")
+    lesions = utils.load_lesions(row)
+    assert len(lesions) == 0 and lesions.shape == utils.get_nii_shape(scan_files["SEG"])
+
+
+def test_sparse_collage_equals_dense(scan, args):
+    CT, SUV, SEG = scan
+    channels = utils.generate_tissue_channels(CT, SUV, args)
+    dense = utils.render_collage_projections(args, SEG, SUV, *channels[:4], CT, *channels[4:])
+    sparse = utils.render_collage_projections(args, None, SUV, *channels[:4], CT, *channels[4:], lesions=utils.LesionVoxels.from_volume(SEG))
+    for i in dense:
+        for name, MIP in dense[i].items():
+            np.testing.assert_allclose(sparse[i][name], MIP, rtol=1e-5, atol=1e-6, err_msg="{} {}".format(i, name))
+
+
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+@pytest.mark.parametrize("order", [1, 3])
+def test_sparse_stack_projections_equal_dense(args, order):
+    CT, SUV, SEG = make_scan((150, 140, 8))
+    channels = list(utils.generate_tissue_channels(CT, SUV, args))
+    channels[5:] = [utils.preprocess_CT_HU_values(arr) for arr in channels[5:]]
+    lesions = utils.LesionVoxels.from_volume(SEG)
+    dense = dict(utils.generate_multi_channel_projections(utils.get_projection_stack(SUV, *channels[:4], CT, *channels[4:], SEG), [-45, 0, 30], 0, 7, -1000, 1000, order=order))
+    sparse = dict(utils.generate_multi_channel_projections(utils.get_projection_stack(SUV, *channels[:4], CT, *channels[4:], lesions), [-45, 0, 30], 0, 7, -1000, 1000, order=order, lesions=lesions))
+    for angle in dense:
+        for name, projection, expected in zip(utils.PROJECTION_CHANNELS, sparse[angle], dense[angle]):
+            np.testing.assert_allclose(projection, expected, rtol=1e-5, atol=1e-6, err_msg="{} {}".format(angle, name))
@@ -0,0 +1,65 @@
+import os
+
+import utils
+from manifest import BuildManifest, get_fingerprints
+
+PARAMS = {"SUV_max": 7, "bone_HU": [200]}
+
+
+def make_artifact(tmp_path):
+    path_input, path_output = tmp_path / "input.nii.gz", tmp_path / "output.npy"
+    path_input.write_bytes(b"input")
+    path_output.write_bytes(b"output")
+    manifest = BuildManifest(str(tmp_path))
+    manifest.record("projections", get_fingerprints([str(path_input)]), PARAMS)
+    manifest.save()
+    return str(path_input), str(path_output)
+
+
+def is_done(tmp_path, path_input, path_output, params=PARAMS):
+    return BuildManifest(str(tmp_path)).is_done("projections", get_fingerprints([path_input]), params, [path_output])
+
+
+def test_up_to_date_artifact_is_skipped(tmp_path):
+    path_input, path_output = make_artifact(tmp_path)
+    assert is_done(tmp_path, path_input, path_output)
+    #Parameters compare equal after the json round trip (tuples and lists)
+    assert is_done(tmp_path, path_input, path_output, {"SUV_max": 7, "bone_HU": (200,)})
+
+
+def test_changed_input_is_regenerated(tmp_path):
+    path_input, path_output = make_artifact(tmp_path)
+    with open(path_input, "wb") as f:
+        f.write(b"changed input")
+    assert not is_done(tmp_path, path_input, path_output)
+
+
+def test_touched_input_is_regenerated(tmp_path):
+    path_input, path_output = make_artifact(tmp_path)
+    stat = os.stat(path_input)
+    os.utime(path_input, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not is_done(tmp_path, path_input, path_output)
+
+
+def test_changed_params_are_regenerated(tmp_path):
+    path_input, path_output = make_artifact(tmp_path)
+    assert not is_done(tmp_path, path_input, path_output, dict(PARAMS, SUV_max=10))
+
+
+def test_missing_output_is_regenerated(tmp_path):
+    path_input, path_output = make_artifact(tmp_path)
+    os.remove(path_output)
+    assert not is_done(tmp_path, path_input, path_output)
+
+
+def test_stale_angles(tmp_path):
+    path_input, _ = make_artifact(tmp_path)
+    inputs = get_fingerprints([path_input])
+    manifest = BuildManifest(str(tmp_path))
+    for angle in (0, 10):
+        for name in utils.PROJECTION_CHANNELS:
+            os.makedirs(tmp_path / name, exist_ok=True)
+            (tmp_path / name / "{}.npy".format(angle)).write_bytes(b"")
+        manifest.record("projections/{}".format(angle), inputs, PARAMS)
+    assert utils.get_stale_angles(str(tmp_path), [0, 10, 20], manifest, inputs, PARAMS) == [20]
+    assert utils.get_stale_angles(str(tmp_path), [0, 10, 20], manifest, inputs, dict(PARAMS, SUV_max=10)) == [0, 10, 20]
@@ -0,0 +1,55 @@
+import zlib
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+import utils
+from nifti_writer import NiftiWriter
+
+
+def count_gzip_members(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    members = 0
+    while data:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        decompressor.decompress(data)
+        data = decompressor.unused_data
+        members += 1
+    return members
+
+
+@pytest.mark.parametrize("extension", [".nii.gz", ".nii"])
+def test_written_volume_has_the_reference_header(tmp_path, scan_files, scan, extension):
+    CT = scan[0]
+    #Blocks much smaller than the volume, so that the gzip file has several members
+    with NiftiWriter(num_threads=3, block_MB=0.01) as writer:
+        for k in range(3):
+            writer.write(scan_files["CT"], CT + k, str(tmp_path / ("CT_{}".format(k) + extension)))
+    reference = nib.load(scan_files["CT"])
+    for k in range(3):
+        image = nib.load(str(tmp_path / ("CT_{}".format(k) + extension)))
+        np.testing.assert_array_equal(image.affine, reference.affine)
+        assert image.header.get_zooms() == reference.header.get_zooms()
+        np.testing.assert_array_equal(utils.read_nii(str(tmp_path / ("CT_{}".format(k) + extension))), CT + k)
+    with open(tmp_path / ("CT_0" + extension), "rb") as f:
+        assert (f.read(2) == b"\x1f\x8b") == (extension == ".nii.gz")
+    if extension == ".nii.gz":
+        assert count_gzip_members(tmp_path / "CT_0.nii.gz") > 2
+    assert sorted(path.name for path in tmp_path.iterdir() if path.name.startswith("CT_")) == ["CT_{}{}".format(k, extension) for k in range(3)]
+
+
+def test_integer_dtype_is_stored_with_its_scale(tmp_path, scan_files, scan):
+    SUV = scan[1]
+    utils.save_npy_nii(scan_files["SUV"], SUV, str(tmp_path / "SUV.nii.gz"), dtype=np.uint16)
+    image = nib.load(str(tmp_path / "SUV.nii.gz"))
+    assert image.get_data_dtype() == np.uint16
+    slope, intercept = utils.get_quantization(np.uint16, SUV.min(), SUV.max())
+    np.testing.assert_allclose(image.get_fdata(), SUV, atol=slope / 2 + 1e-6)
+
+
+def test_failed_write_is_raised(tmp_path, scan_files, scan):
+    with pytest.raises(FileNotFoundError):
+        with NiftiWriter() as writer:
+            writer.write(scan_files["CT"], scan[0], str(tmp_path / "missing" / "CT.nii.gz"))
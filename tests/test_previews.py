@@ -0,0 +1,83 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+import utils
+from conftest import make_scan, write_nii
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data Preparation"))
+import qc_collages
+
+
+@pytest.mark.parametrize("factor", [2, 3])
+def test_downsample_equals_block_loop(factor):
+    arr = np.random.default_rng(0).uniform(-1000, 1000, (7, 6, 5))
+    blocks = np.empty([-(-n // factor) for n in arr.shape])
+    for index in np.ndindex(*blocks.shape):
+        blocks[index] = arr[tuple(slice(i * factor, (i + 1) * factor) for i in index)].max()
+    #The padded border values do not change the maxima
+    np.testing.assert_array_equal(utils.downsample_volume(arr, factor), blocks)
+    #Means of the blocks of a volume cropped to a multiple of factor (no padding)
+    arr = arr[tuple(slice(n - n % factor) for n in arr.shape)]
+    X, Y, Z = arr.shape
+    means = arr.reshape(X // factor, factor, Y // factor, factor, Z // factor, factor).mean(axis=(1, 3, 5))
+    np.testing.assert_allclose(utils.downsample_volume(arr, factor, np.mean), means, rtol=1e-12)
+
+
+def test_pyramid_levels_equal_direct_downsampling(scan):
+    CT, SUV, SEG = scan
+    pyramid = utils.build_preview_pyramid(CT, SUV, SEG, factors=(4, 2, 3))
+    assert sorted(pyramid) == [2, 3, 4]
+    for factor, (CT_level, SUV_level, SEG_level) in pyramid.items():
+        assert (CT_level.dtype, SUV_level.dtype, SEG_level.dtype) == (np.float32, np.float32, np.uint8)
+        #Level 4 is computed from level 2, level 3 from the full volumes
+        np.testing.assert_allclose(CT_level, utils.downsample_volume(CT, factor, np.mean, dtype=np.float64), rtol=1e-5, atol=1e-3)
+        np.testing.assert_array_equal(SUV_level, utils.downsample_volume(SUV, factor))
+        np.testing.assert_array_equal(SEG_level, utils.downsample_volume(SEG, factor))
+        #Max pooling keeps the hottest voxel and every lesion
+        assert SUV_level.max() == SUV.max() and SEG_level.sum() >= 2
+
+
+def test_preview_round_trip(tmp_path, scan):
+    pyramid = utils.build_preview_pyramid(*scan)
+    path = str(tmp_path / "Previews" / "preview.npz")
+    utils.save_preview_pyramid(path, pyramid)
+    assert os.listdir(tmp_path / "Previews") == ["preview.npz"]
+    for factor, volumes in pyramid.items():
+        for arr, stored in zip(volumes, utils.load_preview_level(path, factor)):
+            np.testing.assert_array_equal(stored, arr)
+            assert stored.dtype == arr.dtype
+
+
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+def test_qc_script_renders_changed_scans(tmp_path, monkeypatch, args):
+    CT, SUV, SEG = make_scan((200, 180, 24))
+    files = {name: write_nii(tmp_path / (name + ".nii.gz"), arr) for name, arr in (("CT", CT), ("SUV", SUV), ("SEG", SEG))}
+    pd.DataFrame([dict(files, pat_ID="PETCT_0", scan_date="01-01-2000", diagnosis="LYMPHOMA")]).to_csv(args.path_df, index=False)
+    args.preview_factors, args.preview_level = [2, 4], 4
+    qc_collages.main(args)
+    path_status = os.path.join(utils.get_QC_collage_path(args), "qc_status.csv")
+    assert pd.read_csv(path_status)["rendered"].tolist() == [True]
+
+    #Collage of the level 4 of the pyramid, with the crop scaled to the level
+    CT_level, SUV_level, SEG_level = utils.build_preview_pyramid(CT, SUV, SEG, (2, 4))[4]
+    channels = utils.generate_tissue_channels(CT_level, SUV_level, args)
+    projections = utils.render_collage_projections(args, SEG_level, SUV_level, *channels[:4], CT_level, *channels[4:])
+    frames = {i: {name: utils.get_collage_frame(MIP, crop=85 // 4) for name, MIP in P.items()} for i, P in projections.items()}
+    collage = np.asarray(Image.open(os.path.join(utils.get_QC_collage_path(args), "Collages", "LYMPHOMA_PETCT_0_01-01-2000.jpg")).convert("L"))
+    expected = utils.compose_collage(frames, list(frames))
+    assert collage.shape == expected.shape
+    assert np.abs(collage.astype(float) - expected).mean() < 8
+
+    #With --qc_changed_only an unchanged scan is not rendered again, otherwise it is rendered from its saved pyramid
+    args.qc_changed_only = True
+    qc_collages.main(args)
+    assert pd.read_csv(path_status)["rendered"].tolist() == [False]
+    args.qc_changed_only = False
+    monkeypatch.setattr(qc_collages, "read_nii", None)
+    qc_collages.main(args)
+    assert pd.read_csv(path_status)["rendered"].tolist() == [True]
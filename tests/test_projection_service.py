@@ -0,0 +1,96 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+from conftest import make_scan, write_nii
+from projection_service import ProjectionService, ProjectionServicePool, RandomAngleProjections
+
+pytestmark = pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+
+
+@pytest.fixture
+def service_args(tmp_path, args):
+    #Two scans, their channels stored as tissue label maps
+    args.channel_storage = "label_map"
+    rows = []
+    for seed, (pat_ID, scan_date) in enumerate((("PETCT_0", "01-01-2000"), ("PETCT_1", "02-02-2001"))):
+        CT, SUV, SEG = make_scan((150, 140, 10), seed=seed)
+        scan_dir = tmp_path / pat_ID / scan_date
+        scan_dir.mkdir(parents=True)
+        row = {"pat_ID": pat_ID, "scan_date": scan_date, "diagnosis": "LYMPHOMA", "CT": write_nii(scan_dir / "CTres.nii.gz", CT),
+            "SUV": write_nii(scan_dir / "SUV.nii.gz", SUV), "SEG": write_nii(scan_dir / "SEG.nii.gz", SEG)}
+        path_label_map = utils.get_label_map_path(args, pat_ID, scan_date)
+        os.makedirs(os.path.dirname(path_label_map))
+        utils.save_npy_nii(row["CT"], utils.generate_tissue_label_map(CT, args), path_label_map)
+        rows.append(row)
+    return pd.DataFrame(rows), args
+
+
+def get_expected(row, args, angle):
+    stack, round_channels = utils.load_projection_stack(row, args)
+    return dict(utils.generate_multi_channel_projections(stack, [angle], args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, order=args.projection_order, round_channels=round_channels, dtype=np.float32))[angle]
+
+
+def test_service_equals_projection_script(service_args):
+    df, args = service_args
+    service = ProjectionService(df, args, resident_scans=1)
+    for _, row in df.iterrows():
+        for angle in (-37, 0, 10):
+            projections = service.get(row["pat_ID"], row["scan_date"], angle)
+            expected = get_expected(row, args, angle)
+            assert projections.shape == (len(utils.PROJECTION_CHANNELS),) + expected[0].shape
+            for name, projection, MIP in zip(utils.PROJECTION_CHANNELS, projections, expected):
+                np.testing.assert_allclose(projection, MIP, rtol=1e-5, atol=1e-5, err_msg="{} {}".format(angle, name))
+    row = df.iloc[0]
+    np.testing.assert_array_equal(service.get(row["pat_ID"], row["scan_date"], 0, ["SEG", "CT_MIP"]), service.get(row["pat_ID"], row["scan_date"], 0)[[-1, 5]])
+    assert tuple(service.get_shape(row["pat_ID"], row["scan_date"])) == (150, 140, 10)
+
+
+def test_service_lru_counts(service_args):
+    df, args = service_args
+    keys = [(row["pat_ID"], row["scan_date"]) for _, row in df.iterrows()]
+    #Projections at -10 and 10 degrees have the same shape, the cache holds two of them
+    size = ProjectionService(df, args).get(*keys[0], 10).nbytes
+    service = ProjectionService(df, args, resident_scans=1, cache_MB=2.5 * size / 2**20)
+    service.get(*keys[0], 10)
+    service.get(*keys[0], -10)
+    service.get(*keys[0], 10)
+    assert service.get_counts() == dict(hits=1, misses=2, scans_loaded=1, resident_scans=1, cached_projections=2, cache_MB=2 * size / 2**20)
+    #The third projection evicts the least recently used one (-10 degrees), the second scan evicts the first one
+    service.get(*keys[1], 10)
+    service.get(*keys[0], -10)
+    counts = service.get_counts()
+    assert (counts["misses"], counts["scans_loaded"], counts["resident_scans"], counts["cached_projections"]) == (4, 3, 1, 2)
+    assert list(service.projections) == [keys[1] + (10,), keys[0] + (-10,)]
+
+
+def test_pool_equals_service(service_args):
+    df, args = service_args
+    service = ProjectionService(df, args)
+    with ProjectionServicePool(df, args, num_workers=2) as pool:
+        #A pickled pool connects to the same servers
+        for client in (pool, pickle.loads(pickle.dumps(pool))):
+            for _, row in df.iterrows():
+                np.testing.assert_array_equal(client.get(row["pat_ID"], row["scan_date"], 25), service.get(row["pat_ID"], row["scan_date"], 25))
+        counts = pool.get_counts()
+        assert len(counts) == 2 and sum(c["misses"] for c in counts) == 2 and sum(c["hits"] for c in counts) == 2
+
+
+def test_random_angle_batches(service_args):
+    df, args = service_args
+    service = ProjectionService(df, args)
+    dataset = RandomAngleProjections(service, df, angle_min=-20, angle_max=20, angle_step=10, angles_per_scan=3, channels=["SUV_MIP", "SEG"], batch_size=1, prefetch=1, num_threads=2, seed=0)
+    assert dataset.angles == [-20, -10, 0, 10, 20]
+    assert dataset.image_shape == (10, max(utils.get_projection_width((150, 140), angle) for angle in dataset.angles))
+    batches = list(dataset)
+    assert len(batches) == 2 and sorted(ID for batch in batches for ID in batch["pat_ID"]) == ["PETCT_0", "PETCT_1"]
+    for batch in batches:
+        assert batch["projections"].shape == (1, 3, 2) + dataset.image_shape and batch["angles"].shape == (1, 3)
+        assert set(batch["angles"].ravel()) <= set(dataset.angles) and batch["diagnosis"] == ["LYMPHOMA"]
+        for angle, projections in zip(batch["angles"][0], batch["projections"][0]):
+            expected = service.get(batch["pat_ID"][0], batch["scan_date"][0], angle, ["SUV_MIP", "SEG"])
+            np.testing.assert_array_equal(projections, utils.fit_projection(expected, dataset.image_shape))
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+from config import load_config
+from conftest import make_scan
+from projection_store import save_projection_tensor, open_projection_tensor, save_projection_index, load_projection_index, get_projection, ProjectionDataset
+
+ANGLES = [-90, -45, 0, 45, 90]
+WINDOWS = (0, 7, -1000, 1000)
+
+pytestmark = pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+
+
+@pytest.fixture(scope="module")
+def stack():
+    CT, SUV, SEG = make_scan((150, 140, 6))
+    SUV_B, SUV_LT, SUV_AT, SUV_A, CT_B, CT_LT, CT_AT, CT_A = utils.generate_tissue_channels(CT, SUV, load_config())
+    return utils.get_projection_stack(SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, *[utils.preprocess_CT_HU_values(arr) for arr in (CT_LT, CT_AT, CT_A)], SEG)
+
+
+def save_index(tmp_path, metadata):
+    save_projection_index(str(tmp_path), [dict(metadata, pat_ID="PETCT_0", scan_date="01-01-2000")])
+    return load_projection_index(str(tmp_path))
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_tensor_equals_per_file_projections(tmp_path, stack, compression):
+    utils.generate_all_MIPs(str(tmp_path / "files"), stack, *WINDOWS, -90, 90, 45, order=1, dtype=np.float32)
+    os.makedirs(tmp_path / "tensor")
+    metadata = save_projection_tensor(str(tmp_path / "tensor"), stack, ANGLES, *WINDOWS, order=1, compression=compression)
+    assert metadata["angles"] == ANGLES and metadata["channels"] == utils.PROJECTION_CHANNELS
+    assert open_projection_tensor(metadata["path"]).shape == tuple(metadata["shape"])
+    df_index = save_index(tmp_path, metadata)
+    for angle in ANGLES:
+        for name in utils.PROJECTION_CHANNELS:
+            expected = np.load(tmp_path / "files" / name / "{}.npy".format(angle))
+            np.testing.assert_array_equal(get_projection(df_index, "PETCT_0", "01-01-2000", angle, name), expected, err_msg="{} {}".format(name, angle))
+
+
+def test_reused_angles_equal_regenerated(tmp_path, stack):
+    save_projection_tensor(str(tmp_path), stack, [-45, 0], *WINDOWS, order=1)
+    metadata = save_projection_tensor(str(tmp_path), stack, ANGLES, *WINDOWS, order=1, reuse_angles=[-45, 0])
+    expected = dict(utils.generate_multi_channel_projections(stack, ANGLES, *WINDOWS, order=1, dtype=np.float32))
+    df_index = save_index(tmp_path, metadata)
+    for angle in ANGLES:
+        for c, name in enumerate(utils.PROJECTION_CHANNELS):
+            np.testing.assert_array_equal(get_projection(df_index, "PETCT_0", "01-01-2000", angle, name), expected[angle][c], err_msg="{} {}".format(name, angle))
+
+
+@pytest.mark.parametrize("projection_format", ["tensor", "files"])
+def test_dataset_reads_the_saved_projections(tmp_path, stack, projection_format):
+    df = pd.DataFrame([{"pat_ID": "PETCT_{}".format(k), "scan_date": "01-01-2000", "diagnosis": "LYMPHOMA", "age": 50 + k, "sex": "F"} for k in range(3)])
+    records = []
+    for k, row in df.iterrows():
+        save_path = str(tmp_path / row["pat_ID"] / row["scan_date"])
+        os.makedirs(save_path)
+        #The scans differ by a factor on the SUV
+        scan = stack.copy()
+        scan[:5] *= k + 1
+        if projection_format == "tensor":
+            records.append(dict(save_projection_tensor(save_path, scan, ANGLES, *WINDOWS, order=1), pat_ID=row["pat_ID"], scan_date=row["scan_date"]))
+        else:
+            utils.generate_all_MIPs(save_path, scan, *WINDOWS, -90, 90, 45, order=1, dtype=np.float32)
+    if records:
+        save_projection_index(str(tmp_path), records)
+
+    dataset = ProjectionDataset(df, str(tmp_path), angles=[0, 45], channels=["SUV_MIP", "CT_bone"], batch_size=2, num_threads=2)
+    batches = list(dataset)
+    assert [len(batch["pat_ID"]) for batch in batches] == [2, 1]
+    assert sum(batches[0]["age"] + batches[1]["age"]) == 153
+    projections = np.concatenate([batch["projections"] for batch in batches])
+    assert projections.shape[:3] == (3, 2, 2)
+    for k, row in df.iterrows():
+        save_path = tmp_path / row["pat_ID"] / row["scan_date"]
+        for a, angle in enumerate([0, 45]):
+            for c, name in enumerate(["SUV_MIP", "CT_bone"]):
+                if projection_format == "tensor":
+                    expected = get_projection(load_projection_index(str(tmp_path)), row["pat_ID"], row["scan_date"], angle, name)
+                else:
+                    expected = np.load(save_path / name / "{}.npy".format(angle))
+                np.testing.assert_array_equal(projections[k, a, c], utils.fit_projection(expected, projections.shape[-2:]), err_msg="{} {} {}".format(row["pat_ID"], name, angle))
@@ -0,0 +1,177 @@
+import cv2
+import numpy as np
+import pytest
+import scipy.ndimage
+
+import utils
+from config import load_config
+from conftest import make_scan
+
+ANGLES = [-90, -45, 0, 10, 90]
+SUV_MIN, SUV_MAX, CT_MIN, CT_MAX = 0, 7, -1000, 1000
+#Maximum absolute difference of the order 0/1 projections from the order 3 ones (see utils.project_channels): SUV_MIP, SUV tissue channels,
+#CT tissue channels, fraction of the SEG pixels that differ and CT_MIP before its normalization (relative to its range)
+ORDER_BOUNDS = {
+    1: {"SUV_MIP": 0.015, "SUV": 0.22, "CT": 0.02, "SEG": 0.006, "CT_MIP": 0.004},
+    0: {"SUV_MIP": 0.09, "SUV": 0.67, "CT": 0.07, "SEG": 0.02, "CT_MIP": 0.017},
+}
+
+
+def get_rotated_projection(arr, angle, intensity_type, clip=None):
+    """
+    Projection of the original projection scripts: scipy.ndimage.rotate of the whole volume, reduced along axis 1 and normalized (not cropped yet).
+    """
+    rotated = scipy.ndimage.rotate(arr, angle=angle, axes=(0,1))
+    if intensity_type == "SEG":
+        return cv2.rotate(np.max(rotated, axis=1).astype("float"), cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if clip is not None:
+        rotated = np.clip(rotated, *clip)
+    MIP = (np.max(rotated, axis=1) if intensity_type == "maximum" else np.sum(rotated, axis=1)).astype("float")
+    MIP = MIP / np.max(MIP)
+    MIP = np.absolute(MIP - np.amax(MIP))
+    return cv2.rotate(MIP, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+
+def make_body_scan(shape=(150, 140, 12), seed=0):
+    """
+    Smoother scan than make_scan, closer to the interpolation errors of real scans: body (fat around lean tissue) with two lungs and a bone,
+    10 HU of noise, uptake of 1 in the body with two hot lesions, blurred by the partial volume (1 voxel).
+    """
+    rng = np.random.default_rng(seed)
+    X, Y, Z = shape
+    x, y = np.meshgrid(np.linspace(-1, 1, X), np.linspace(-1, 1, Y), indexing="ij")
+    r = (x / 0.8) ** 2 + (y / 0.6) ** 2
+    CT = np.full((X, Y), -1000.)
+    CT[r < 1] = -100.
+    CT[r < 0.8] = 40.
+    CT[((x - 0.35) / 0.2) ** 2 + (y / 0.3) ** 2 < 1] = -800.
+    CT[((x + 0.35) / 0.2) ** 2 + (y / 0.3) ** 2 < 1] = -800.
+    CT[(x / 0.12) ** 2 + ((y + 0.35) / 0.12) ** 2 < 1] = 700.
+    CT = np.repeat(CT[:, :, None], Z, axis=2) + rng.normal(0, 10, shape) * (CT[:, :, None] > -1000)
+    SUV = np.where(CT > -1000, 1., 0.)
+    SEG = np.zeros(shape, dtype=np.uint8)
+    z = np.arange(Z)[None, None]
+    for cx, cy, cz, radius in ((0.1, 0.1, Z // 3, 0.1), (-0.2, -0.1, 2 * Z // 3, 0.07)):
+        d = ((x - cx)[:, :, None] ** 2 + (y - cy)[:, :, None] ** 2) / radius ** 2 + ((z - cz) / 3.) ** 2
+        SEG[d < 1] = 1
+        SUV += 8 * np.exp(-d)
+    CT = scipy.ndimage.gaussian_filter(CT, 1).astype(np.float32)
+    SUV = scipy.ndimage.gaussian_filter(SUV, 1).astype(np.float32)
+    return np.asfortranarray(CT), np.asfortranarray(SUV), np.asfortranarray(SEG)
+
+
+def get_stack(CT, SUV, SEG):
+    SUV_B, SUV_LT, SUV_AT, SUV_A, CT_B, CT_LT, CT_AT, CT_A = utils.generate_tissue_channels(CT, SUV, load_config())
+    volumes = [SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, utils.preprocess_CT_HU_values(CT_LT), utils.preprocess_CT_HU_values(CT_AT), utils.preprocess_CT_HU_values(CT_A)]
+    return utils.get_projection_stack(*volumes, SEG)
+
+
+@pytest.fixture(scope="module")
+def stack():
+    CT, SUV, SEG = make_scan((150, 140, 8))
+    return get_stack(CT, SUV, SEG), SEG
+
+
+#The sums of the CT of a body in air (negative HU) peak at 0 in the empty corners of the rotation, which the original normalization divides by
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+def test_order_3_equals_scipy_rotate(stack):
+    stack, SEG = stack
+    projections = dict(utils.generate_multi_channel_projections(stack, ANGLES, SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, round_channels=("SEG",)))
+    assert list(projections) == ANGLES
+    for angle in ANGLES:
+        for c, name in enumerate(utils.PROJECTION_CHANNELS):
+            if name == "SEG":
+                expected = get_rotated_projection(SEG, angle, "SEG")
+            elif name.startswith("SUV"):
+                expected = get_rotated_projection(stack[c], angle, "maximum", (SUV_MIN, SUV_MAX))
+            else:
+                expected = get_rotated_projection(stack[c], angle, "sum")
+                if name != "CT_MIP":
+                    expected = (expected - np.min(expected)) / (np.max(expected) - np.min(expected))
+            np.testing.assert_array_equal(projections[angle][c], expected[:,60:-60], err_msg="{} {}".format(name, angle))
+
+
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+def test_integer_CT_channels_are_rounded():
+    #The original scripts rotated the channels of an integer CT as integer volumes (masked by int64 masks), scipy.ndimage.rotate rounds them
+    CT, SUV, SEG = make_scan((150, 140, 6))
+    CT = np.asfortranarray(np.round(CT).astype(np.int16))
+    args = load_config()
+    round_channels = utils.get_round_channels(CT.dtype, SUV.dtype, SEG.dtype)
+    assert round_channels == ("CT_MIP", "CT_bone", "CT_lean", "CT_adipose", "CT_air", "SEG")
+    CT_channels = [CT] + [CT * mask.astype(np.int64) for mask in utils.generate_binary_masks(CT, args)]
+    CT_channels = CT_channels[:2] + [utils.preprocess_CT_HU_values(arr) for arr in CT_channels[2:]]
+    projections = dict(utils.generate_multi_channel_projections(get_stack(CT, SUV, SEG), ANGLES, SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, round_channels=round_channels))
+    for angle in ANGLES:
+        for name, arr in zip(["CT_MIP", "CT_bone", "CT_lean", "CT_adipose", "CT_air"], CT_channels):
+            expected = get_rotated_projection(arr, angle, "sum")
+            if name != "CT_MIP":
+                expected = (expected - np.min(expected)) / (np.max(expected) - np.min(expected))
+            np.testing.assert_array_equal(projections[angle][utils.PROJECTION_CHANNELS.index(name)], expected[:,60:-60], err_msg="{} {}".format(name, angle))
+    #Without the rounding the sums of the interpolated values differ
+    unrounded = dict(utils.generate_multi_channel_projections(get_stack(CT, SUV, SEG), [10], SUV_MIN, SUV_MAX, CT_MIN, CT_MAX))
+    assert not np.array_equal(unrounded[10][utils.PROJECTION_CHANNELS.index("CT_lean")], projections[10][utils.PROJECTION_CHANNELS.index("CT_lean")])
+
+
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+def test_order_3_is_the_default(stack):
+    stack, _ = stack
+    default = dict(utils.generate_multi_channel_projections(stack, [45], SUV_MIN, SUV_MAX, CT_MIN, CT_MAX))
+    cubic = dict(utils.generate_multi_channel_projections(stack, [45], SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, order=3))
+    np.testing.assert_array_equal(default[45], cubic[45])
+    assert load_config().projection_order == 3
+
+
+@pytest.fixture(scope="module")
+def body_projections():
+    CT, SUV, SEG = make_body_scan()
+    stack = get_stack(CT, SUV, SEG)
+    angles = list(range(-90, 91, 10))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return CT, stack, angles, dict(utils.generate_multi_channel_projections(stack, angles, SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, order=3))
+
+
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+@pytest.mark.parametrize("order", [0, 1])
+def test_low_order_bounds(body_projections, order):
+    CT, stack, angles, expected = body_projections
+    projections = dict(utils.generate_multi_channel_projections(stack, angles, SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, order=order))
+    bounds = ORDER_BOUNDS[order]
+    for angle in angles:
+        for c, name in enumerate(utils.PROJECTION_CHANNELS):
+            difference = np.abs(projections[angle][c] - expected[angle][c])
+            if name == "SEG":
+                assert np.mean(difference > 0.5) <= bounds["SEG"], angle
+            elif name != "CT_MIP":
+                assert np.max(difference) <= bounds[name if name == "SUV_MIP" else name[:name.index("_")]], "{} {}".format(name, angle)
+        CT_sum = utils.project_volume(CT, utils.get_rotation_plan(CT.shape[:2], angle, order=order), "sum")
+        CT_sum_cubic = utils.project_volume(CT, utils.get_rotation_plan(CT.shape[:2], angle, order=3), "sum")
+        assert np.max(np.abs(CT_sum - CT_sum_cubic)) <= bounds["CT_MIP"] * np.ptp(CT_sum_cubic), angle
+
+
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+@pytest.mark.parametrize("order", [1, 3])
+def test_multi_channel_projections_equal_per_modality(tmp_path, order):
+    CT, SUV, SEG = make_scan((130, 120, 6))
+    SUV_B, SUV_LT, SUV_AT, SUV_A, CT_B, CT_LT, CT_AT, CT_A = utils.generate_tissue_channels(CT, SUV, load_config())
+    CT_LT, CT_AT, CT_A = [utils.preprocess_CT_HU_values(arr) for arr in (CT_LT, CT_AT, CT_A)]
+    for name in utils.PROJECTION_CHANNELS:
+        (tmp_path / name).mkdir()
+    utils.generate_all_MIPs_SUV(str(tmp_path), SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, SEG, SUV_MIN, SUV_MAX, -90, 90, 45, order=order)
+    utils.generate_all_MIPs_CT(str(tmp_path), CT, CT_B, CT_LT, CT_AT, CT_A, SEG, CT_MIN, CT_MAX, -90, 90, 45, order=order)
+    stack = utils.get_projection_stack(SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, CT_LT, CT_AT, CT_A, SEG)
+    for angle, MIPs in utils.generate_multi_channel_projections(stack, range(-90, 91, 45), SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, order=order):
+        for name, MIP in zip(utils.PROJECTION_CHANNELS, MIPs):
+            np.testing.assert_array_equal(MIP, np.load(tmp_path / name / "{}.npy".format(angle)), err_msg="{} {}".format(name, angle))
+
+
+@pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+@pytest.mark.parametrize("order", [0, 1])
+def test_roi_projections_equal_full_volume(order):
+    CT, SUV, SEG = make_body_scan((150, 140, 8))
+    stack = get_stack(CT, SUV, SEG)
+    bbox = utils.get_body_bbox(CT, load_config(), SEG)
+    assert bbox != tuple((0, n) for n in CT.shape)
+    expected = utils.generate_multi_channel_projections(stack, ANGLES, SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, order=order)
+    for (angle, MIPs), (_, MIPs_roi) in zip(expected, utils.generate_multi_channel_projections(stack, ANGLES, SUV_MIN, SUV_MAX, CT_MIN, CT_MAX, order=order, bbox=bbox)):
+        np.testing.assert_allclose(MIPs_roi, MIPs, rtol=1e-6, atol=1e-6, err_msg=str(angle))
@@ -0,0 +1,39 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from config import load_config
+from scan_runner import run_scans
+
+
+def process_scan(row, args):
+    if row["crash"]:
+        os._exit(1)
+    if row["fail"]:
+        raise ValueError("corrupt volume")
+    time.sleep(row["sleep"])
+    return {"value": 2 * row["x"]}
+
+
+def get_df(crash=(), fail=(), sleep=0.):
+    return pd.DataFrame([{"pat_ID": "PETCT_{}".format(k), "scan_date": "01-01-2000", "x": k, "crash": k in crash, "fail": k in fail, "sleep": sleep} for k in range(6)])
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_failing_scan_is_reported_and_skipped(num_workers):
+    df_status = run_scans(process_scan, get_df(fail=(2,)), load_config(), num_workers=num_workers)
+    assert list(df_status["pat_ID"]) == list(get_df()["pat_ID"])
+    assert list(df_status["status"]) == ["done", "done", "failed", "done", "done", "done"]
+    assert "corrupt volume" in df_status.loc[2, "error"]
+    assert [int(value) for value in df_status["value"].drop(2)] == [0, 2, 6, 8, 10]
+
+
+def test_dead_worker_fails_the_scans_in_flight_only():
+    #Scan 1 kills its worker while scan 0 is still running on the pool, the other scans run on a new pool
+    df_status = run_scans(process_scan, get_df(crash=(1,), sleep=0.5), load_config(), num_workers=2, max_in_flight=2)
+    assert list(df_status["pat_ID"]) == list(get_df()["pat_ID"])
+    assert list(df_status["status"]) == ["failed", "failed", "done", "done", "done", "done"]
+    assert "BrokenProcessPool" in df_status.loc[1, "error"]
+    assert [int(value) for value in df_status["value"][2:]] == [4, 6, 8, 10]
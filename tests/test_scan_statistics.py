@@ -0,0 +1,77 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data Preparation"))
+import scan_statistics
+
+CHANNEL_NAMES = ["SUV_" + tissue for tissue in utils.TISSUE_TYPES] + ["CT_" + tissue for tissue in utils.TISSUE_TYPES]
+
+
+def test_statistics_equal_masked_reductions(scan, args):
+    CT, SUV, SEG = scan
+    stats = utils.compute_scan_statistics(CT, SUV, SEG, args)
+    masks = utils.generate_binary_masks(CT, args)
+    assert stats["voxels"] == CT.size and stats["voxels_lesion"] == np.count_nonzero(SEG)
+    for name, arr in (("CT", CT), ("SUV", SUV)):
+        assert stats[name + "_min"] == arr.min() and stats[name + "_max"] == arr.max()
+        assert stats[name + "_mean"] == pytest.approx(arr.mean(dtype=np.float64))
+        for q in utils.STAT_PERCENTILES:
+            assert stats["{}_p{}".format(name, q)] == pytest.approx(np.percentile(arr, q))
+        for tissue, mask in zip(utils.TISSUE_TYPES, masks):
+            assert stats["voxels_" + tissue] == np.count_nonzero(mask)
+            assert stats["{}_{}_min".format(name, tissue)] == arr[mask].min() and stats["{}_{}_max".format(name, tissue)] == arr[mask].max()
+            assert stats["{}_{}_mean".format(name, tissue)] == pytest.approx(arr[mask].mean(dtype=np.float64))
+        assert stats[name + "_lesion_max"] == arr[SEG > 0].max()
+        assert stats["hist_" + name].sum() == arr.size
+    assert stats["hist_SUV_lesion"].sum() == np.count_nonzero(SEG)
+
+
+def test_channel_min_equals_channel(scan, args):
+    CT, SUV, SEG = scan
+    stats = utils.compute_scan_statistics(CT, SUV, SEG, args)
+    for name, channel in zip(CHANNEL_NAMES, utils.generate_tissue_channels(CT, SUV, args)):
+        assert utils.get_channel_min(stats, name) == channel.min(), name
+        assert utils.get_channel_min(stats, name, "max") == channel.max(), name
+    assert utils.get_channel_min(stats, "CT_lesion") == (CT * SEG).min()
+    assert utils.get_channel_min(None, "CT") is None
+
+
+def test_index_round_trip(scan, args):
+    CT, SUV, SEG = scan
+    records = [{"pat_ID": "PETCT_{}".format(k), "scan_date": "01-01-2000", "statistics": utils.compute_scan_statistics(CT + 100 * k, SUV, SEG, args)} for k in range(3)]
+    utils.save_scan_statistics(args, records[:2])
+    utils.save_scan_statistics(args, records[1:])
+    stats = utils.ScanStatistics(args)
+    assert len(stats) == 3 and stats.get("PETCT_9", "01-01-2000") is None
+    assert stats.get("PETCT_2", "01-01-2000")["CT_max"] == pytest.approx(records[2]["statistics"]["CT_max"])
+    assert stats.channel_min("PETCT_1", "01-01-2000", "CT") == pytest.approx(CT.min() + 100)
+    counts, edges = stats.histogram("SUV")
+    np.testing.assert_array_equal(counts, 3 * records[0]["statistics"]["hist_SUV"])
+    np.testing.assert_array_equal(edges, utils.HISTOGRAM_EDGES["SUV"])
+    #Window of the cohort within a histogram bin of the exact percentile
+    low, high = stats.window("SUV", (1, 99))
+    width = edges[1] - edges[0]
+    assert abs(low - np.percentile(SUV, 1)) <= width and abs(high - np.percentile(SUV, 99)) <= width
+
+    #Statistics of other HU windows are not used
+    args.lean_HU = [-30, 150]
+    assert len(utils.ScanStatistics(args)) == 0
+
+
+def test_statistics_script_skips_indexed_scans(tmp_path, monkeypatch, scan_files, args):
+    pd.DataFrame([dict(scan_files, pat_ID="PETCT_{}".format(k), scan_date="01-01-2000", diagnosis="LYMPHOMA") for k in range(2)]).to_csv(args.path_df, index=False)
+    scan_statistics.main(args)
+    df_status = pd.read_csv(tmp_path / "statistics_status.csv")
+    assert list(df_status["status"]) == ["done", "done"]
+    assert len(utils.ScanStatistics(args)) == 2
+    #The volumes of indexed scans are not read again
+    monkeypatch.setattr(scan_statistics, "read_nii", None)
+    scan_statistics.main(args)
+    assert list(pd.read_csv(tmp_path / "statistics_status.csv")["status"]) == ["done", "done"]
+    assert len(utils.ScanStatistics(args)) == 2
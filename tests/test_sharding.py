@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import sharding
+import utils
+from config import load_config
+from conftest import write_nii
+
+
+@pytest.fixture
+def df(tmp_path):
+    rows = []
+    for k, n_z in enumerate([4, 9, 2, 7, 7, 3, 12, 5, 1, 6]):
+        path_CT = write_nii(tmp_path / "CT_{}.nii.gz".format(k), np.zeros((4, 4, n_z), dtype=np.float32))
+        rows.append({"pat_ID": "PETCT_{:02d}".format(k), "scan_date": "01-01-2000", "CT": path_CT})
+    return pd.DataFrame(rows)
+
+
+def get_args(tmp_path, shard_index=0):
+    return load_config(path_df=str(tmp_path / "df_final.csv"), num_shards=3, shard_index=shard_index)
+
+
+def test_shard_assignment_is_deterministic(df):
+    shards = sharding.get_shard_assignment(df, 3)
+    assert set(shards) == {0, 1, 2}
+    np.testing.assert_array_equal(sharding.get_shard_assignment(df, 3), shards)
+    #Same shard for every scan whatever the order of df
+    shuffled = df.sample(frac=1, random_state=0)
+    assert dict(zip(shuffled["pat_ID"], sharding.get_shard_assignment(shuffled, 3))) == dict(zip(df["pat_ID"], shards))
+    #Balanced by cost: the largest shard exceeds the mean by less than the costliest scan
+    costs = sharding.get_scan_costs(df)
+    loads = np.bincount(shards, weights=costs, minlength=3)
+    assert loads.max() - costs.sum() / 3 < costs.max()
+
+
+def test_merge_of_complete_shards(tmp_path, df):
+    for k in range(3):
+        args = get_args(tmp_path, k)
+        sharding.save_shard_record(str(tmp_path), "channels", args, df, sharding.select_shard(df, args))
+    shards = sharding.merge_shards(df, str(tmp_path), "channels", get_args(tmp_path))
+    assert shards == {(row["pat_ID"], row["scan_date"]): k for row, k in zip(df.to_dict("records"), sharding.get_shard_assignment(df, 3))}
+
+
+def test_merge_rejects_duplicates(tmp_path, df):
+    for k in range(3):
+        args = get_args(tmp_path, k)
+        #Shard 1 also processed the scans of shard 0
+        df_shard = df[sharding.get_shard_assignment(df, 3) <= k] if k == 1 else sharding.select_shard(df, args)
+        sharding.save_shard_record(str(tmp_path), "channels", args, df, df_shard)
+    with pytest.raises(ValueError, match="processed by shards"):
+        sharding.merge_shards(df, str(tmp_path), "channels", get_args(tmp_path))
+
+
+def test_merge_rejects_missing_shards(tmp_path, df):
+    for k in (0, 2):
+        args = get_args(tmp_path, k)
+        sharding.save_shard_record(str(tmp_path), "channels", args, df, sharding.select_shard(df, args))
+    with pytest.raises(ValueError, match="missing"):
+        sharding.merge_shards(df, str(tmp_path), "channels", get_args(tmp_path))
+
+
+def test_merge_rejects_duplicate_scans_in_the_dataset(tmp_path, df):
+    with pytest.raises(ValueError, match="Duplicate scans"):
+        sharding.merge_shards(pd.concat([df, df.iloc[:2]]), str(tmp_path), "channels", get_args(tmp_path))
+
+
+def test_merge_of_the_shard_indexes(tmp_path, df):
+    path_status = str(tmp_path / "scan_status.csv")
+    for k in range(3):
+        args = get_args(tmp_path, k)
+        df_shard = sharding.select_shard(df, args)
+        df_shard[["pat_ID", "scan_date"]].assign(status="done").to_csv(sharding.get_shard_path(path_status, args), index=False)
+        utils.save_bbox_index(args, [{"pat_ID": pat_ID, "scan_date": scan_date, "bbox": ((0, 4), (0, 4), (0, k + 1))} for pat_ID, scan_date in zip(df_shard["pat_ID"], df_shard["scan_date"])])
+        sharding.save_shard_record(str(tmp_path), "channels", args, df, df_shard)
+    assert sharding.get_shard_path(path_status, get_args(tmp_path, 1)) == str(tmp_path / "scan_status.shard-1-of-3.csv")
+    shards = sharding.merge_shards(df, str(tmp_path), "channels", get_args(tmp_path), indexes=[path_status], updates=[utils.get_bbox_index_path(get_args(tmp_path))])
+    df_status = pd.read_csv(path_status)
+    assert list(df_status["pat_ID"]) == list(df["pat_ID"]) and set(df_status["status"]) == {"done"}
+    df_bbox = pd.read_csv(utils.get_bbox_index_path(get_args(tmp_path)))
+    assert {(row["pat_ID"], row["scan_date"]): row["z1"] - 1 for _, row in df_bbox.iterrows()} == shards
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import utils
+from conftest import make_scan, write_nii
+from projection_store import load_projection_index, get_projection
+from scan_runner import run_pipeline
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data Preparation"))
+import streaming_pipeline
+
+pytestmark = pytest.mark.filterwarnings("ignore:divide by zero:RuntimeWarning", "ignore:invalid value:RuntimeWarning")
+
+
+def test_pipeline_stages_run_in_order():
+    df = pd.DataFrame([{"pat_ID": "PETCT_{}".format(k), "scan_date": "01-01-2000", "x": k} for k in range(8)])
+    def load(item, args):
+        return None if item["row"]["x"] == 3 else dict(item, value=item["row"]["x"])
+    def compute(item, args):
+        if item["value"] == 5:
+            raise ValueError("corrupt volume")
+        item["value"] *= 2
+        return item
+    def write(item, args):
+        item["outputs"] = {"value": item.pop("value")}
+        return item
+    df_status = run_pipeline([("load", load, 1), ("compute", compute, 3), ("write", write, 1)], df, None, queue_size=1)
+    assert list(df_status["pat_ID"]) == list(df["pat_ID"])
+    assert list(df_status["status"]) == ["done"] * 3 + ["skipped", "done", "failed", "done", "done"]
+    assert "corrupt volume" in df_status.loc[5, "error"]
+    assert [int(value) for value in df_status["value"].drop([3, 5])] == [0, 2, 4, 8, 12, 14]
+    assert {"seconds_load", "seconds_compute", "seconds_write"} <= set(df_status.columns)
+
+
+@pytest.mark.parametrize("projection_format", ["tensor", "files"])
+def test_pipeline_projections_equal_direct_generation(tmp_path, monkeypatch, args, projection_format):
+    CT, SUV, SEG = make_scan((150, 140, 6))
+    row = {"pat_ID": "PETCT_0", "scan_date": "01-01-2000", "diagnosis": "LYMPHOMA", "CT": write_nii(tmp_path / "CTres.nii.gz", CT), "SUV": write_nii(tmp_path / "SUV.nii.gz", SUV), "SEG": write_nii(tmp_path / "SEG.nii.gz", SEG)}
+    pd.DataFrame([row]).to_csv(args.path_df, index=False)
+    args.pipeline_outputs, args.projection_format, args.projection_order = ["projections"], projection_format, 1
+    args.rotation_min, args.rotation_max, args.rotation_interval = -90, 90, 45
+
+    #compute_scan saves the projections, the item passed to the writer holds none of them
+    written = []
+    write_scan = streaming_pipeline.write_scan
+    monkeypatch.setattr(streaming_pipeline, "write_scan", lambda item, args: written.append(sorted(item)) or write_scan(item, args))
+    streaming_pipeline.main(args)
+    assert len(written) == 1 and "projections" not in written[0]
+
+    SUV_B, SUV_LT, SUV_AT, SUV_A, CT_B, CT_LT, CT_AT, CT_A = utils.generate_tissue_channels(CT, SUV, args)
+    stack = utils.get_projection_stack(SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, *[utils.preprocess_CT_HU_values(arr) for arr in (CT_LT, CT_AT, CT_A)], SEG)
+    expected = dict(utils.generate_multi_channel_projections(stack, [-90, -45, 0, 45, 90], args.SUV_min, args.SUV_max, args.CT_min, args.CT_max, order=1, dtype=np.float32))
+    save_path = os.path.join(args.path_multi_angled_multi_channel_2D_projections, "PETCT_0", "01-01-2000")
+    df_index = load_projection_index(args.path_multi_angled_multi_channel_2D_projections) if projection_format == "tensor" else None
+    for angle, MIPs in expected.items():
+        for name, MIP in zip(utils.PROJECTION_CHANNELS, MIPs):
+            saved = get_projection(df_index, "PETCT_0", "01-01-2000", angle, name) if projection_format == "tensor" else np.load(os.path.join(save_path, name, "{}.npy".format(angle)))
+            np.testing.assert_allclose(saved, MIP, rtol=1e-5, atol=1e-5, err_msg="{} {}".format(name, angle))
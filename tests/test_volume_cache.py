@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+import utils
+from conftest import make_scan, write_nii
+from volume_cache import VolumeCache
+
+
+@pytest.fixture
+def volumes(tmp_path):
+    return [write_nii(tmp_path / "CT_{}.nii.gz".format(k), make_scan(seed=k)[0]) for k in range(3)]
+
+
+def get_entries(cache_dir):
+    return sorted(os.path.join(root, f) for root, _, files in os.walk(cache_dir) for f in files if f.endswith(".npy"))
+
+
+def test_cached_volume_equals_decoded(tmp_path, volumes):
+    cache = VolumeCache(str(tmp_path / "cache"), hot_items=0)
+    for _ in range(2):
+        arr = cache.read(volumes[0])
+        np.testing.assert_array_equal(arr, utils.read_nii(volumes[0]))
+        assert not arr.flags.writeable
+    assert len(get_entries(tmp_path / "cache")) == 1
+    #A rewritten source is decoded again
+    write_nii(volumes[0], make_scan(seed=5)[0])
+    np.testing.assert_array_equal(cache.read(volumes[0]), make_scan(seed=5)[0])
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, volumes, monkeypatch):
+    size = utils.read_nii(volumes[0]).nbytes
+    cache = VolumeCache(str(tmp_path / "cache"), max_GB=2.5 * size / 2**30, hot_items=0)
+    #The misses only update the ledger, the cache directory is listed once at startup
+    monkeypatch.setattr(os, "walk", None)
+    cache.read(volumes[0])
+    cache.read(volumes[1])
+    cache.read(volumes[0])
+    cache.read(volumes[2])
+    monkeypatch.undo()
+    entries = get_entries(tmp_path / "cache")
+    assert sorted(cache.entries) == entries and len(entries) == 2
+    assert cache.total == sum(os.path.getsize(entry) for entry in entries) <= cache.max_bytes
+    #Volume 1 is the least recently used
+    assert [os.path.basename(entry) for entry in entries] == sorted(cache.key(path) + ".npy" for path in (volumes[0], volumes[2]))
+    #A new process starts from the entries on disk
+    assert VolumeCache(str(tmp_path / "cache")).total == cache.total
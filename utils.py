@@ -1,42 +1,632 @@
-import SimpleITK as sitk
 import os
 import numpy as np
-import matplotlib.pyplot as plt
-import nibabel as nib
-from config import parse_args
-import cv2
-from PIL import Image
-import scipy.ndimage
-from tqdm import tqdm
+import importlib
+import json
+import pandas as pd
+import contextlib
+import itertools
 
+from profiling import profiled, profile_stage, profile_io
+from manifest import get_temp_path, save_npy_atomic, BuildManifest
+
+class LazyModule:
+    """
+    Module imported on first use, so that importing utils (e.g. in every worker process) does not load the heavy dependencies of the steps that are not run.
+    submodules - Submodules imported on first access, e.g. scipy.ndimage.
+    """
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+
+    def __getattr__(self, name):
+        if name in self._submodules:
+            return importlib.import_module(self._name + "." + name)
+        return getattr(importlib.import_module(self._name), name)
+
+sitk = LazyModule("SimpleITK")
+nib = LazyModule("nibabel")
+cv2 = LazyModule("cv2")
+Image = LazyModule("PIL.Image")
+scipy = LazyModule("scipy", submodules=("ndimage", "special", "spatial"))
+
+def tqdm(*args, **kwargs):
+    """
+    tqdm progress bar, imported on first use (see LazyModule).
+    """
+    from tqdm import tqdm as progress_bar
+    return progress_bar(*args, **kwargs)
+
+VOLUME_CACHE = None #VolumeCache used by read_nii, see volume_cache.init_volume_cache.
+
+@profiled("load")
 def read_nii(path):
+    if VOLUME_CACHE is not None:
+        return VOLUME_CACHE.read(path)
+    profile_io(path, "read")
     img = sitk.ReadImage(path)
     img_arr = sitk.GetArrayFromImage(img)
     img_arr = np.transpose(img_arr, (2,1,0))
     return img_arr
 
+def get_nii_shape(path):
+    """
+    Shape of the volume read_nii(path) returns, from the header only.
+    """
+    return tuple(int(n) for n in nib.load(path).shape[:3])
+
+def read_nii_slabs(path, slab_size):
+    """
+    Read a NIfTI volume slab by slab along z, holding one slab in memory: yields (z0, z1, slab) where slab is read_nii(path)[:, :, z0:z1]
+    (same values, dtype and memory layout). The file is kept open, so a gzip-compressed volume is decompressed once, sequentially.
+    """
+    image = nib.load(path, keep_file_open=True)
+    proxy = image.dataobj
+    scaled = (proxy.slope, proxy.inter) != (1., 0.)
+    for z0 in range(0, image.shape[2], slab_size):
+        z1 = min(z0 + slab_size, image.shape[2])
+        with profile_stage("load"):
+            if z0 == 0:
+                profile_io(path, "read")
+            slab = np.asarray(proxy[:, :, z0:z1])
+            #Scaled volumes are read by SimpleITK as float32
+            slab = np.asfortranarray(slab.astype(np.float32) if scaled else slab)
+        yield z0, z1, slab
+
+def get_scan_artifacts(args, row):
+    """
+    Inputs, parameters and outputs of the artifacts of the 3D channel generation for one scan (row of df_final.csv), as recorded in its BuildManifest:
+    "channels" (tissue label map or the eight masked SUV/CT volumes), "collage" (visualization collage), "preview" (preview pyramid) and "QC_collage_<level>x"
+    (QC collage rendered from a level of the preview pyramid).
+    Returns {artifact: (input paths, params, output paths)}.
+    """
+    pat_ID, scan_date = row["pat_ID"], row["scan_date"]
+    HU_windows = {"bone_HU": args.bone_HU, "lean_HU": args.lean_HU, "adipose_HU": args.adipose_HU, "air_HU": args.air_HU}
+    if args.channel_storage == "label_map":
+        outputs_channels = [get_label_map_path(args, pat_ID, scan_date)]
+    else:
+        outputs_channels = list(get_channel_paths(args, pat_ID, scan_date).values())
+    path_collage = os.path.join(args.path_multi_channel_3D_CT_SUV, "Visualization", "Collages", row["diagnosis"] + "_" + pat_ID + "_" + scan_date + ".jpg")
+    path_QC_collage = os.path.join(get_QC_collage_path(args), "Collages", row["diagnosis"] + "_" + pat_ID + "_" + scan_date + ".jpg")
+    return {
+        "channels": ([row["CT"], row["SUV"]], dict(HU_windows, channel_dtype=args.channel_dtype, channel_storage=args.channel_storage), outputs_channels),
+        "collage": ([row["CT"], row["SUV"], row["SEG"]], dict(HU_windows, SUV_max_collage=args.SUV_max_collage, MIP_types=args.MIP_types), [path_collage]),
+        #Recorded in the manifest of the preview folder of the scan (see get_preview_path)
+        "preview": ([row["CT"], row["SUV"], row["SEG"]], {"preview_factors": sorted(args.preview_factors)}, [get_preview_path(args, pat_ID, scan_date)]),
+        "QC_collage_{}x".format(args.preview_level): ([row["CT"], row["SUV"], row["SEG"]], dict(HU_windows, SUV_max_collage=args.SUV_max_collage, MIP_types=args.MIP_types, preview_level=args.preview_level),
+            [path_QC_collage])}
+
+def get_preview_path(args, pat_ID, scan_date):
+    """
+    Path of the preview pyramid of one scan ("Previews/<pat_ID>/<scan_date>/preview.npz" in the output folder of the 3D channel generation), see build_preview_pyramid.
+    """
+    return os.path.join(args.path_multi_channel_3D_CT_SUV, "Previews", pat_ID, scan_date, "preview.npz")
+
+def get_QC_collage_path(args):
+    """
+    Folder of the QC collages rendered from the preview level args.preview_level ("Visualization/QC_<level>x").
+    """
+    return os.path.join(args.path_multi_channel_3D_CT_SUV, "Visualization", "QC_{}x".format(args.preview_level))
+
+def get_projection_params(args):
+    """
+    Parameters the multi-angle projections depend on, recorded in the BuildManifest of every scan (a change regenerates the affected projections only).
+    """
+    return {"SUV_min": args.SUV_min, "SUV_max": args.SUV_max, "CT_min": args.CT_min, "CT_max": args.CT_max, "projection_order": args.projection_order, "channel_storage": args.channel_storage,
+        "bone_HU": args.bone_HU, "lean_HU": args.lean_HU, "adipose_HU": args.adipose_HU, "air_HU": args.air_HU, "channel_dtype": args.channel_dtype, "volume_dtype": args.volume_dtype,
+        "projection_dtype": args.projection_dtype}
+
+def get_projection_inputs(row):
+    """
+    Input volumes the multi-angle projections of one scan (row of df_final.csv) are recorded with in its BuildManifest, the same for the projection script
+    and the streaming pipeline: CT, SUV and SEG. The tissue channels are derived from them with the parameters of get_projection_params.
+    """
+    return [row["CT"], row["SUV"], row["SEG"]]
+
+def get_body_bbox(CT_arr, args, SEG_arr=None, lesions=None):
+    """
+    Bounding box of the body: every voxel outside the air HU window (CT >= air_HU[0]) and every lesion voxel of SEG, grown by args.roi_margin voxels
+    (at least 1, so that the box is surrounded by air only). All the voxels outside the box are air, which makes ROI-restricted processing exact.
+    lesions - Optional LesionVoxels of SEG, used instead of SEG_arr.
+    Returns ((x0, x1), (y0, y1), (z0, z1)), the whole volume if there is no body voxel.
+    """
+    mask = get_body_mask(CT_arr, args, SEG_arr, lesions)
+    mask_xy = np.any(mask, axis=2)
+    return get_bbox_from_profiles((np.any(mask_xy, axis=1), np.any(mask_xy, axis=0), np.any(mask, axis=(0,1))), args)
+
+def get_body_mask(CT_arr, args, SEG_arr=None, lesions=None):
+    """
+    Voxels of the body (see get_body_bbox).
+    """
+    mask = CT_arr >= args.air_HU[0]
+    if lesions is not None:
+        mask[lesions.coords] = True
+    elif SEG_arr is not None:
+        mask |= SEG_arr != 0
+    return mask
+
+def get_bbox_from_profiles(profiles, args):
+    """
+    Body bounding box (see get_body_bbox) from the x, y and z profiles of the body mask (whether any body voxel is in every x, y and z plane).
+    """
+    margin = max(getattr(args, "roi_margin", 1), 1)
+    bbox = []
+    for any_mask in profiles:
+        indices = np.flatnonzero(any_mask)
+        if len(indices) == 0:
+            return tuple((0, len(profile)) for profile in profiles)
+        bbox.append((max(int(indices[0]) - margin, 0), min(int(indices[-1]) + 1 + margin, len(any_mask))))
+    return tuple(bbox)
+
+def get_roi(bbox):
+    """
+    Slices of a bounding box, e.g. arr[get_roi(bbox)] is the cropped sub-volume.
+    """
+    return tuple(slice(start, end) for start, end in bbox)
+
+def get_outside_value(arr, bbox):
+    """
+    Value of all the voxels of arr outside bbox, or None if they are not all equal (0 if bbox covers the whole volume).
+    Reads the six slabs around the box only.
+    """
+    (x0, x1), (y0, y1), (z0, z1) = bbox
+    slabs = [arr[:x0], arr[x1:], arr[x0:x1, :y0], arr[x0:x1, y1:], arr[x0:x1, y0:y1, :z0], arr[x0:x1, y0:y1, z1:]]
+    value = None
+    for slab in slabs:
+        if slab.size == 0:
+            continue
+        low, high = np.min(slab), np.max(slab)
+        if low != high or (value is not None and low != value):
+            return None
+        value = low
+    return 0. if value is None else float(value)
+
+def reduce_roi(arr_roi, shape, bbox, axis, reduction, outside=0.):
+    """
+    np.max or np.sum along axis (0 or 1) of a volume of the given shape, from its bbox sub-volume arr_roi only, when all its voxels outside bbox equal outside.
+    Same result as reducing the full volume (the sums up to float rounding).
+    """
+    (start, end), n = bbox[axis], shape[axis]
+    kept = [a for a in range(3) if a != axis]
+    if reduction is np.max:
+        P_roi = np.max(arr_roi, axis=axis)
+        P = np.full([shape[a] for a in kept], outside, dtype=P_roi.dtype)
+        P_roi = P_roi if end - start == n else np.maximum(P_roi, outside)
+    else:
+        P_roi = np.sum(arr_roi, axis=axis)
+        if outside != 0:
+            P_roi += outside * (n - (end - start))
+        P = np.full([shape[a] for a in kept], outside * n, dtype=P_roi.dtype)
+    P[tuple(slice(*bbox[a]) for a in kept)] = P_roi
+    return P
+
+def get_bbox_index_path(args):
+    """
+    Path of the body bounding box index of the dataset ("body_bbox.csv", next to df_final.csv).
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(args.path_df)), "body_bbox.csv")
+
+def save_bbox_index(args, records):
+    """
+    Add or update the bounding boxes of scans ({"pat_ID", "scan_date", "bbox"} records) in the body bounding box index (of the shard of a sharded run, see sharding.merge_shards).
+    """
+    from sharding import get_shard_path #sharding imports utils
+    path = get_shard_path(get_bbox_index_path(args), args)
+    df = pd.DataFrame([dict({"pat_ID": record["pat_ID"], "scan_date": record["scan_date"]}, **{axis + suffix: record["bbox"][k][j] for k, axis in enumerate("xyz") for j, suffix in enumerate(("0", "1"))}) for record in records],
+        columns=["pat_ID", "scan_date", "x0", "x1", "y0", "y1", "z0", "z1"])
+    if os.path.isfile(path):
+        df = pd.concat([pd.read_csv(path), df]).drop_duplicates(["pat_ID", "scan_date"], keep="last")
+    path_temp = get_temp_path(path)
+    df.to_csv(path_temp, index=False)
+    os.replace(path_temp, path)
+    return df
+
+def load_bbox_index(args):
+    """
+    Load the body bounding box index as {(pat_ID, scan_date): bbox} (empty if it does not exist yet).
+    """
+    path = get_bbox_index_path(args)
+    if not os.path.isfile(path):
+        return {}
+    df = pd.read_csv(path)
+    return {(row["pat_ID"], row["scan_date"]): ((int(row["x0"]), int(row["x1"])), (int(row["y0"]), int(row["y1"])), (int(row["z0"]), int(row["z1"]))) for _, row in df.iterrows()}
+
+STAT_PERCENTILES = [0.5, 1, 5, 25, 50, 75, 95, 99, 99.5] #Percentiles of CT and SUV saved in the statistics of every scan
+HISTOGRAM_EDGES = {"SUV": np.linspace(0, 50, 201), "CT": np.arange(-1024, 3072 + 8, 8)} #Histogram bins of the scan statistics, values outside go to the first/last bin
+
+def get_statistics_paths(args):
+    """
+    Paths of the scan statistics index ("scan_statistics.csv") and of the histograms of the scans ("scan_histograms.npz"), next to df_final.csv.
+    """
+    folder = os.path.dirname(os.path.abspath(args.path_df))
+    return os.path.join(folder, "scan_statistics.csv"), os.path.join(folder, "scan_histograms.npz")
+
+def get_HU_windows(args):
+    """
+    HU windows the tissue statistics are computed with, recorded with them so that statistics of other windows are not used.
+    """
+    return json.dumps([list(args.bone_HU), list(args.lean_HU), list(args.adipose_HU), list(args.air_HU)])
+
+def get_histogram(arr, edges):
+    """
+    Counts of arr in the uniform bins of edges (values outside of the edges are counted in the first/last bin).
+    """
+    n = len(edges) - 1
+    bins = np.clip((arr - edges[0]) * (n / (edges[-1] - edges[0])), 0, n - 1).astype(np.intp)
+    return np.bincount(bins.ravel(), minlength=n)
+
+@profiled("stats")
+def compute_scan_statistics(CT_arr, SUV_arr, SEG_arr, args, label_map=None, lesions=None):
+    """
+    Statistics of one scan: min, max, mean and STAT_PERCENTILES of CT and SUV, voxel count, min, max and mean of CT and SUV for every tissue class
+    and for the lesions, and histograms of CT, SUV and lesion SUV (keys "hist_CT", "hist_SUV", "hist_SUV_lesion", see HISTOGRAM_EDGES).
+    The tissue reductions are indexed by the tissue label map (computed if not given) and the lesion ones by the LesionVoxels of SEG (built from SEG_arr if not given).
+    Returns a flat dict.
+    """
+    if label_map is None:
+        label_map = generate_tissue_label_map(CT_arr, args)
+    if lesions is None:
+        lesions = LesionVoxels.from_volume(SEG_arr)
+    stats = {"voxels": int(CT_arr.size), "HU_windows": get_HU_windows(args)}
+    counts = np.bincount(label_map.ravel(), minlength=len(TISSUE_TYPES) + 1)
+    mask = np.empty(CT_arr.shape, dtype=bool)
+    stats["voxels_lesion"] = len(lesions)
+    for k, tissue in enumerate(TISSUE_TYPES):
+        stats["voxels_" + tissue] = int(counts[k + 1])
+    for name, arr in (("CT", CT_arr), ("SUV", SUV_arr)):
+        percentiles = np.percentile(arr, STAT_PERCENTILES)
+        stats.update({name + "_min": float(np.min(arr)), name + "_max": float(np.max(arr)), name + "_mean": float(np.mean(arr, dtype=np.float64))})
+        stats.update({name + "_p" + str(q): float(value) for q, value in zip(STAT_PERCENTILES, percentiles)})
+        #Label-indexed sums in one pass, masked min/max per tissue class
+        total = np.bincount(label_map.ravel(), weights=arr.ravel(), minlength=len(TISSUE_TYPES) + 1)
+        for k, tissue in enumerate(TISSUE_TYPES):
+            n = counts[k + 1]
+            np.equal(label_map, k + 1, out=mask)
+            stats.update({"{}_{}_min".format(name, tissue): float(np.min(arr, where=mask, initial=np.inf)) if n else np.nan,
+                "{}_{}_max".format(name, tissue): float(np.max(arr, where=mask, initial=-np.inf)) if n else np.nan,
+                "{}_{}_mean".format(name, tissue): float(total[k + 1]) / n if n else np.nan})
+        #Lesion channels as rendered in the collage (arr * SEG)
+        values = lesions.gather(arr)
+        stats.update({name + "_lesion_min": float(np.min(values)) if len(values) else np.nan, name + "_lesion_max": float(np.max(values)) if len(values) else np.nan,
+            name + "_lesion_mean": float(np.mean(values, dtype=np.float64)) if len(values) else np.nan})
+        stats["hist_" + name] = get_histogram(arr, HISTOGRAM_EDGES[name])
+        if name == "SUV":
+            stats["hist_SUV_lesion"] = get_histogram(values, HISTOGRAM_EDGES["SUV"])
+    return stats
+
+def get_channel_min(stats, name, reduction="min"):
+    """
+    Minimum (or reduction="max" maximum) of a channel of the scan from its statistics, without reading the channel: "CT"/"SUV", a tissue channel
+    ("CT_lean_tissue", "SUV_bone", ... equal to the volume in the tissue and 0 elsewhere) or a lesion channel ("CT_lesion" = CT*SEG, "SUV_lesion").
+    Returns None if stats is None.
+    """
+    if stats is None:
+        return None
+    volume, _, part = name.partition("_")
+    if not part:
+        return stats["{}_{}".format(volume, reduction)]
+    n = stats["voxels_" + part]
+    if n == 0:
+        return 0.
+    value = stats["{}_{}_{}".format(volume, part, reduction)]
+    if n < stats["voxels"]:
+        value = min(value, 0.) if reduction == "min" else max(value, 0.)
+    return value
+
+def save_scan_statistics(args, records):
+    """
+    Add or update the statistics of scans ({"pat_ID", "scan_date", "statistics"} records, see compute_scan_statistics) in the scan statistics index
+    (of the shard of a sharded run, see sharding.merge_shards).
+    """
+    from sharding import get_shard_path #sharding imports utils
+    path_csv, path_npz = (get_shard_path(path, args) for path in get_statistics_paths(args))
+    rows = [dict({"pat_ID": record["pat_ID"], "scan_date": record["scan_date"]}, **{key: value for key, value in record["statistics"].items() if not key.startswith("hist_")}) for record in records]
+    histograms = {"{}/{}/{}".format(record["pat_ID"], record["scan_date"], key): value for record in records for key, value in record["statistics"].items() if key.startswith("hist_")}
+    df = pd.DataFrame(rows)
+    if os.path.isfile(path_csv):
+        df = pd.concat([pd.read_csv(path_csv), df]).drop_duplicates(["pat_ID", "scan_date"], keep="last")
+    if os.path.isfile(path_npz):
+        with np.load(path_npz) as f:
+            histograms = dict({key: f[key] for key in f.files}, **histograms)
+    histograms.update({"edges_" + name: edges for name, edges in HISTOGRAM_EDGES.items()})
+    for path, save, mode in ((path_npz, lambda f: np.savez(f, **histograms), "wb"), (path_csv, lambda f: df.to_csv(f, index=False), "w")):
+        path_temp = get_temp_path(path)
+        with open(path_temp, mode, newline=None if "b" in mode else "") as f:
+            save(f)
+        os.replace(path_temp, path)
+    return df
+
+class ScanStatistics:
+    """
+    Read access to the scan statistics index (see compute_scan_statistics / save_scan_statistics): the statistics of a scan are looked up instead of
+    reducing its volumes again, and dataset-level queries (e.g. the SUV/CT window of the cohort) are answered from the saved histograms.
+    Statistics computed with other HU windows than args are ignored.
+    """
+    def __init__(self, args):
+        self.path_csv, self.path_npz = get_statistics_paths(args)
+        self.df = pd.read_csv(self.path_csv) if os.path.isfile(self.path_csv) else pd.DataFrame(columns=["pat_ID", "scan_date", "HU_windows"])
+        self.df = self.df[self.df["HU_windows"] == get_HU_windows(args)]
+        self.rows = {(row["pat_ID"], row["scan_date"]): row for row in self.df.to_dict("records")}
+        self._histograms = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, pat_ID, scan_date):
+        """
+        Statistics of a scan (dict), None if it is not indexed.
+        """
+        return self.rows.get((pat_ID, scan_date))
+
+    def channel_min(self, pat_ID, scan_date, name, reduction="min"):
+        """
+        Minimum/maximum of a channel of a scan (see get_channel_min), None if the scan is not indexed.
+        """
+        return get_channel_min(self.get(pat_ID, scan_date), name, reduction)
+
+    def histogram(self, name="SUV", scans=None):
+        """
+        Histogram "SUV", "CT" or "SUV_lesion" summed over the scans ((pat_ID, scan_date) list, default all). Returns (counts, edges).
+        """
+        if self._histograms is None:
+            with np.load(self.path_npz) as f:
+                self._histograms = {key: f[key] for key in f.files}
+        counts = np.zeros(len(HISTOGRAM_EDGES[name.split("_")[0]]) - 1, dtype=np.int64)
+        for pat_ID, scan_date in (self.rows if scans is None else scans):
+            counts += self._histograms["{}/{}/hist_{}".format(pat_ID, scan_date, name)]
+        return counts, self._histograms["edges_" + name.split("_")[0]]
+
+    def window(self, name="SUV", percentiles=(1, 99), scans=None):
+        """
+        Values at the given percentiles of all the voxels of the scans (e.g. the SUV/CT window of the cohort), interpolated within the histogram bins.
+        """
+        counts, edges = self.histogram(name, scans)
+        cumulative = np.concatenate([[0], np.cumsum(counts)]) / max(np.sum(counts), 1)
+        return [float(np.interp(q / 100., cumulative, edges)) for q in percentiles]
+
+def get_voxel_spacing(path):
+    """
+    Voxel spacing (mm) of a NIfTI volume along the axes of read_nii, read from its header only.
+    """
+    return tuple(float(spacing) for spacing in nib.load(path).header.get_zooms()[:3])
+
+def label_lesions(SEG_arr, connectivity=3):
+    """
+    Connected components of the lesion mask SEG != 0 (connectivity 1, 2 or 3: 6-, 18- or 26-connected). Returns (labels, number of lesions).
+    """
+    return scipy.ndimage.label(SEG_arr != 0, structure=scipy.ndimage.generate_binary_structure(3, connectivity))
+
+def get_sphere_offsets(spacing, volume_ml=1.):
+    """
+    Voxel offsets (N, 3) of a sphere of the given volume centred on a voxel, used for SUVpeak.
+    """
+    radius = (3 * volume_ml * 1000 / (4 * np.pi)) ** (1 / 3.)
+    spacing = np.asarray(spacing)
+    extent = np.floor(radius / spacing).astype(int)
+    grid = np.stack(np.meshgrid(*[np.arange(-n, n + 1) for n in extent], indexing="ij"), axis=-1).reshape(-1, 3)
+    return grid[np.sum((grid * spacing) ** 2, axis=1) <= radius ** 2]
+
+@profiled("lesions")
+def quantify_lesions(SUV_arr, CT_arr, SEG_arr, args, spacing):
+    """
+    Lesion-level and patient-level quantification of one scan. The lesions are the connected components of SEG (see label_lesions) and every
+    feature is a label-indexed reduction over the lesion voxels only (no loop over the lesions):
+    voxels, MTV (ml), SUVmax, SUVmean, SUVpeak (highest mean SUV in a sphere of args.SUV_peak_ml ml centred in the lesion), TLG (SUVmean x MTV),
+    mean CT, the fractions of the lesion in every tissue class of the HU windows and the centroid (mm).
+    The patient features add up MTV/TLG, take the max of SUVmax/SUVpeak and the voxel-weighted SUVmean, CT and tissue fractions over all the lesions, plus
+    the dissemination: n_lesions, Dmax (largest distance between two lesion centroids), Dbulk (largest distance from the largest lesion) and
+    Dspread (largest sum of the distances from one lesion to all the others), in mm.
+
+    spacing - Voxel spacing (mm) of the volumes, e.g. from get_voxel_spacing.
+    Returns (patient features dict, per-lesion DataFrame).
+    """
+    labels, n = label_lesions(SEG_arr, args.lesion_connectivity)
+    voxel_ml = float(np.prod(spacing)) / 1000
+    coords = np.nonzero(labels)
+    lesion = labels[coords] - 1
+    SUV = SUV_arr[coords].astype(np.float64)
+    CT = CT_arr[coords].astype(np.float64)
+
+    #Lesion voxels sorted by lesion for the max reductions
+    order = np.argsort(lesion, kind="stable")
+    counts = np.bincount(lesion, minlength=n)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.intp)
+
+    #Mean SUV in a sphere centred on every lesion voxel
+    offsets = get_sphere_offsets(spacing, args.SUV_peak_ml)
+    local_sum, local_count = np.zeros(len(SUV)), np.zeros(len(SUV))
+    points = np.stack(coords, axis=1)
+    for offset in offsets:
+        shifted = points + offset
+        valid = np.all((shifted >= 0) & (shifted < SUV_arr.shape), axis=1)
+        local_sum[valid] += SUV_arr[tuple(shifted[valid].T)]
+        local_count += valid
+
+    tissues = generate_tissue_label_map(CT, args) #Tissue class of every lesion voxel
+    composition = np.bincount(lesion * (len(TISSUE_TYPES) + 1) + tissues, minlength=n * (len(TISSUE_TYPES) + 1)).reshape(n, len(TISSUE_TYPES) + 1)
+
+    lesions = pd.DataFrame({"lesion": np.arange(1, n + 1), "voxels": counts, "MTV_ml": counts * voxel_ml})
+    if n:
+        lesions["SUVmax"] = np.maximum.reduceat(SUV[order], starts)
+        lesions["SUVpeak"] = np.maximum.reduceat((local_sum / local_count)[order], starts)
+    else:
+        lesions["SUVmax"] = lesions["SUVpeak"] = np.zeros(0)
+    lesions["SUVmean"] = np.bincount(lesion, weights=SUV, minlength=n) / np.maximum(counts, 1)
+    lesions["TLG"] = lesions["SUVmean"] * lesions["MTV_ml"]
+    lesions["CT_mean"] = np.bincount(lesion, weights=CT, minlength=n) / np.maximum(counts, 1)
+    for k, tissue in enumerate(["unassigned"] + TISSUE_TYPES):
+        lesions["fraction_" + tissue] = composition[:, k] / np.maximum(counts, 1)
+    centroids = np.stack([np.bincount(lesion, weights=points[:, axis] * spacing[axis], minlength=n) for axis in range(3)], axis=1) / np.maximum(counts, 1)[:, None]
+    for axis, name in enumerate("xyz"):
+        lesions["centroid_{}_mm".format(name)] = centroids[:, axis]
+    lesions = lesions[["lesion"] + LESION_FEATURES + ["centroid_{}_mm".format(name) for name in "xyz"]]
+
+    total = max(len(SUV), 1)
+    features = {"n_lesions": n, "voxels": int(len(SUV)), "MTV_ml": len(SUV) * voxel_ml, "TLG": float(lesions["TLG"].sum()),
+        "SUVmax": float(lesions["SUVmax"].max()) if n else 0., "SUVmean": float(np.sum(SUV)) / total, "SUVpeak": float(lesions["SUVpeak"].max()) if n else 0.,
+        "CT_mean": float(np.sum(CT)) / total}
+    features.update({"fraction_" + tissue: float(np.sum(composition[:, k])) / total for k, tissue in enumerate(["unassigned"] + TISSUE_TYPES)})
+    #Dissemination between the lesion centroids, in blocks of rows of the distance matrix
+    features["Dmax_mm"] = features["Dspread_mm"] = 0.
+    rows_per_block = max(1, 2**22 // max(n, 1))
+    for r0 in range(0, n, rows_per_block):
+        distances = scipy.spatial.distance.cdist(centroids[r0:r0+rows_per_block], centroids)
+        features["Dmax_mm"] = max(features["Dmax_mm"], float(np.max(distances)))
+        features["Dspread_mm"] = max(features["Dspread_mm"], float(np.max(np.sum(distances, axis=1))))
+    features["Dbulk_mm"] = float(np.max(scipy.spatial.distance.cdist(centroids[[np.argmax(counts)]], centroids))) if n else 0.
+    return features, lesions
+
+class LesionVoxels:
+    """
+    Sparse lesion mask of a scan, built once per scan (see from_volume and load_lesions): the coordinates and SEG values of the lesion voxels (SEG != 0),
+    in C order, and their bounding box. The lesions usually cover well under 1% of the voxels, so the lesion-masked volumes (arr * SEG), their
+    projections and the rotated SEG projections are computed from the lesion voxels only instead of from whole volumes.
+
+    shape - Shape of the volume.
+    coords - Tuple of the (N,) x, y and z coordinates of the lesion voxels.
+    values - (N,) SEG values of the lesion voxels.
+    """
+    def __init__(self, shape, coords, values):
+        self.shape = tuple(int(n) for n in shape)
+        self.coords = tuple(coords)
+        self.values = values
+        #Bounding box ((x0, x1), (y0, y1), (z0, z1)) of the lesion voxels, None without lesion
+        self.bbox = tuple((int(np.min(c)), int(np.max(c)) + 1) for c in self.coords) if len(values) else None
+
+    @classmethod
+    def from_volume(cls, SEG_arr):
+        #Lesion voxels found in memory order (read_nii returns F-ordered volumes, where np.nonzero is several times slower) and sorted to C order
+        order = "F" if SEG_arr.flags.f_contiguous and not SEG_arr.flags.c_contiguous else "C"
+        flat = np.flatnonzero(SEG_arr.ravel(order=order))
+        if order == "F":
+            flat = np.sort(np.ravel_multi_index(np.unravel_index(flat, SEG_arr.shape, order="F"), SEG_arr.shape))
+        coords = np.unravel_index(flat, SEG_arr.shape)
+        return cls(SEG_arr.shape, coords, SEG_arr[coords])
+
+    @classmethod
+    def empty(cls, shape, dtype=np.uint8):
+        """
+        Scan without lesion, e.g. a NEGATIVE scan.
+        """
+        return cls(shape, [np.zeros(0, dtype=np.intp)] * 3, np.zeros(0, dtype=dtype))
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def gather(self, arr):
+        """
+        Values of the lesion-masked volume arr * SEG at the lesion voxels.
+        """
+        return arr[self.coords] * self.values
+
+    def reduce(self, values, reduction):
+        """
+        Reduction (e.g. np.min) of the whole volume equal to values at the lesion voxels and 0 elsewhere, e.g. of arr * SEG from gather(arr).
+        """
+        if len(values) < np.prod(self.shape):
+            values = np.append(values, np.zeros(1, dtype=values.dtype))
+        return reduction(values)
+
+    def project(self, values, axis, reduction, fill=0.):
+        """
+        np.max or np.sum along axis of the volume equal to values at the lesion voxels and fill elsewhere (e.g. a collage projection of arr * SEG, see
+        reduce_collage_projections), accumulated over the lesion voxels only. Sums are accumulated in float64 and returned in the dtype of values.
+        """
+        axes = [k for k in range(3) if k != axis]
+        shape = (self.shape[axes[0]], self.shape[axes[1]])
+        pixels = np.ravel_multi_index((self.coords[axes[0]], self.coords[axes[1]]), shape)
+        counts = np.bincount(pixels, minlength=shape[0] * shape[1])
+        #Number of voxels of every ray outside the lesions
+        n_fill = self.shape[axis] - counts
+        if reduction is np.sum:
+            MIP = np.bincount(pixels, weights=values, minlength=len(counts)) + n_fill * np.float64(fill)
+        else:
+            lowest = np.finfo(values.dtype).min if np.issubdtype(values.dtype, np.floating) else np.iinfo(values.dtype).min
+            MIP = np.where(n_fill > 0, np.asarray(fill, dtype=values.dtype), lowest).astype(values.dtype)
+            np.maximum.at(MIP, pixels, values)
+        return MIP.reshape(shape).astype(values.dtype, copy=False)
+
+    def crop(self, margin=1, dtype=None):
+        """
+        Dense lesion volume inside the bounding box of the lesions grown by margin voxels (at least 1 for the rotated projections, see get_rotation_plan),
+        clipped to the volume. Returns (volume, bbox).
+        """
+        bbox = tuple((max(start - margin, 0), min(end + margin, n)) for (start, end), n in zip(self.bbox, self.shape))
+        volume = np.zeros(tuple(end - start for start, end in bbox), dtype=self.dtype if dtype is None else dtype)
+        volume[tuple(c - start for c, (start, _) in zip(self.coords, bbox))] = self.values
+        return volume, bbox
+
+    def to_volume(self, dtype=None, out=None):
+        """
+        Dense SEG volume, written to out if given.
+        """
+        if out is None:
+            out = np.zeros(self.shape, dtype=self.dtype if dtype is None else dtype)
+        else:
+            out[...] = 0
+        out[self.coords] = self.values
+        return out
+
+    def rotated_projection(self, angle, order=3):
+        """
+        Max projection along axis 1 of the lesion volume rotated by angle, i.e. project_volume(self.to_volume(), get_rotation_plan(self.shape[:2], angle, order)),
+        sampled inside the bounding box of the lesions only (order <= 1). All zero without lesion.
+        """
+        if not len(self):
+            return np.zeros((get_rotation_plan(self.shape[:2], angle, order=3)["out_shape"][0], self.shape[2]))
+        if order > 1:
+            return project_volume(self.to_volume(), get_rotation_plan(self.shape[:2], angle, order=order))
+        volume, bbox = self.crop()
+        plan = get_rotation_plan(self.shape[:2], angle, order=order, roi=bbox[:2])
+        return project_channels(volume[None], plan, ["maximum"], backgrounds=[0.], z_roi=bbox[2] + (self.shape[2],))[0]
+
+def is_negative(row):
+    """
+    Whether a scan (row of df_final.csv) is a NEGATIVE scan, i.e. has no lesion and an empty SEG.
+    """
+    return row.get("diagnosis") == "NEGATIVE"
+
+def load_lesions(row, shape=None):
+    """
+    LesionVoxels of a scan (row of df_final.csv): read from its SEG volume, or empty for a NEGATIVE scan whose SEG is not read (shape from its header if not given).
+    """
+    if is_negative(row):
+        return LesionVoxels.empty(get_nii_shape(row["SEG"]) if shape is None else shape)
+    return LesionVoxels.from_volume(read_nii(row["SEG"]))
+
+def get_stack_bbox(stack, args, bbox=None):
+    """
+    Body bounding box of a projection stack (see get_projection_stack): bbox (e.g. from the index) if it fits in the stack, else computed from its CT and SEG channels.
+    """
+    if bbox is not None and all(0 <= start < end <= n for (start, end), n in zip(bbox, stack.shape[1:])):
+        return bbox
+    return get_body_bbox(stack[PROJECTION_CHANNELS.index("CT_MIP")], args, stack[PROJECTION_CHANNELS.index("SEG")])
+
+@profiled("mask")
 def generate_binary_masks(CT_arr, args):
     """
     Takes the CT image as input and generates the following binary masks based on its HU cut-off values:
     Bone, Lean Tissue, Adipose Tissue, Air
+    The masks are boolean, so the channels keep the dtype of the volume they are applied to (see get_channels).
     """
-    bone_mask = np.where(CT_arr > args.bone_HU[0], 1, 0)
+    bone_mask = CT_arr > args.bone_HU[0]
 
-    lean_mask = np.where(CT_arr < args.lean_HU[0], 0, CT_arr)
-    lean_mask = np.where(lean_mask > args.lean_HU[1], 0, lean_mask)
-    lean_mask = np.where(lean_mask == 0, 0, 1)
+    #Voxels of exactly 0 HU are outside the lean/adipose windows
+    lean_mask = (CT_arr >= args.lean_HU[0]) & (CT_arr <= args.lean_HU[1]) & (CT_arr != 0)
 
-    adipose_mask = np.where(CT_arr < args.adipose_HU[0], 0, CT_arr)
-    adipose_mask = np.where(adipose_mask > args.adipose_HU[1], 0, adipose_mask)
-    adipose_mask = np.where(adipose_mask == 0, 0, 1)
+    adipose_mask = (CT_arr >= args.adipose_HU[0]) & (CT_arr <= args.adipose_HU[1]) & (CT_arr != 0)
 
-    air_mask = np.where(CT_arr < args.air_HU[0], 1, 0)
+    air_mask = CT_arr < args.air_HU[0]
     return bone_mask, lean_mask, adipose_mask, air_mask
 
 def get_channels(arr, mask):
     arr_new = arr*mask
     return arr_new
 
+@profiled("mask")
 def generate_HU_channels(arr, bone_mask, lean_mask, adipose_mask, air_mask):
     arr_B = get_channels(arr, bone_mask)
     arr_LT = get_channels(arr, lean_mask)
@@ -44,20 +634,223 @@ def generate_HU_channels(arr, bone_mask, lean_mask, adipose_mask, air_mask):
     arr_A = get_channels(arr, air_mask)
     return arr_B, arr_LT, arr_AT, arr_A
 
-def save_npy_nii(ref_path, arr, save_path):
-    image = nib.load(ref_path)
-    new_image = nib.Nifti1Image(arr, image.affine)
-    nib.save(new_image, save_path)
+TISSUE_TYPES = ["bone", "lean_tissue", "adipose_tissue", "air"] #Label k+1 of the tissue label map corresponds to TISSUE_TYPES[k], 0 is unassigned.
+LESION_FEATURES = ["voxels", "MTV_ml", "TLG", "SUVmax", "SUVmean", "SUVpeak", "CT_mean"] + ["fraction_" + tissue for tissue in ["unassigned"] + TISSUE_TYPES] #Per-lesion features of quantify_lesions
 
-def save_all_nii(path_ref, save_path, arr_B, arr_LT, arr_AT, arr_A, prefix):
-    save_npy_nii(path_ref, arr_B, os.path.join(save_path, str(prefix) + "_bone.nii.gz"))
-    save_npy_nii(path_ref, arr_LT, os.path.join(save_path, str(prefix) + "_lean_tissue.nii.gz"))
-    save_npy_nii(path_ref, arr_AT, os.path.join(save_path, str(prefix) + "_adipose_tissue.nii.gz"))
-    save_npy_nii(path_ref, arr_A, os.path.join(save_path, str(prefix) + "_air.nii.gz"))
+@profiled("mask")
+def generate_tissue_label_map(CT_arr, args, out=None):
+    """
+    Takes the CT image as input and generates a uint8 label map of the tissues based on its HU cut-off values:
+    0 - None, 1 - Bone, 2 - Lean Tissue, 3 - Adipose Tissue, 4 - Air
+
+    The windows are identical to generate_binary_masks (including voxels of exactly 0 HU being outside the lean/adipose windows).
+    out - Optional preallocated uint8 array with the shape of CT_arr.
+    """
+    if out is None:
+        out = np.zeros(CT_arr.shape, dtype=np.uint8)
+    else:
+        out.fill(0)
+    mask = np.empty(CT_arr.shape, dtype=bool)
+    temp = np.empty(CT_arr.shape, dtype=bool)
+
+    np.greater(CT_arr, args.bone_HU[0], out=mask)
+    np.copyto(out, 1, where=mask)
+
+    for label, window in ((2, args.lean_HU), (3, args.adipose_HU)):
+        np.greater_equal(CT_arr, window[0], out=mask)
+        np.less_equal(CT_arr, window[1], out=temp)
+        np.logical_and(mask, temp, out=mask)
+        np.not_equal(CT_arr, 0, out=temp)
+        np.logical_and(mask, temp, out=mask)
+        np.copyto(out, label, where=mask)
+
+    np.less(CT_arr, args.air_HU[0], out=mask)
+    np.copyto(out, 4, where=mask)
+    return out
+
+@profiled("mask")
+def generate_tissue_channels(CT_arr, SUV_arr, args, dtype=np.float32, out=None, return_label_map=False, bbox=None):
+    """
+    Fused replacement of generate_binary_masks + 2 x generate_HU_channels: reads CT and SUV once and writes all the eight tissue channels into one array.
+
+    dtype - Output dtype of the channels.
+    out - Optional preallocated array of shape (8,) + CT_arr.shape.
+    bbox - Optional body bounding box of CT_arr (see get_body_bbox): the HU windows are only evaluated inside it, everything outside is air.
+    Returns out with the channels in the order SUV_B, SUV_LT, SUV_AT, SUV_A, CT_B, CT_LT, CT_AT, CT_A (and the tissue label map if return_label_map).
+    """
+    if out is None:
+        out = np.zeros((2*len(TISSUE_TYPES),) + CT_arr.shape, dtype=dtype)
+    else:
+        out.fill(0)
+    air = TISSUE_TYPES.index("air")
+    if bbox is None:
+        roi = (slice(None),) * 3
+        label_map = generate_tissue_label_map(CT_arr, args)
+    else:
+        roi = get_roi(bbox)
+        label_map = np.full(CT_arr.shape, air + 1, dtype=np.uint8)
+        label_map[roi] = generate_tissue_label_map(CT_arr[roi], args)
+        #Air channels outside the box
+        np.copyto(out[air], SUV_arr, casting="unsafe")
+        np.copyto(out[len(TISSUE_TYPES) + air], CT_arr, casting="unsafe")
+        out[air][roi] = 0
+        out[len(TISSUE_TYPES) + air][roi] = 0
+    mask = np.empty(label_map[roi].shape, dtype=bool)
+    for k in range(len(TISSUE_TYPES)):
+        np.equal(label_map[roi], k + 1, out=mask)
+        np.copyto(out[k][roi], SUV_arr[roi], where=mask, casting="unsafe")
+        np.copyto(out[len(TISSUE_TYPES) + k][roi], CT_arr[roi], where=mask, casting="unsafe")
+    if return_label_map:
+        return out, label_map
+    return out
+
+DTYPES = ["float64", "float32", "float16", "uint16", "uint8"] #Dtypes of the dtype policy (--volume_dtype, --channel_dtype, --projection_dtype); integer dtypes are stored with a scale.
+
+def get_quantization(dtype, low=0., high=1., integral=False):
+    """
+    Scale (slope, intercept) storing values in [low, high] as dtype, i.e. value = slope * stored + intercept; (1., 0.) for float dtypes.
+    For integer dtypes the range is extended to include 0, which is stored exactly (the background of the channels and projections stays exactly 0).
+    integral - The values are integers (e.g. SEG): stored exactly with a slope of 1 if their range fits dtype.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return 1., 0.
+    low, high = min(float(low), 0.), max(float(high), 0.)
+    levels = int(np.iinfo(dtype).max)
+    if high <= low:
+        return 1., 0.
+    if integral and high - low <= levels:
+        return 1., low
+    slope = high / levels if low == 0 else (high - low) / (levels - 1)
+    #Slope rounded up to 8 significant bits: slope * stored is then exact in float32, so 0 stays exact with the float32 scale of the NIfTI header
+    mantissa, exponent = np.frexp(slope)
+    slope = float(np.ldexp(np.ceil(np.ldexp(mantissa, 8)), exponent - 8))
+    return slope, -float(np.ceil(-low / slope)) * slope
+
+def is_integral(arr):
+    """
+    Whether all the values of arr are (finite) integers.
+    """
+    return bool(np.all(np.equal(np.rint(arr), arr)))
+
+def quantize(arr, dtype, scale=(1., 0.)):
+    """
+    Store arr as dtype: a cast for float dtypes, round((arr - intercept) / slope) for integer dtypes (see get_quantization), with NaN stored as 0.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == "f":
+        return arr.astype(dtype, copy=False)
+    slope, inter = scale
+    q = np.subtract(arr, inter, dtype=np.result_type(arr.dtype, np.float32))
+    q /= slope
+    np.nan_to_num(q, copy=False, nan=0.) #NaN (e.g. the projections of an empty channel) cannot be stored
+    np.rint(q, out=q)
+    np.clip(q, 0, np.iinfo(dtype).max, out=q)
+    return q.astype(dtype)
+
+def dequantize(arr, scale=(1., 0.), dtype=np.float32):
+    """
+    Values of an array stored by quantize, as dtype.
+    """
+    out = np.asarray(arr).astype(dtype)
+    if np.issubdtype(np.asarray(arr).dtype, np.integer) and tuple(scale) != (1., 0.):
+        out *= scale[0]
+        out += scale[1]
+    return out
+
+def get_compute_dtype(dtype, default=np.float32):
+    """
+    dtype arrays stored as dtype are computed in: dtype itself for float dtypes, default (e.g. --volume_dtype) for integer ones.
+    """
+    return np.dtype(dtype) if np.dtype(dtype).kind == "f" else np.dtype(default)
+
+def compare_to_baseline(baseline, arr):
+    """
+    Numerical difference of arr (e.g. dequantized) from its float64 baseline: maximum and mean absolute error, RMSE and the maximum error relative to the range
+    of the baseline over the voxels/pixels finite in both, and the number of them finite in only one.
+    """
+    baseline, arr = np.asarray(baseline, dtype=np.float64), np.asarray(arr, dtype=np.float64)
+    finite = np.isfinite(baseline)
+    valid = finite & np.isfinite(arr)
+    error = np.abs(arr[valid] - baseline[valid])
+    value_range = float(np.ptp(baseline[valid])) if error.size else 0.
+    max_error = float(np.max(error)) if error.size else 0.
+    return {"max_abs_error": max_error, "mean_abs_error": float(np.mean(error)) if error.size else 0., "rmse": float(np.sqrt(np.mean(np.square(error)))) if error.size else 0.,
+        "max_rel_error": max_error / value_range if value_range > 0 else 0., "non_finite_mismatch": int(np.count_nonzero(finite != np.isfinite(arr)))}
+
+def get_nii_extension(args):
+    """
+    Extension of the NIfTI volumes written by the scripts: ".nii.gz" or ".nii" (uncompressed) as set by --nifti_format.
+    """
+    return "." + getattr(args, "nifti_format", "nii.gz")
+
+def save_npy_nii(ref_path, arr, save_path, writer=None, dtype=None):
+    """
+    Save arr as a NIfTI volume with the header of ref_path, with writer (nifti_writer.NiftiWriter, the file is then written asynchronously) or at once.
+    dtype - Stored dtype (default: the dtype of arr), see NiftiWriter.
+    """
+    if writer is not None:
+        return writer.write(ref_path, arr, save_path, dtype)
+    from nifti_writer import NiftiWriter #nifti_writer imports utils
+    with NiftiWriter() as writer:
+        writer.write(ref_path, arr, save_path, dtype)
+
+def save_all_nii(path_ref, save_path, arr_B, arr_LT, arr_AT, arr_A, prefix, writer=None, extension=".nii.gz", dtype=None):
+    save_npy_nii(path_ref, arr_B, os.path.join(save_path, str(prefix) + "_bone" + extension), writer, dtype)
+    save_npy_nii(path_ref, arr_LT, os.path.join(save_path, str(prefix) + "_lean_tissue" + extension), writer, dtype)
+    save_npy_nii(path_ref, arr_AT, os.path.join(save_path, str(prefix) + "_adipose_tissue" + extension), writer, dtype)
+    save_npy_nii(path_ref, arr_A, os.path.join(save_path, str(prefix) + "_air" + extension), writer, dtype)
 
 def preprocess_CT_HU_values(arr):
 	return arr - np.min(arr)
 
+def get_label_map_path(args, pat_ID, scan_date):
+    """
+    Path of the tissue label map of one scan, written by the 3D channel generation when --channel_storage is "label_map".
+    """
+    return os.path.join(args.path_multi_channel_3D_CT_SUV, "3D_CT_SUV_Data", pat_ID, scan_date, "tissue_labels" + get_nii_extension(args))
+
+def get_channel_paths(args, pat_ID, scan_date):
+    """
+    Paths of the eight masked SUV/CT volumes of one scan, written by the 3D channel generation when --channel_storage is "channels" (see save_all_nii).
+    Returns {"CT_bone": path, ..., "SUV_air": path}.
+    """
+    save_path = os.path.join(args.path_multi_channel_3D_CT_SUV, "3D_CT_SUV_Data", pat_ID, scan_date)
+    return {prefix + "_" + tissue: os.path.join(save_path, prefix + "_" + tissue + get_nii_extension(args)) for prefix in ("CT", "SUV") for tissue in TISSUE_TYPES}
+
+class TissueChannels:
+    """
+    Lazily materializes the multi-channel SUV and CT volumes of one scan from its tissue label map.
+
+    channels["SUV_bone"], channels["CT_lean_tissue"], ... - Channel names as written by save_all_nii (without ".nii.gz").
+    channels["SUV"], channels["CT"] - Original volumes.
+    The CT, SUV and label map volumes are read on first use and kept, the channels are computed on every request.
+    """
+    def __init__(self, path_label_map, path_CT, path_SUV, dtype=np.float32):
+        self.paths = {"labels": path_label_map, "CT": path_CT, "SUV": path_SUV}
+        self.dtype = dtype
+        self.volumes = {}
+
+    def keys(self):
+        return [modality + "_" + tissue for modality in ("SUV", "CT") for tissue in TISSUE_TYPES]
+
+    def volume(self, name):
+        if name not in self.volumes:
+            self.volumes[name] = read_nii(self.paths[name])
+        return self.volumes[name]
+
+    @profiled("mask")
+    def __getitem__(self, name):
+        if name in ("CT", "SUV"):
+            return self.volume(name)
+        modality, tissue = name.split("_", 1)
+        arr = self.volume(modality)
+        channel = np.zeros(arr.shape, dtype=self.dtype)
+        np.copyto(channel, arr, where=self.volume("labels") == TISSUE_TYPES.index(tissue) + 1, casting="unsafe")
+        return channel
+
+
+@profiled("encode")
 def save_MIP(save_path, Data, factor=1.):
     """
     Save the Image using PIL.
@@ -71,6 +864,7 @@ def save_MIP(save_path, Data, factor=1.):
     im = (factor * MIP_img).astype(np.uint8)
     im = Image.fromarray(im).convert('RGB')
     im.save(save_path)
+    profile_io(save_path, "written")
 
 def generate_MIPs_PET(Data, type_MIP, intensity_type, img_type):
     """
@@ -166,193 +960,321 @@ def get_contours(img):
     temp_edge = np.asarray(temp_edge, dtype=np.uint8)
     return temp_edge
 
-def create_collage(path_c, path_s, save_path):
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    for MIP in os.listdir(path_c):
-        image1 = Image.open(os.path.join(path_c, MIP))
-        image2 = Image.open(os.path.join(path_s, MIP))
-        collage = Image.new('RGB', (image1.size[0]*2, image1.size[1]))
-        # Paste the first image onto the collage
-        collage.paste(image1, (0, 0))
-        # Paste the second image onto the collage
-        collage.paste(image2, (image1.size[0], 0))
-
-        # Save the collage
-        collage.save(os.path.join(save_path, MIP))
-
-def create_final_collage(path, save_path, pat_ID):
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    image1 = Image.open(os.path.join(path, "MIP_SUV.jpg"))
-    image2 = Image.open(os.path.join(path, "MIP_SUV_bone.jpg"))
-    image3 = Image.open(os.path.join(path, "MIP_SUV_lean.jpg"))
-    image4 = Image.open(os.path.join(path, "MIP_SUV_adipose.jpg"))
-    image5 = Image.open(os.path.join(path, "MIP_SUV_air.jpg"))
-    image6 = Image.open(os.path.join(path, "MIP_SUV_SEG.jpg"))
-    image7 = Image.open(os.path.join(path, "SIP_SUV_SEG.jpg"))
-
-    image8 = Image.open(os.path.join(path, "SIP_CT.jpg"))
-    image9 = Image.open(os.path.join(path, "SIP_CT_bone.jpg"))
-    image10 = Image.open(os.path.join(path, "SIP_CT_lean.jpg"))
-    image11 = Image.open(os.path.join(path, "SIP_CT_adipose.jpg"))
-    image12 = Image.open(os.path.join(path, "SIP_CT_air.jpg"))
-    image13 = Image.open(os.path.join(path, "MIP_CT_SEG.jpg"))
-    image14 = Image.open(os.path.join(path, "SIP_CT_SEG.jpg"))
-
-    collage = Image.new('RGB', (image1.size[0]*7, image1.size[1]*2))
-
-    # Paste SUV
-    collage.paste(image1, (0, 0))
-    collage.paste(image2, (image1.size[0]*1, 0))
-    collage.paste(image3, (image1.size[0]*2, 0))
-    collage.paste(image4, (image1.size[0]*3, 0))
-    collage.paste(image5, (image1.size[0]*4, 0))
-    collage.paste(image6, (image1.size[0]*5, 0))
-    collage.paste(image7, (image1.size[0]*6, 0))
-
-    # # Paste CT
-    collage.paste(image8, (0, image1.size[1]))
-    collage.paste(image9, (image1.size[0]*1, image1.size[1]))
-    collage.paste(image10, (image1.size[0]*2, image1.size[1]))
-    collage.paste(image11, (image1.size[0]*3, image1.size[1]))
-    collage.paste(image12, (image1.size[0]*4, image1.size[1]))
-    collage.paste(image13, (image1.size[0]*5, image1.size[1]))
-    collage.paste(image14, (image1.size[0]*6, image1.size[1]))
-
-    # Save the collage
-    collage.save(os.path.join(save_path, pat_ID + ".jpg"))
-
-
-def generate_SUV_CT_collage(args, SEG_arr, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, save_path, pat_ID, scan_date, disease_type):
+def orient_collage_projection(MIP, type_MIP, img_type=None):
+    """
+    Normalize a collage projection to (0,1) (inverted if img_type is "negative") and rotate/flip it like generate_MIPs_PET/generate_MIPs_CT.
+    img_type None only rotates/flips the projection (segmentation, see generate_MIPs_Seg).
+    """
+    MIP = MIP.astype("float")
+    if img_type is not None:
+        MIP = MIP/np.max(MIP)# Pixel Normalization, value ranges b/w (0,1).
+    if img_type == "negative":
+        MIP = np.absolute(MIP - np.amax(MIP))
+    MIP = cv2.rotate(MIP, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    if type_MIP == "saggital":
+        MIP = np.flip(MIP, 1)
+    return MIP
+
+def min_max_normalize(MIP):
+    return (MIP - np.min(MIP)) / (np.max(MIP) - np.min(MIP))
+
+def render_collage_projections(args, SEG_arr, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, bbox=None, stats=None, lesions=None):
+    """
+    Compute the 14 projections of the collage for every view in args.MIP_types.
+
+    Every volume is reduced once per view and all the views are computed together: the max projections of SUV are clipped after the reduction
+    (same result as clipping the volume), min(CT) is computed once and shared, and the shifted CT channels (arr - min(arr)) are written to one reused buffer
+    instead of new arrays. The lesion SUV/CT projections and the SEG projections are accumulated over the lesion voxels only (see LesionVoxels).
+    With the body bounding box of the scan (see get_body_bbox), the channels that are zero outside it (bone, lean, adipose) are only reduced inside it.
+    With the statistics of the scan (see compute_scan_statistics), the minima of the CT channels are looked up instead of computed.
+    lesions - Optional LesionVoxels of SEG (built from SEG_arr if not given, SEG_arr is then not read).
+    Returns {view: {name: projection}}, the same images as generate_MIPs_PET/generate_MIPs_CT (before save_MIP), up to float rounding of the lesion sums.
+    """
+    P = reduce_collage_projections(args, SEG_arr, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, bbox=bbox, stats=stats, lesions=lesions)
+    return finish_collage_projections(P)
+
+@profiled("render")
+def reduce_collage_projections(args, SEG_arr, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, bbox=None, stats=None, lows=None, lesions=None):
+    """
+    Reductions of the volumes along every view of render_collage_projections, before they are normalized and oriented (see finish_collage_projections).
+    lows - Optional minima of the shifted CT channels ({"CT_lean_tissue", "CT_adipose_tissue", "CT_air", "CT", "CT_lesion"}), e.g. of the whole volume when reducing
+    one slab of it (the reductions of consecutive z slabs are then consecutive columns of the reductions of the volume, see generate_tissue_channels_slabs).
+    """
+    if lesions is None:
+        lesions = LesionVoxels.from_volume(SEG_arr)
+    axes = {i: 1 if i == "coronal" else 0 for i in args.MIP_types}
+    P = {i: {} for i in axes}
+    roi = (slice(None),) * 3 if bbox is None else get_roi(bbox)
+    cropped = bbox is not None and tuple(bbox) != tuple((0, n) for n in CT_arr.shape)
+
+    def reduce(arr, axis, reduction, outside=0.):
+        #arr is the roi of a volume equal to outside everywhere else
+        return reduction(arr, axis=axis) if bbox is None else reduce_roi(arr, CT_arr.shape, bbox, axis, reduction, outside)
+
+    #SUV max projections
+    for name, arr, inside in (("MIP_SUV_bone", SUV_arr_B, True), ("MIP_SUV_lean", SUV_arr_LT, True), ("MIP_SUV_adipose", SUV_arr_AT, True), ("MIP_SUV_air", SUV_arr_A, False), ("MIP_SUV", SUV_arr, False)):
+        for i, axis in axes.items():
+            P[i][name] = np.clip(reduce(arr[roi], axis, np.max) if inside else np.max(arr, axis=axis), 0, 14)
+    SUV_L = np.clip(lesions.gather(SUV_arr), 0, 14)
+    for i, axis in axes.items():
+        P[i]["MIP_SUV_SEG"] = lesions.project(SUV_L, axis, np.max)
+        P[i]["SIP_SUV_SEG"] = lesions.project(SUV_L, axis, np.sum)
+    del SUV_L
+
+    #CT sum projections
+    for i, axis in axes.items():
+        P[i]["SIP_CT_bone"] = reduce(CT_arr_B[roi], axis, np.sum)
+    buffer = np.empty(CT_arr.shape, dtype=np.result_type(CT_arr, CT_arr_LT, CT_arr_AT, CT_arr_A))
+    buffer_roi = np.empty(tuple(end - start for start, end in bbox), dtype=buffer.dtype) if cropped else buffer
+    for name, channel, arr, inside in (("SIP_CT_lean", "CT_lean_tissue", CT_arr_LT[roi], True), ("SIP_CT_adipose", "CT_adipose_tissue", CT_arr_AT[roi], True), ("SIP_CT_air", "CT_air", CT_arr_A, False),
+            ("SIP_CT", "CT", CT_arr, False)):
+        low = get_collage_low(channel, arr, lows, stats, inside and cropped)
+        shifted = np.subtract(arr, low, out=(buffer_roi if inside else buffer) if buffer.dtype == arr.dtype else None)
+        for i, axis in axes.items():
+            P[i][name] = reduce(shifted, axis, np.sum, -low) if inside else np.sum(shifted, axis=axis)
+    del buffer, buffer_roi, shifted
+
+    #Lesion CT projections (CT * SEG, shifted by its minimum) and SEG projections, 0 and -min outside the lesions
+    CT_L = lesions.gather(CT_arr)
+    low = get_collage_low("CT_lesion", CT_L, lows, stats) if lows is not None or stats is not None else lesions.reduce(CT_L, np.min)
+    CT_L -= low
+    for i, axis in axes.items():
+        P[i]["SIP_CT_SEG"] = lesions.project(CT_L, axis, np.sum, -low)
+        P[i]["MIP_CT_SEG"] = lesions.project(CT_L, axis, np.max, -low)
+        P[i]["MIP_SEG"] = lesions.project(lesions.values, axis, np.max)
+    return P
+
+def get_collage_low(channel, arr, lows=None, stats=None, cropped=False):
+    """
+    Minimum of a shifted CT channel of the collage (see reduce_collage_projections): from lows or stats if given, else of arr (a roi cropped from a volume that is 0 outside it if cropped).
+    """
+    if lows is not None:
+        return np.asarray(lows[channel], dtype=arr.dtype)[()]
+    if stats is not None:
+        return np.asarray(get_channel_min(stats, channel), dtype=arr.dtype)[()]
+    return np.minimum(np.min(arr), 0) if cropped else np.min(arr)
+
+def finish_collage_projections(P):
+    """
+    Normalize and orient the reductions {view: {name: projection}} of render_collage_projections (and of the SEG, "MIP_SEG") into the collage projections.
+    """
+    projections = {}
+    for i in P:
+        MIP_SEG = orient_collage_projection(P[i]["MIP_SEG"], i)
+        projections[i] = {}
+        for name in ("MIP_SUV_bone", "MIP_SUV_lean", "MIP_SUV_adipose", "MIP_SUV_air", "MIP_SUV", "MIP_SUV_SEG", "SIP_SUV_SEG"):
+            projections[i][name] = orient_collage_projection(P[i][name], i, "negative")
+        for name in ("SIP_CT_bone", "SIP_CT_lean", "SIP_CT_adipose", "SIP_CT_air"):
+            projections[i][name] = min_max_normalize(orient_collage_projection(P[i][name], i, "positive" if name == "SIP_CT_adipose" else "negative"))
+        projections[i]["SIP_CT"] = orient_collage_projection(P[i]["SIP_CT"], i, "positive")
+        for name in ("SIP_CT_SEG", "MIP_CT_SEG"):
+            MIP_CT_SEG = min_max_normalize(orient_collage_projection(P[i][name], i, "negative"))*MIP_SEG
+            projections[i][name] = np.absolute(MIP_CT_SEG - np.amax(MIP_CT_SEG))
+    return projections
+
+#Projections of the final collage: SUV in the first row, CT in the second one
+COLLAGE_LAYOUT = [["MIP_SUV", "MIP_SUV_bone", "MIP_SUV_lean", "MIP_SUV_adipose", "MIP_SUV_air", "MIP_SUV_SEG", "SIP_SUV_SEG"],
+                  ["SIP_CT", "SIP_CT_bone", "SIP_CT_lean", "SIP_CT_adipose", "SIP_CT_air", "MIP_CT_SEG", "SIP_CT_SEG"]]
+
+def get_collage_frame(Data, crop=85):
+    """
+    Convert a projection in (0,1) to the 8-bit image saved by save_MIP (same [:,85:-85] crop, or crop columns on both sides, e.g. fewer for a preview).
+    """
+    return (255. * Data[:,crop:Data.shape[1]-crop]).astype(np.uint8)
+
+def compose_collage(frames, MIP_types, layout=COLLAGE_LAYOUT):
+    """
+    Compose a collage from the frames (see get_collage_frame) of every view in one preallocated canvas: one cell per projection of layout,
+    with the views side by side in each cell.
+    """
+    height, width = frames[MIP_types[0]][layout[0][0]].shape
+    cell_width = width*len(MIP_types)
+    canvas = np.zeros((height*len(layout), cell_width*len(layout[0])), dtype=np.uint8)
+    for r, row in enumerate(layout):
+        for c, name in enumerate(row):
+            for v, i in enumerate(MIP_types):
+                frame = frames[i][name][:height, :cell_width - v*width]
+                canvas[r*height:r*height + frame.shape[0], c*cell_width + v*width:c*cell_width + v*width + frame.shape[1]] = frame
+    return canvas
+
+@profiled("encode")
+def save_collage_image(save_path, img):
+    """
+    Save an 8-bit grayscale image as RGB using PIL, atomically.
+    """
+    path_temp = get_temp_path(save_path)
+    Image.fromarray(img).convert('RGB').save(path_temp, format="JPEG")
+    os.replace(path_temp, save_path)
+    profile_io(save_path, "written")
+
+def generate_SUV_CT_collage(args, SEG_arr, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, save_path, pat_ID, scan_date, disease_type, save_intermediates=False, bbox=None, stats=None, lesions=None):
     """
     B - Bone; LT - Lean Tissue; AT - Adipose Tissue; A - Air; L - Lesion
+    bbox, stats, lesions - Optional body bounding box, statistics and LesionVoxels of the scan (see render_collage_projections).
+
+    The final collage (save_path/Collages/<diagnosis>_<pat_ID>_<scan_date>.jpg) is composed in memory and is the only image written,
+    unless save_intermediates is set (also writes the projections of every view to save_path/MIPs/<pat_ID>_<scan_date>/<view>/ and the per-projection collages to .../collages/).
     """
-    #save_path_MIP = os.path.join(save_path, "Visualization", "MIPs", pat_ID + "_" + scan_date)
-    save_path_MIP = os.path.join(save_path, "MIPs", pat_ID + "_" + scan_date)
-    if not os.path.exists(save_path_MIP):
-        os.makedirs(save_path_MIP)
-
-    SUV_arr_L = SUV_arr*SEG_arr
-    CT_arr_L = CT_arr*SEG_arr
-    CT_arr_LT, CT_arr_AT, CT_arr_A, CT_arr_L = preprocess_CT_HU_values(CT_arr_LT), preprocess_CT_HU_values(CT_arr_AT), preprocess_CT_HU_values(CT_arr_A), preprocess_CT_HU_values(CT_arr_L)
-
-    #MIP_types = ["coronal", "saggital"]
-    MIP_types = args.MIP_types
-
-    for i in MIP_types:
-        save_path_MIP_temp = os.path.join(save_path_MIP, i)
-        if not os.path.exists(save_path_MIP_temp):
-            os.makedirs(save_path_MIP_temp)
-
-        P_SUV_bone = generate_MIPs_PET(SUV_arr_B, i, intensity_type="max", img_type="negative")
-        save_MIP(os.path.join(save_path_MIP_temp, "MIP_SUV_bone.jpg"), P_SUV_bone, factor=1.)
-        P_CT_bone = generate_MIPs_CT(CT_arr_B, i, intensity_type="sum", img_type="negative")
-        P_CT_bone = (P_CT_bone - np.min(P_CT_bone)) / (np.max(P_CT_bone) - np.min(P_CT_bone))
-        save_MIP(os.path.join(save_path_MIP_temp, "SIP_CT_bone.jpg"), P_CT_bone, factor=1.)
-
-        P_SUV_lean = generate_MIPs_PET(SUV_arr_LT, i, intensity_type="max", img_type="negative")
-        save_MIP(os.path.join(save_path_MIP_temp, "MIP_SUV_lean.jpg"), P_SUV_lean, factor=1.)
-        P_CT_lean = generate_MIPs_CT(CT_arr_LT, i, intensity_type="sum", img_type="negative")
-        P_CT_lean = (P_CT_lean - np.min(P_CT_lean)) / (np.max(P_CT_lean) - np.min(P_CT_lean))
-        save_MIP(os.path.join(save_path_MIP_temp, "SIP_CT_lean.jpg"), P_CT_lean, factor=1.)
-
-        P_SUV_adipose = generate_MIPs_PET(SUV_arr_AT, i, intensity_type="max", img_type="negative")
-        save_MIP(os.path.join(save_path_MIP_temp, "MIP_SUV_adipose.jpg"), P_SUV_adipose, factor=1.)
-        P_CT_adipose = generate_MIPs_CT(CT_arr_AT, i, intensity_type="sum", img_type="positive")
-        P_CT_adipose = (P_CT_adipose - np.min(P_CT_adipose)) / (np.max(P_CT_adipose) - np.min(P_CT_adipose))
-        save_MIP(os.path.join(save_path_MIP_temp, "SIP_CT_adipose.jpg"), P_CT_adipose, factor=1.)
-        
-        P_SUV_air = generate_MIPs_PET(SUV_arr_A, i, intensity_type="max", img_type="negative")
-        #P_SUV_air = (P_SUV_air - np.min(P_SUV_air)) / (np.max(P_SUV_air) - np.min(P_SUV_air))
-        save_MIP(os.path.join(save_path_MIP_temp, "MIP_SUV_air.jpg"), P_SUV_air, factor=1.)
-        P_CT_air = generate_MIPs_CT(CT_arr_A, i, intensity_type="sum", img_type="negative")
-        P_CT_air = (P_CT_air - np.min(P_CT_air)) / (np.max(P_CT_air) - np.min(P_CT_air))
-        save_MIP(os.path.join(save_path_MIP_temp, "SIP_CT_air.jpg"), P_CT_air, factor=1.)
-
-        MIP_SUV = generate_MIPs_PET(SUV_arr, i, intensity_type="max", img_type="negative")
-        save_MIP(os.path.join(save_path_MIP_temp, "MIP_SUV.jpg"), MIP_SUV, factor=1.)
-        MIP_SUV_SEG = generate_MIPs_PET(SUV_arr_L, i, intensity_type="max", img_type="negative")
-        save_MIP(os.path.join(save_path_MIP_temp, "MIP_SUV_SEG.jpg"), MIP_SUV_SEG, factor=1.)
-
-        MIP_SUV_SEG = generate_MIPs_PET(SUV_arr_L, i, intensity_type="sum", img_type="negative")
-        save_MIP(os.path.join(save_path_MIP_temp, "SIP_SUV_SEG.jpg"), MIP_SUV_SEG, factor=1.)
-
-        CT_arr_new = CT_arr - np.min(CT_arr)
-        MIP_CT = generate_MIPs_CT(CT_arr_new, i, intensity_type="sum", img_type="positive")
-        save_MIP(os.path.join(save_path_MIP_temp, "SIP_CT.jpg"), MIP_CT, factor=1.)
-
-        MIP_CT_SEG = generate_MIPs_CT(CT_arr_L, i, intensity_type="sum", img_type="negative")
-        MIP_SEG = generate_MIPs_Seg(SEG_arr, i)
-        MIP_CT_SEG = (MIP_CT_SEG - np.min(MIP_CT_SEG)) / (np.max(MIP_CT_SEG) - np.min(MIP_CT_SEG))
-        MIP_CT_SEG_new = MIP_CT_SEG*MIP_SEG
-        MIP_CT_SEG_new = np.absolute(MIP_CT_SEG_new - np.amax(MIP_CT_SEG_new))
-        save_MIP(os.path.join(save_path_MIP_temp, "SIP_CT_SEG.jpg"), MIP_CT_SEG_new, factor=1.)
-
-        MIP_CT_SEG = generate_MIPs_CT(CT_arr_L, i, intensity_type="max", img_type="negative")
-        MIP_SEG = generate_MIPs_Seg(SEG_arr, i)
-        MIP_CT_SEG = (MIP_CT_SEG - np.min(MIP_CT_SEG)) / (np.max(MIP_CT_SEG) - np.min(MIP_CT_SEG))
-        MIP_CT_SEG_new = MIP_CT_SEG*MIP_SEG
-        MIP_CT_SEG_new = np.absolute(MIP_CT_SEG_new - np.amax(MIP_CT_SEG_new))
-        save_MIP(os.path.join(save_path_MIP_temp, "MIP_CT_SEG.jpg"), MIP_CT_SEG_new, factor=1.)
-
-    path_collages = os.path.join(save_path_MIP, "collages")
-    path_c = os.path.join(save_path_MIP, "coronal")
-    path_s = os.path.join(save_path_MIP, "saggital")
-    create_collage(path_c, path_s, path_collages)
-    create_final_collage(path_collages, os.path.join(save_path, "Collages"), disease_type + "_" + pat_ID + "_" + scan_date)
-
-def preprocess_df(df, args):
-    #Bone HU window
-    df["SUV_bone"] = df["SUV"]
-    df["SUV_bone"] = df["SUV_bone"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["SUV_bone"] = df["SUV_bone"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["SUV_bone"] = df["SUV_bone"].str.replace("SUV.nii.gz", "SUV_bone.nii.gz")
-
-    df["CT_bone"] = df["CT"]
-    df["CT_bone"] = df["CT_bone"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["CT_bone"] = df["CT_bone"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["CT_bone"] = df["CT_bone"].str.replace("CTres.nii.gz", "CT_bone.nii.gz")
-
-    #Lean HU window
-    df["SUV_lean"] = df["SUV"]
-    df["SUV_lean"] = df["SUV_lean"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["SUV_lean"] = df["SUV_lean"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["SUV_lean"] = df["SUV_lean"].str.replace("SUV.nii.gz", "SUV_lean_tissue.nii.gz")
-
-    df["CT_lean"] = df["CT"]
-    df["CT_lean"] = df["CT_lean"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["CT_lean"] = df["CT_lean"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["CT_lean"] = df["CT_lean"].str.replace("CTres.nii.gz", "CT_lean_tissue.nii.gz")
-
-    #Adipose HU window
-    df["SUV_adipose"] = df["SUV"]
-    df["SUV_adipose"] = df["SUV_adipose"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["SUV_adipose"] = df["SUV_adipose"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["SUV_adipose"] = df["SUV_adipose"].str.replace("SUV.nii.gz", "SUV_adipose_tissue.nii.gz")
-
-    df["CT_adipose"] = df["CT"]
-    df["CT_adipose"] = df["CT_adipose"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["CT_adipose"] = df["CT_adipose"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["CT_adipose"] = df["CT_adipose"].str.replace("CTres.nii.gz", "CT_adipose_tissue.nii.gz")
-
-    #Air HU window
-    df["SUV_air"] = df["SUV"]
-    df["SUV_air"] = df["SUV_air"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["SUV_air"] = df["SUV_air"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["SUV_air"] = df["SUV_air"].str.replace("SUV.nii.gz", "SUV_air.nii.gz")
-
-    df["CT_air"] = df["CT"]
-    df["CT_air"] = df["CT_air"].str.replace("/media/sambit/HDD/Sambit/Projects/U-CAN/autoPET_2022/Data/FDG-PET-CT-Lesions", "/media/sambit/HDD/Sambit/Projects/Project_5/Framework/Data_Preparation/Output/3D_CT_SUV_Data")
-    #df["CT_air"] = df["CT_air"].str.replace(args.data_path, args.path_multi_channel_3D_CT_SUV)
-    df["CT_air"] = df["CT_air"].str.replace("CTres.nii.gz", "CT_air.nii.gz")
+    #All the projections of both views at once (see render_collage_projections)
+    projections = render_collage_projections(args, SEG_arr, SUV_arr, SUV_arr_B, SUV_arr_LT, SUV_arr_AT, SUV_arr_A, CT_arr, CT_arr_B, CT_arr_LT, CT_arr_AT, CT_arr_A, bbox=bbox, stats=stats, lesions=lesions)
+    frames = {i: {name: get_collage_frame(MIP) for name, MIP in P.items()} for i, P in projections.items()}
+    save_SUV_CT_collage(frames, save_path, pat_ID, scan_date, disease_type, save_intermediates=save_intermediates)
 
-    return df
+def save_SUV_CT_collage(frames, save_path, pat_ID, scan_date, disease_type, save_intermediates=False):
+    """
+    Save the collage of the frames {view: {name: frame}} rendered by generate_SUV_CT_collage (see get_collage_frame).
+    """
+    MIP_types = list(frames)
+    if save_intermediates:
+        #save_path_MIP = os.path.join(save_path, "Visualization", "MIPs", pat_ID + "_" + scan_date)
+        save_path_MIP = os.path.join(save_path, "MIPs", pat_ID + "_" + scan_date)
+        for i in MIP_types:
+            os.makedirs(os.path.join(save_path_MIP, i), exist_ok=True)
+            for name, frame in frames[i].items():
+                save_collage_image(os.path.join(save_path_MIP, i, name + ".jpg"), frame)
+        os.makedirs(os.path.join(save_path_MIP, "collages"), exist_ok=True)
+        for name in frames[MIP_types[0]]:
+            save_collage_image(os.path.join(save_path_MIP, "collages", name + ".jpg"), compose_collage(frames, MIP_types, layout=[[name]]))
+
+    os.makedirs(os.path.join(save_path, "Collages"), exist_ok=True)
+    save_collage_image(os.path.join(save_path, "Collages", disease_type + "_" + pat_ID + "_" + scan_date + ".jpg"), compose_collage(frames, MIP_types))
+
+def generate_tissue_channels_slabs(args, path_CT, path_SUV, path_SEG, slab_size, writer=None, save_path=None, path_label_map=None, dtype=np.float32, save_dtype=None, collage=True, roi=False):
+    """
+    Out-of-core generate_tissue_channels, with the collage projections and the body bounding box of the scan: CT, SUV and SEG are read slab by slab of slab_size
+    z planes (see read_nii_slabs) and only one slab of every volume and of its channels is held in memory, whatever the size of the scan.
+
+    The channels of every slab are written as they are computed (see nifti_writer.NiftiWriter.open_slabs) to save_path (the eight volumes of save_all_nii) or to path_label_map
+    (the tissue label map), and the collage projections are reduced along x or y per slab (see reduce_collage_projections). A first pass over the slabs computes what
+    depends on the whole volume: the minima of the shifted CT channels of the collage, the range of the channels stored as an integer save_dtype and the body profiles,
+    and keeps the lesion voxels of every slab (see LesionVoxels), so that SEG is only read once. Without path_SEG (e.g. a NEGATIVE scan) the scan has no lesion and no SEG is read.
+    The outputs are identical to the in-memory generate_tissue_channels, save_all_nii and render_collage_projections (up to float rounding of the lesion sums).
+    Returns the collage projections (None unless collage) and the body bounding box (None unless roi, see get_body_bbox).
+    """
+    shape = get_nii_shape(path_CT)
+    extension = get_nii_extension(args)
+    channel_names = [prefix + "_" + tissue for prefix in ("SUV", "CT") for tissue in TISSUE_TYPES] #Order of generate_tissue_channels
+    save_dtype = np.dtype(dtype if save_dtype is None else save_dtype)
+    quantized = save_path is not None and save_dtype.kind != "f" and np.dtype(dtype).kind == "f"
+    with_SEG = (collage or roi) and path_SEG is not None
+
+    def read_slabs(with_SEG=False):
+        SEG_slabs = read_nii_slabs(path_SEG, slab_size) if with_SEG else itertools.repeat((None, None, None))
+        for (z0, z1, CT_arr), (_, _, SUV_arr), (_, _, SEG_arr) in zip(read_nii_slabs(path_CT, slab_size), read_nii_slabs(path_SUV, slab_size), SEG_slabs):
+            yield z0, z1, CT_arr, SUV_arr, SEG_arr
+
+    #First pass: minima, channel ranges, body profiles and lesion voxels (z0 -> LesionVoxels of the slab) of the whole volume
+    lows, ranges = {}, [[np.inf, -np.inf, True] for _ in channel_names]
+    profiles = [np.zeros(shape[0], dtype=bool), np.zeros(shape[1], dtype=bool), np.zeros(shape[2], dtype=bool)]
+    lesions = {}
+    if collage or roi or quantized:
+        for z0, z1, CT_arr, SUV_arr, SEG_arr in read_slabs(with_SEG):
+            lesions[z0] = LesionVoxels.empty(CT_arr.shape) if SEG_arr is None else LesionVoxels.from_volume(SEG_arr)
+            channels = generate_tissue_channels(CT_arr, SUV_arr, args, dtype=dtype)
+            if collage:
+                for name, low in (("CT_lean_tissue", np.min(channels[5])), ("CT_adipose_tissue", np.min(channels[6])), ("CT_air", np.min(channels[7])), ("CT", np.min(CT_arr)),
+                        ("CT_lesion", lesions[z0].reduce(lesions[z0].gather(CT_arr), np.min))):
+                    lows[name] = low if name not in lows else np.minimum(lows[name], low)
+            if quantized:
+                for k, channel in enumerate(channels):
+                    ranges[k] = [min(ranges[k][0], np.min(channel)), max(ranges[k][1], np.max(channel)), ranges[k][2] and is_integral(channel)]
+            if roi:
+                mask = get_body_mask(CT_arr, args, lesions=lesions[z0])
+                mask_xy = np.any(mask, axis=2)
+                profiles[0] |= np.any(mask_xy, axis=1)
+                profiles[1] |= np.any(mask_xy, axis=0)
+                profiles[2][z0:z1] = np.any(mask, axis=(0,1))
+                del mask, mask_xy
+            del channels
+
+    #Second pass: channels written and collage projections reduced slab by slab
+    reductions = []
+    with contextlib.ExitStack() as files:
+        if path_label_map is not None:
+            files_labels = files.enter_context(writer.open_slabs(path_CT, shape, path_label_map, np.uint8))
+        elif save_path is not None:
+            files_channels = [files.enter_context(writer.open_slabs(path_SUV if name.startswith("SUV") else path_CT, shape, os.path.join(save_path, name + extension), save_dtype,
+                get_quantization(save_dtype, low, high, integral=integral) if quantized else None)) for name, (low, high, integral) in zip(channel_names, ranges)]
+        if path_label_map is not None or save_path is not None or collage:
+            for z0, z1, CT_arr, SUV_arr, _ in read_slabs():
+                channels, label_map = generate_tissue_channels(CT_arr, SUV_arr, args, dtype=dtype, return_label_map=True)
+                if path_label_map is not None:
+                    files_labels.write(label_map)
+                elif save_path is not None:
+                    for f, channel in zip(files_channels, channels):
+                        f.write(channel)
+                if collage:
+                    reductions.append(reduce_collage_projections(args, None, SUV_arr, *channels[:4], CT_arr, *channels[4:], lows=lows, lesions=lesions[z0]))
+                del channels, label_map
+
+    #The reductions of consecutive slabs are consecutive columns (z is the last axis of both views)
+    projections = finish_collage_projections({i: {name: np.concatenate([P[i][name] for P in reductions], axis=-1) for name in reductions[0][i]} for i in reductions[0]}) if collage else None
+    return projections, get_bbox_from_profiles(profiles, args) if roi else None
+
+def downsample_volume(arr, factor, reduction=np.max, dtype=None):
+    """
+    Downsample a volume by an integer factor along every axis, reducing every factor^3 block with reduction (e.g. np.max, np.mean).
+    The volume is padded with its border values up to a multiple of factor, so that no voxel is dropped.
+    """
+    pad = [(0, -n % factor) for n in arr.shape]
+    if any(after for _, after in pad):
+        arr = np.pad(arr, pad, mode="edge")
+    X, Y, Z = arr.shape
+    blocks = arr.reshape(X // factor, factor, Y // factor, factor, Z // factor, factor)
+    return reduction(blocks, axis=(1, 3, 5)) if dtype is None else reduction(blocks, axis=(1, 3, 5), dtype=dtype)
+
+def build_preview_pyramid(CT_arr, SUV_arr, SEG_arr, factors=(2, 4)):
+    """
+    Preview pyramid of a scan for fast QC collages: CT, SUV and SEG downsampled by every factor, CT averaged and SUV and SEG max-pooled (so that hot
+    lesions and small segmentations are kept). Every level is computed from the previous one when its factor divides the next (mean of means, max of maxima).
+    Returns {factor: (CT, SUV, SEG)} with CT/SUV as float32 and SEG as uint8.
+    """
+    pyramid = {}
+    level, volumes = 1, (CT_arr, SUV_arr, SEG_arr)
+    for factor in sorted(factors):
+        if factor % level:
+            level, volumes = 1, (CT_arr, SUV_arr, SEG_arr)
+        CT, SUV, SEG = volumes
+        step = factor // level
+        volumes = (downsample_volume(CT, step, np.mean, dtype=np.float32).astype(np.float32, copy=False), downsample_volume(SUV, step).astype(np.float32, copy=False),
+            downsample_volume(SEG, step).astype(np.uint8, copy=False))
+        pyramid[factor], level = volumes, factor
+    return pyramid
+
+def save_preview_pyramid(path, pyramid):
+    """
+    Save a preview pyramid (see build_preview_pyramid) as one compressed .npz ("CT_<factor>", "SUV_<factor>", "SEG_<factor>"), atomically.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path_temp = get_temp_path(path)
+    with open(path_temp, "wb") as f:
+        np.savez_compressed(f, **{"{}_{}".format(name, factor): arr for factor, volumes in pyramid.items() for name, arr in zip(("CT", "SUV", "SEG"), volumes)})
+    os.replace(path_temp, path)
+    profile_io(path, "written")
+
+@profiled("load")
+def load_preview_level(path, factor):
+    """
+    (CT, SUV, SEG) of one level of the preview pyramid saved at path.
+    """
+    profile_io(path, "read")
+    with np.load(path) as f:
+        return tuple(f["{}_{}".format(name, factor)] for name in ("CT", "SUV", "SEG"))
 
-def preprocess_CT_HU_values(arr):
-    return arr - np.min(arr)
+def preprocess_CT_HU_values(arr, low=None):
+    """
+    Shift arr to start at 0; low is its minimum if already known (see get_channel_min).
+    """
+    return arr - (np.min(arr) if low is None else np.asarray(low, dtype=arr.dtype))
+
+def normalize_projection(MIP_PET):
+    """
+    Normalize a projection to (0,1), invert it and rotate it to the image orientation used for all the saved projections.
+    """
+    MIP_PET = MIP_PET/np.max(MIP_PET)# Pixel Normalization, value ranges b/w (0,1).
+    MIP_PET = np.absolute(MIP_PET - np.amax(MIP_PET))
+    MIP_PET = cv2.rotate(MIP_PET, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return MIP_PET
 
 def generate_MIPs_new(Data, suv_min, suv_max, intensity_type=None, img_type=None):
     """
@@ -375,10 +1297,7 @@ def generate_MIPs_new(Data, suv_min, suv_max, intensity_type=None, img_type=None
     elif intensity_type == "sum": 
         MIP_PET = np.sum(PET, axis=1).astype("float")
 
-    MIP_PET = MIP_PET/np.max(MIP_PET)# Pixel Normalization, value ranges b/w (0,1).
-    MIP_PET = np.absolute(MIP_PET - np.amax(MIP_PET))
-    MIP_PET = cv2.rotate(MIP_PET, cv2.ROTATE_90_COUNTERCLOCKWISE)
-    return MIP_PET
+    return normalize_projection(MIP_PET)
 
 def generate_MIPs_Seg_new(Data):
     """
@@ -391,27 +1310,235 @@ def generate_MIPs_Seg_new(Data):
     MIP_Seg = cv2.rotate(MIP_Seg, cv2.ROTATE_90_COUNTERCLOCKWISE)
     return MIP_Seg
 
-def generate_all_MIPs_SUV(save_path, SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, SEG, suv_min, suv_max, rot_min=-90, rot_max=90, rot_interval=1):
+@profiled("rotate")
+def get_rotation_plan(in_plane_shape, angle, order=3, roi=None):
+    """
+    Precompute the sampling geometry of a rotation by angle (degrees) in the (0,1) plane, with the same output plane shape and centering as scipy.ndimage.rotate(..., axes=(0,1), reshape=True).
+
+    in_plane_shape - Shape of the volume along axes 0 and 1.
+    order - Interpolation order: 0 (nearest) and 1 (linear) are sampled directly by project_volume, higher orders fall back to scipy.ndimage.rotate on slabs of the volume.
+    For order <= 1 the plan holds, for every output ray with at least one sample inside the volume, the flat (axis 0, axis 1) source indices and interpolation weights of its samples.
+    roi - Optional ((x0, x1), (y0, y1)) in-plane bounding box (order <= 1): only the samples inside it are indexed (into the cropped volume), the other
+    samples inside the volume are counted per ray in plan["n_volume"] - plan["counts"] (see the backgrounds of project_channels).
+    """
+    c, s = scipy.special.cosdg(angle), scipy.special.sindg(angle)
+    rot_matrix = np.array([[c, s], [-s, c]])
+    in_plane_shape = np.asarray(in_plane_shape)
+    iy, ix = in_plane_shape
+    out_bounds = rot_matrix @ [[0, 0, iy, iy], [0, ix, 0, ix]]
+    out_plane_shape = (np.ptp(out_bounds, axis=1) + 0.5).astype(int)
+    offset = (in_plane_shape - 1) / 2 - rot_matrix @ ((out_plane_shape - 1) / 2)
+
+    plan = {"angle": angle, "order": order, "in_shape": tuple(int(n) for n in in_plane_shape), "out_shape": tuple(int(n) for n in out_plane_shape)}
+    if order > 1:
+        return plan
+
+    #Input coordinates of every output pixel; samples outside the input are cval (0), as in mode="constant"
+    u, v = np.meshgrid(np.arange(out_plane_shape[0]), np.arange(out_plane_shape[1]), indexing="ij")
+    x = rot_matrix[0, 0] * u + rot_matrix[0, 1] * v + offset[0]
+    y = rot_matrix[1, 0] * u + rot_matrix[1, 1] * v + offset[1]
+    tol = 1e-6
+    valid = (x > -tol) & (x < iy - 1 + tol) & (y > -tol) & (y < ix - 1 + tol)
+    if roi is not None:
+        plan.update(roi=tuple(tuple(int(n) for n in bounds) for bounds in roi), n_volume=valid.sum(axis=1))
+        (x0, x1), (y0, y1) = roi
+        x, y, iy, ix = x - x0, y - y0, x1 - x0, y1 - y0
+        valid = (x > -tol) & (x < iy - 1 + tol) & (y > -tol) & (y < ix - 1 + tol)
+    x, y = x[valid], y[valid]
+
+    if order == 0:
+        i = np.clip(np.floor(x + 0.5), 0, iy - 1).astype(np.intp)
+        j = np.clip(np.floor(y + 0.5), 0, ix - 1).astype(np.intp)
+        indices = (i * ix + j)[None]
+        weights = np.ones((1, len(i)), dtype=np.float32)
+    else:
+        i = np.clip(np.floor(x), 0, max(iy - 2, 0)).astype(np.intp)
+        j = np.clip(np.floor(y), 0, max(ix - 2, 0)).astype(np.intp)
+        fx, fy = x - i, y - j
+        indices = np.stack([i * ix + j, i * ix + j + 1, (i + 1) * ix + j, (i + 1) * ix + j + 1])
+        weights = np.stack([(1 - fx) * (1 - fy), (1 - fx) * fy, fx * (1 - fy), fx * fy]).astype(np.float32)
+
+    counts = valid.sum(axis=1)
+    plan.update(indices=indices, weights=weights, counts=counts, starts=np.concatenate([[0], np.cumsum(counts)[:-1]]))
+    return plan
+
+@profiled("project")
+def project_channels(stack, plan, intensity_types, clips=None, round_channels=None, chunk_size=2**24, backgrounds=None, z_roi=None):
+    """
+    Project every channel of stack rotated by plan["angle"] along axis 1 in a single pass: the rotation geometry and the gathered samples are shared by all the channels.
+
+    stack - 4D multi-channel volume (C, X, Y, Z).
+    plan - Rotation plan from get_rotation_plan.
+    intensity_types - Reduction of every channel: "maximum", "sum", "mean" or "std".
+    clips - Optional (min, max) of every channel (or None) applied to the rotated values before the reduction (e.g. SUV window).
+    round_channels - Channels whose rotated values are rounded as scipy.ndimage.rotate does for integer volumes (e.g. SEG stored as float).
+    chunk_size - Maximum number of sampled values held in memory at once.
+    backgrounds - With a plan restricted to a roi (order <= 1), value of every channel outside the roi: stack is the cropped volume and the samples outside are this value.
+    z_roi - Optional (z0, z1, Z): stack only holds the slices z0:z1 of a volume of Z slices whose other slices equal the backgrounds.
+    Returns the (C, X', Z) float projections.
+
+    order=3 (the default of the projection functions) reproduces the cubic scipy.ndimage.rotate output exactly, and still runs scipy.ndimage.rotate on every slab.
+    order=0/1 are much faster but the projections differ by the interpolation, mostly at sharp edges (lesions, bone, air, tissue masks). Maximum absolute
+    difference from the order 3 projections after their normalization (generate_all_MIPs_SUV/CT), on the body phantom of tests/test_projections.py every 10 degrees:
+        order=1: SUV_MIP 0.015, SUV tissue channels 0.22, CT tissue channels 0.02, SEG off by one label on 0.6% of the pixels (lesion borders).
+        order=0: SUV_MIP 0.09, SUV tissue channels 0.67, CT tissue channels 0.07, SEG off by one label on 2% of the pixels.
+    CT_MIP is divided by its largest ray sum, about 0 for the rays that only cross the empty corners of the rotation, so its normalized difference has no bound;
+    before the normalization it differs by 0.4% (order=1) and 1.7% (order=0) of its range.
+    """
+    n_channels, n_z = stack.shape[0], stack.shape[3]
+    n_rows, n_rays = plan["out_shape"]
+    clips = [None] * n_channels if clips is None else clips
+    rounded = np.zeros(n_channels, dtype=bool)
+    if round_channels is not None:
+        rounded[list(round_channels)] = True
+    if np.issubdtype(stack.dtype, np.integer):
+        rounded[:] = True
+    reductions = {"maximum": np.max, "sum": np.sum, "mean": np.mean, "std": np.std}
+    MIPs = np.zeros((n_channels, n_rows, n_z))
+
+    #Channels are interleaved along the last axis so that one gather fetches all of them
+    volume = np.moveaxis(stack, 0, 2)
+
+    if plan["order"] > 1:
+        #Rotate slabs of the volume so that the full rotated volume is never held in memory
+        slab = max(1, chunk_size // (n_rows * n_rays * n_channels))
+        #Rounded channels of a float stack are rotated to float64, as scipy.ndimage.rotate interpolates integer volumes before rounding them
+        output = np.float64 if rounded.any() and not np.issubdtype(stack.dtype, np.integer) else None
+        for z in range(0, n_z, slab):
+            with profile_stage("rotate"):
+                rotated = scipy.ndimage.rotate(volume[:, :, :, z:z+slab].reshape(volume.shape[:2] + (-1,)), angle=plan["angle"], axes=(0,1), order=plan["order"], output=output)
+            rotated = rotated.reshape(rotated.shape[:2] + (n_channels, -1))
+            for c in range(n_channels):
+                rotated_c = rotated[:, :, c]
+                if rounded[c] and not np.issubdtype(rotated_c.dtype, np.integer):
+                    rotated_c = np.floor(rotated_c + 0.5)
+                elif output is not None:
+                    rotated_c = rotated_c.astype(stack.dtype)
+                if clips[c] is not None:
+                    rotated_c = np.clip(rotated_c, clips[c][0], clips[c][1])
+                MIPs[c, :, z:z+slab] = reductions[intensity_types[c]](rotated_c, axis=1)
+        return MIPs
+
+    flat = np.ascontiguousarray(volume).reshape(-1, n_channels * n_z)
+    indices, weights, counts, starts = plan["indices"], plan["weights"], plan["counts"], plan["starts"]
+    # Rays partly outside the volume also sample cval (0), rays partly outside the roi sample the backgrounds
+    cvals = np.array([0. if clip is None else np.clip(0., clip[0], clip[1]) for clip in clips])
+    n_volume = plan.get("n_volume", counts)
+    n_cval, n_background = n_rays - n_volume, n_volume - counts
+    backgrounds = np.zeros(n_channels) if backgrounds is None else np.array(backgrounds, dtype=np.float64)
+    backgrounds[rounded] = np.floor(backgrounds[rounded] + 0.5)
+    for c in range(n_channels):
+        if clips[c] is not None:
+            backgrounds[c] = np.clip(backgrounds[c], clips[c][0], clips[c][1])
+    sumsq = np.zeros_like(MIPs)
+    for c in range(n_channels):
+        if intensity_types[c] == "maximum":
+            MIPs[c, counts == 0] = np.where(n_cval[counts == 0] > 0, cvals[c], -np.inf)[:, None]
+
+    rows_per_chunk = max(1, chunk_size // max(1, n_channels * n_z * int(np.max(counts, initial=1))))
+    for r0 in range(0, len(counts), rows_per_chunk):
+        rows = np.arange(r0, min(r0 + rows_per_chunk, len(counts)))
+        rows = rows[counts[rows] > 0]
+        if len(rows) == 0:
+            continue
+        s0, s1 = starts[rows[0]], starts[rows[-1]] + counts[rows[-1]]
+        samples = weights[0, s0:s1, None] * flat[indices[0, s0:s1]]
+        for k in range(1, len(indices)):
+            samples += weights[k, s0:s1, None] * flat[indices[k, s0:s1]]
+        samples = samples.reshape(-1, n_channels, n_z)
+
+        groups = starts[rows] - s0
+        partial = rows[n_cval[rows] > 0]
+        for c in range(n_channels):
+            samples_c = samples[:, c]
+            if rounded[c]:
+                #Rotated integer volumes are rounded half up by scipy.ndimage
+                np.floor(samples_c + 0.5, out=samples_c)
+            if clips[c] is not None:
+                np.clip(samples_c, clips[c][0], clips[c][1], out=samples_c)
+            if intensity_types[c] == "maximum":
+                MIPs[c, rows] = np.maximum.reduceat(samples_c, groups, axis=0)
+                MIPs[c, partial] = np.maximum(MIPs[c, partial], cvals[c])
+            else:
+                MIPs[c, rows] = np.add.reduceat(samples_c, groups, axis=0, dtype=np.float64)
+                if intensity_types[c] == "std":
+                    sumsq[c, rows] = np.add.reduceat(np.square(samples_c), groups, axis=0, dtype=np.float64)
+
+    for c in range(n_channels):
+        if intensity_types[c] == "maximum":
+            MIPs[c, n_background > 0] = np.maximum(MIPs[c, n_background > 0], backgrounds[c])
+            continue
+        MIPs[c] += (n_cval * cvals[c] + n_background * backgrounds[c])[:, None]
+        if intensity_types[c] == "sum":
+            continue
+        MIPs[c] /= n_rays
+        if intensity_types[c] == "std":
+            sumsq[c] += (n_cval * cvals[c]**2 + n_background * backgrounds[c]**2)[:, None]
+            MIPs[c] = np.sqrt(np.maximum(sumsq[c] / n_rays - MIPs[c]**2, 0))
+
+    if z_roi is not None:
+        #Slices outside the roi: every sample inside the volume is the background
+        z0, z1, n_z_full = z_roi
+        MIPs_full = np.empty((n_channels, n_rows, n_z_full))
+        MIPs_full[:, :, z0:z1] = MIPs
+        n_volume = plan.get("n_volume", counts)
+        for c in range(n_channels):
+            if intensity_types[c] == "maximum":
+                outside = np.maximum(np.where(n_volume > 0, backgrounds[c], -np.inf), np.where(n_cval > 0, cvals[c], -np.inf))
+            else:
+                outside = n_volume * backgrounds[c] + n_cval * cvals[c]
+                if intensity_types[c] != "sum":
+                    outside = outside / n_rays
+                if intensity_types[c] == "std":
+                    outside = np.sqrt(np.maximum((n_volume * backgrounds[c]**2 + n_cval * cvals[c]**2) / n_rays - outside**2, 0))
+            MIPs_full[c, :, :z0] = outside[:, None]
+            MIPs_full[c, :, z1:] = outside[:, None]
+        MIPs = MIPs_full
+    return MIPs
+
+def project_volume(arr, plan, intensity_type="maximum", clip=None, chunk_size=2**24):
+    """
+    Project arr rotated by plan["angle"] along axis 1, i.e. reduce scipy.ndimage.rotate(arr, plan["angle"], axes=(0,1), order=plan["order"]) along axis 1 without building the rotated volume.
+
+    arr - 3D volume (X, Y, Z); pass a C-contiguous array to avoid a copy on every call.
+    Returns the (X', Z) float projection (see project_channels).
+    """
+    return project_channels(arr[None], plan, [intensity_type], clips=[clip], chunk_size=chunk_size)[0]
+
+def generate_projection(Data, plan, suv_min, suv_max, intensity_type=None, img_type=None):
+    """
+    Same as generate_MIPs_new(scipy.ndimage.rotate(Data, angle, axes=(0,1)), ...) using the rotation-free projection engine (see project_volume).
+    """
+    clip = (suv_min, suv_max) if img_type == "SUV" else None
+    return normalize_projection(project_volume(Data, plan, intensity_type=intensity_type, clip=clip))
+
+def generate_projection_Seg(Data, plan):
+    """
+    Same as generate_MIPs_Seg_new(scipy.ndimage.rotate(Data, angle, axes=(0,1))) using the rotation-free projection engine.
+    """
+    return cv2.rotate(project_volume(Data, plan, intensity_type="maximum"), cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+def generate_all_MIPs_SUV(save_path, SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, SEG, suv_min, suv_max, rot_min=-90, rot_max=90, rot_interval=1, order=3):
     """
     Generate rotating 2D MIPs along coronal direction from (-90, 90).
+
+    order - Interpolation order of the rotations (see project_volume).
+    SEG is projected from its lesion voxels (see LesionVoxels.rotated_projection).
     """
+    SUV, SUV_B, SUV_LT, SUV_AT, SUV_A = [np.ascontiguousarray(arr) for arr in (SUV, SUV_B, SUV_LT, SUV_AT, SUV_A)]
+    lesions = LesionVoxels.from_volume(SEG)
     for i in tqdm(range(rot_min, rot_max+1, rot_interval)):
         file_path = os.path.join(save_path, "SUV_MIP", str(i) + ".npy")
         if not os.path.isfile(file_path):
             print("angle: ", i)
-            suv_temp = scipy.ndimage.rotate(SUV, angle=i, axes=(0,1))
-            suv_b_temp = scipy.ndimage.rotate(SUV_B, angle=i, axes=(0,1))
-            suv_lt_temp = scipy.ndimage.rotate(SUV_LT, angle=i, axes=(0,1))
-            suv_at_temp = scipy.ndimage.rotate(SUV_AT, angle=i, axes=(0,1))
-            suv_a_temp = scipy.ndimage.rotate(SUV_A, angle=i, axes=(0,1))
-            seg_temp = scipy.ndimage.rotate(SEG, angle=i, axes=(0,1))
-
-            suv_MIP = generate_MIPs_new(suv_temp, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
-            suv_b_MIP = generate_MIPs_new(suv_b_temp, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
-            suv_lt_MIP = generate_MIPs_new(suv_lt_temp, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
-            suv_at_MIP = generate_MIPs_new(suv_at_temp, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
-            suv_a_MIP = generate_MIPs_new(suv_a_temp, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
-            seg_MIP = generate_MIPs_Seg_new(seg_temp)
+            plan = get_rotation_plan(SUV.shape[:2], i, order=order)
+
+            suv_MIP = generate_projection(SUV, plan, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
+            suv_b_MIP = generate_projection(SUV_B, plan, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
+            suv_lt_MIP = generate_projection(SUV_LT, plan, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
+            suv_at_MIP = generate_projection(SUV_AT, plan, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
+            suv_a_MIP = generate_projection(SUV_A, plan, suv_min, suv_max, intensity_type="maximum", img_type="SUV")
+            seg_MIP = cv2.rotate(lesions.rotated_projection(i, order=order), cv2.ROTATE_90_COUNTERCLOCKWISE)
 
             suv_MIP = suv_MIP[:,60:-60]
             suv_b_MIP = suv_b_MIP[:,60:-60]
@@ -428,30 +1555,29 @@ def generate_all_MIPs_SUV(save_path, SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, SEG, suv
             np.save(os.path.join(save_path, "SEG", str(i) + ".npy"), seg_MIP)
         #break
 
-def generate_all_MIPs_CT(save_path, CT, CT_B, CT_LT, CT_AT, CT_A, SEG, ct_min, ct_max, rot_min=-90, rot_max=90, rot_interval=1):
+def generate_all_MIPs_CT(save_path, CT, CT_B, CT_LT, CT_AT, CT_A, SEG, ct_min, ct_max, rot_min=-90, rot_max=90, rot_interval=1, order=3):
     """
     Generate rotating 2D MIPs along coronal direction from (-90, 90).
+
+    order - Interpolation order of the rotations (see project_volume).
     """
+    CT, CT_B, CT_LT, CT_AT, CT_A = [np.ascontiguousarray(arr) for arr in (CT, CT_B, CT_LT, CT_AT, CT_A)]
     for i in tqdm(range(rot_min, rot_max+1, rot_interval)):
         file_path = os.path.join(save_path, "CT_MIP", str(i) + ".npy")
         if not os.path.isfile(file_path):
-            ct_temp = scipy.ndimage.rotate(CT, angle=i, axes=(0,1))
-            ct_b_temp = scipy.ndimage.rotate(CT_B, angle=i, axes=(0,1))
-            ct_lt_temp = scipy.ndimage.rotate(CT_LT, angle=i, axes=(0,1))
-            ct_at_temp = scipy.ndimage.rotate(CT_AT, angle=i, axes=(0,1))
-            ct_a_temp = scipy.ndimage.rotate(CT_A, angle=i, axes=(0,1))
-
-            ct_MIP = generate_MIPs_new(ct_temp, ct_min, ct_max, intensity_type="sum", img_type="CT")
-            ct_b_MIP = generate_MIPs_new(ct_b_temp, ct_min, ct_max, intensity_type="sum", img_type="CT")
+            plan = get_rotation_plan(CT.shape[:2], i, order=order)
+
+            ct_MIP = generate_projection(CT, plan, ct_min, ct_max, intensity_type="sum", img_type="CT")
+            ct_b_MIP = generate_projection(CT_B, plan, ct_min, ct_max, intensity_type="sum", img_type="CT")
             ct_b_MIP = (ct_b_MIP - np.min(ct_b_MIP)) / (np.max(ct_b_MIP) - np.min(ct_b_MIP))
 
-            ct_lt_MIP = generate_MIPs_new(ct_lt_temp, ct_min, ct_max, intensity_type="sum", img_type="CT")
+            ct_lt_MIP = generate_projection(CT_LT, plan, ct_min, ct_max, intensity_type="sum", img_type="CT")
             ct_lt_MIP = (ct_lt_MIP - np.min(ct_lt_MIP)) / (np.max(ct_lt_MIP) - np.min(ct_lt_MIP))
 
-            ct_at_MIP = generate_MIPs_new(ct_at_temp, ct_min, ct_max, intensity_type="sum", img_type="CT")
+            ct_at_MIP = generate_projection(CT_AT, plan, ct_min, ct_max, intensity_type="sum", img_type="CT")
             ct_at_MIP = (ct_at_MIP - np.min(ct_at_MIP)) / (np.max(ct_at_MIP) - np.min(ct_at_MIP))
 
-            ct_a_MIP = generate_MIPs_new(ct_a_temp, ct_min, ct_max, intensity_type="sum", img_type="CT")
+            ct_a_MIP = generate_projection(CT_A, plan, ct_min, ct_max, intensity_type="sum", img_type="CT")
             ct_a_MIP = (ct_a_MIP - np.min(ct_a_MIP)) / (np.max(ct_a_MIP) - np.min(ct_a_MIP))
 
             ct_MIP = ct_MIP[:,60:-60]
@@ -465,4 +1591,229 @@ def generate_all_MIPs_CT(save_path, CT, CT_B, CT_LT, CT_AT, CT_A, SEG, ct_min, c
             np.save(os.path.join(save_path, "CT_lean", str(i) + ".npy"), ct_lt_MIP)
             np.save(os.path.join(save_path, "CT_adipose", str(i) + ".npy"), ct_at_MIP)
             np.save(os.path.join(save_path, "CT_air", str(i) + ".npy"), ct_a_MIP)
-        #break
\ No newline at end of file
+        #break
+
+PROJECTION_CHANNELS = ["SUV_MIP", "SUV_bone", "SUV_lean", "SUV_adipose", "SUV_air", "CT_MIP", "CT_bone", "CT_lean", "CT_adipose", "CT_air", "SEG"] #Channels (and output folders) of the multi-angle projections, in stack order.
+
+def get_projection_stack(SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, CT_LT, CT_AT, CT_A, SEG, dtype=np.float32):
+    """
+    Stack all the volumes of one scan into a (C, X, Y, Z) array with the channels ordered as PROJECTION_CHANNELS.
+    SEG - SEG volume or its LesionVoxels.
+    """
+    volumes = (SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, CT_LT, CT_AT, CT_A, SEG)
+    stack = np.empty((len(volumes),) + SUV.shape, dtype=dtype)
+    for c, arr in enumerate(volumes):
+        if isinstance(arr, LesionVoxels):
+            arr.to_volume(out=stack[c])
+        else:
+            stack[c] = arr
+    return stack
+
+def get_round_channels(CT_dtype, SUV_dtype, SEG_dtype):
+    """
+    Projection channels of the integer source volumes among CT, SUV and SEG (e.g. an int16 CT): the original projections rotated them with scipy.ndimage.rotate
+    as integer volumes, which rounds the rotated values, so the projections of the float stack round them too (see project_channels).
+    """
+    dtypes = {"CT": CT_dtype, "SUV": SUV_dtype, "SEG": SEG_dtype}
+    return tuple(name for name in PROJECTION_CHANNELS if np.issubdtype(dtypes[name.split("_")[0]], np.integer))
+
+def load_projection_stack(row, args, stats=None):
+    """
+    Load all the SUV, CT and SEG volumes of one scan (row of df_final.csv) as a projection stack. Returns the stack and the channels of its integer
+    source volumes, rounded by the projections (see get_round_channels).
+    stats - Optional ScanStatistics, the minima of the CT channels are looked up in it.
+    The SEG of a NEGATIVE scan is not read (see is_negative).
+    """
+    pat_ID = row["pat_ID"]
+    scan_date = row["scan_date"]
+
+    if args.channel_storage == "label_map":
+        #Rebuild the channels from the tissue label map
+        channels = TissueChannels(get_label_map_path(args, pat_ID, scan_date), row["CT"], row["SUV"], dtype=args.volume_dtype)
+        SUV, SUV_B, SUV_LT, SUV_AT, SUV_A = channels["SUV"], channels["SUV_bone"], channels["SUV_lean_tissue"], channels["SUV_adipose_tissue"], channels["SUV_air"]
+        CT, CT_B, CT_LT, CT_AT, CT_A = channels["CT"], channels["CT_bone"], channels["CT_lean_tissue"], channels["CT_adipose_tissue"], channels["CT_air"]
+    else:
+        #Read the channels written by the 3D channel generation
+        paths = get_channel_paths(args, pat_ID, scan_date)
+        SUV = read_nii(row["SUV"])
+        SUV_B, SUV_LT, SUV_AT, SUV_A = [read_nii(paths["SUV_" + tissue]) for tissue in TISSUE_TYPES]
+
+        CT = read_nii(row["CT"])
+        CT_B, CT_LT, CT_AT, CT_A = [read_nii(paths["CT_" + tissue]) for tissue in TISSUE_TYPES]
+
+    lows = [None] * 3 if stats is None else [stats.channel_min(pat_ID, scan_date, name) for name in ("CT_lean_tissue", "CT_adipose_tissue", "CT_air")]
+    CT_LT, CT_AT, CT_A = preprocess_CT_HU_values(CT_LT, lows[0]), preprocess_CT_HU_values(CT_AT, lows[1]), preprocess_CT_HU_values(CT_A, lows[2])
+
+    SEG = LesionVoxels.empty(CT.shape) if is_negative(row) else read_nii(row["SEG"])
+
+    #Project all the SUV, CT and SEG channels together, one pass per angle
+    stack = get_projection_stack(SUV, SUV_B, SUV_LT, SUV_AT, SUV_A, CT, CT_B, CT_LT, CT_AT, CT_A, SEG, dtype=args.volume_dtype)
+    return stack, get_round_channels(CT.dtype, SUV.dtype, SEG.dtype)
+
+def generate_multi_channel_projections(stack, angles, suv_min, suv_max, ct_min, ct_max, order=3, round_channels=("SEG",), bbox=None, dtype=np.float64, lesions=None):
+    """
+    Generate the projections of all the channels of a projection stack (see get_projection_stack) at every angle, with one rotation plan and one batched pass per angle.
+
+    round_channels - Channels (names of PROJECTION_CHANNELS) whose rotated values are rounded as scipy.ndimage.rotate does for integer volumes:
+    the channels of the integer source volumes (see get_round_channels), which the stack holds as floats.
+    bbox - Optional body bounding box (see get_body_bbox, order <= 1): the channels that are constant outside it (tissue channels) are
+    only sampled inside it, the others over the whole volume. Same projections up to float rounding.
+    lesions - Optional LesionVoxels of SEG (built from the stack if not given): SEG is only sampled inside the bounding box of the lesions (order <= 1) and is 0 without lesion.
+    dtype - Float dtype of the yielded projections (they are accumulated and normalized in float64).
+
+    Yields (angle, projections) where projections is a (C, H, W) array ordered as PROJECTION_CHANNELS, identical to what generate_all_MIPs_SUV/CT save.
+    """
+    groups = get_projection_groups(stack, bbox, order, lesions)
+    for angle in angles:
+        yield angle, project_groups(groups, stack.shape[1:], angle, suv_min, suv_max, ct_min, ct_max, order=order, round_channels=round_channels, dtype=dtype)
+
+def get_projection_groups(stack, bbox=None, order=3, lesions=None):
+    """
+    Channels of a projection stack grouped by the sub-volume they are projected from (see generate_multi_channel_projections): [(channels, volumes, backgrounds, bbox)],
+    the channels that are not constant outside bbox with their whole volumes and the others cropped to bbox, with their value outside it.
+    SEG is cropped to the bounding box of the lesions instead (order <= 1, see LesionVoxels.crop) and is in no group without lesion (the channels of no group are 0).
+    lesions - Optional LesionVoxels of the SEG channel (built from it if not given).
+    The groups hold all that is needed to project the stack at any angle (see project_groups), the stack itself can be freed.
+    """
+    SEG_channel = PROJECTION_CHANNELS.index("SEG")
+    if lesions is None:
+        lesions = LesionVoxels.from_volume(stack[SEG_channel])
+    if bbox is not None and (order > 1 or tuple(bbox) == tuple((0, n) for n in stack.shape[1:])):
+        bbox = None
+    lesion_groups = []
+    if len(lesions) and order <= 1:
+        volume, lesion_bbox = lesions.crop(dtype=stack.dtype)
+        lesion_groups.append(([SEG_channel], volume[None], [0.], lesion_bbox))
+    channels = [c for c in range(len(PROJECTION_CHANNELS)) if c != SEG_channel or (len(lesions) and order > 1)]
+    if bbox is None:
+        return [(channels, stack[:len(channels)] if channels == list(range(len(channels))) else stack[channels], None, None)] + lesion_groups
+    outside = {c: get_outside_value(stack[c], bbox) for c in channels}
+    inner = [c for c in channels if outside[c] is not None]
+    full = [c for c in channels if outside[c] is None]
+    groups = [(full, np.ascontiguousarray(stack[full]), None, None), (inner, np.stack([stack[c][get_roi(bbox)] for c in inner]), [outside[c] for c in inner], bbox)] + lesion_groups
+    return [group for group in groups if len(group[0]) > 0]
+
+def project_groups(groups, shape, angle, suv_min, suv_max, ct_min, ct_max, order=3, round_channels=("SEG",), dtype=np.float64):
+    """
+    Projections (C, H, W) at angle of the channel groups (see get_projection_groups) of a projection stack of volume shape (X, Y, Z), see generate_multi_channel_projections.
+    """
+    SUV_channels = [c for c, name in enumerate(PROJECTION_CHANNELS) if name.startswith("SUV")]
+    CT_channels = [c for c, name in enumerate(PROJECTION_CHANNELS) if name.startswith("CT")]
+    SEG_channel = PROJECTION_CHANNELS.index("SEG")
+    intensity_types = ["sum" if c in CT_channels else "maximum" for c in range(len(PROJECTION_CHANNELS))]
+    clips = [(suv_min, suv_max) if c in SUV_channels else None for c in range(len(PROJECTION_CHANNELS))]
+
+    MIPs = None
+    for channels, volumes, backgrounds, roi in groups:
+        plan = get_rotation_plan(shape[:2], angle, order=order, roi=None if roi is None else roi[:2])
+        MIPs_group = project_channels(volumes, plan, [intensity_types[c] for c in channels], clips=[clips[c] for c in channels],
+            round_channels=[k for k, c in enumerate(channels) if PROJECTION_CHANNELS[c] in round_channels],
+            backgrounds=backgrounds, z_roi=None if roi is None else roi[2] + (shape[2],))
+        if MIPs is None:
+            MIPs = np.zeros((len(PROJECTION_CHANNELS),) + MIPs_group.shape[1:])
+        MIPs[channels] = MIPs_group
+    projections = []
+    for c, name in enumerate(PROJECTION_CHANNELS):
+        if c == SEG_channel:
+            MIP = cv2.rotate(MIPs[c], cv2.ROTATE_90_COUNTERCLOCKWISE)
+        else:
+            MIP = normalize_projection(MIPs[c])
+        if c in CT_channels and name != "CT_MIP":
+            MIP = (MIP - np.min(MIP)) / (np.max(MIP) - np.min(MIP))
+        projections.append(MIP[:,60:-60])
+    return np.stack(projections).astype(dtype, copy=False)
+
+def get_stale_angles(save_path, angles, manifest=None, inputs=None, params=None):
+    """
+    Angles whose projections (one .npy file per channel) have to be generated: missing files, or, with a BuildManifest, angles recorded with other inputs/parameters.
+    """
+    stale = []
+    for angle in angles:
+        outputs = [os.path.join(save_path, name, str(angle) + ".npy") for name in PROJECTION_CHANNELS]
+        if manifest is None:
+            done = all(os.path.isfile(path) for path in outputs)
+        else:
+            done = manifest.is_done("projections/" + str(angle), inputs, params, outputs)
+        if not done:
+            stale.append(angle)
+    return stale
+
+def generate_all_MIPs(save_path, stack, suv_min, suv_max, ct_min, ct_max, rot_min=-90, rot_max=90, rot_interval=1, order=3, round_channels=("SEG",), manifest=None, inputs=None, params=None, bbox=None, dtype=np.float64):
+    """
+    Generate rotating 2D MIPs along coronal direction from (-90, 90) for all the SUV, CT and SEG channels together (replaces generate_all_MIPs_SUV + generate_all_MIPs_CT).
+
+    stack - Projection stack from get_projection_stack.
+    bbox - Optional body bounding box of the scan (see generate_multi_channel_projections).
+    manifest, inputs, params - Optional BuildManifest of the scan with the input fingerprints and parameters of the projections: only stale angles are generated and
+    every angle is recorded once all its channels are written. Without a manifest an angle is skipped if the projections of all the channels exist.
+    dtype - Stored dtype of the projections (see save_projections).
+    """
+    angles = get_stale_angles(save_path, range(rot_min, rot_max+1, rot_interval), manifest, inputs, params)
+    projections = generate_multi_channel_projections(stack, angles, suv_min, suv_max, ct_min, ct_max, order=order, round_channels=round_channels, bbox=bbox, dtype=get_compute_dtype(dtype))
+    save_projections(save_path, tqdm(projections, total=len(angles)), manifest, inputs, params, dtype=dtype)
+
+def quantize_projections(MIPs, dtype):
+    """
+    Store (C, H, W) projections as dtype, every image with its own scale for integer dtypes (see get_quantization). Returns the stored array and the (C, 2) scales.
+    """
+    scales = np.array([get_quantization(dtype, np.nanmin(MIP), np.nanmax(MIP), integral=is_integral(MIP)) if np.isfinite(MIP).any() else (1., 0.) for MIP in MIPs])
+    return np.stack([quantize(MIP, dtype, scale) for MIP, scale in zip(MIPs, scales)]), scales
+
+def load_projection_scales(save_path):
+    """
+    Scales of the integer projections saved as .npy files in save_path (see save_projections): {channel: {angle: (slope, intercept)}}.
+    """
+    path = os.path.join(save_path, "projection_scales.json")
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return {channel: {int(angle): tuple(scale) for angle, scale in scales.items()} for channel, scales in json.load(f).items()}
+
+def save_projections(save_path, projections, manifest=None, inputs=None, params=None, dtype=None):
+    """
+    Save (angle, (C, H, W) projections) pairs as one .npy file per channel and angle (save_path/<channel>/<angle>.npy), recording every angle in the manifest if given.
+
+    dtype - Stored dtype (default: the dtype of the projections). Integer projections are saved with the scale of every image in "projection_scales.json" (see load_projection_scales).
+    """
+    for channel in PROJECTION_CHANNELS:
+        os.makedirs(os.path.join(save_path, channel), exist_ok=True)
+    scales_all = None
+    for angle, MIPs in projections:
+        MIPs, scales = quantize_projections(MIPs, MIPs.dtype if dtype is None else dtype)
+        for name, MIP in zip(PROJECTION_CHANNELS, MIPs):
+            save_npy_atomic(os.path.join(save_path, name, str(angle) + ".npy"), MIP)
+        if np.issubdtype(MIPs.dtype, np.integer):
+            if scales_all is None:
+                scales_all = load_projection_scales(save_path)
+            for name, scale in zip(PROJECTION_CHANNELS, scales):
+                scales_all.setdefault(name, {})[int(angle)] = tuple(float(x) for x in scale)
+            path_temp = get_temp_path(os.path.join(save_path, "projection_scales.json"))
+            with open(path_temp, "w") as f:
+                json.dump(scales_all, f)
+            os.replace(path_temp, os.path.join(save_path, "projection_scales.json"))
+        if manifest is not None:
+            manifest.record("projections/" + str(angle), inputs, params)
+            manifest.save()
+
+def get_projection_width(in_plane_shape, angle):
+    """
+    Width of the projections saved at angle (after the [:,60:-60] crop); it grows with the in-plane diagonal of the rotated volume.
+    """
+    return get_rotation_plan(in_plane_shape, angle, order=3)["out_shape"][0] - 120
+
+def fit_projection(MIP, shape):
+    """
+    Center-crop or pad (repeating the border pixels) the last two axes of projections to shape, so that projections of different angles/scans can be stacked.
+    """
+    pad, crop = [(0, 0)] * (MIP.ndim - 2), [slice(None)] * (MIP.ndim - 2)
+    for n, size in zip(MIP.shape[-2:], shape):
+        if n < size:
+            pad.append(((size - n) // 2, size - n - (size - n) // 2))
+            crop.append(slice(None))
+        else:
+            pad.append((0, 0))
+            crop.append(slice((n - size) // 2, (n - size) // 2 + size))
+    MIP = MIP[tuple(crop)]
+    if any(p != (0, 0) for p in pad):
+        MIP = np.pad(MIP, pad, mode="edge")
+    return MIP
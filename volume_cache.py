@@ -0,0 +1,99 @@
+#Persistent cache of the decoded NIfTI volumes read by utils.read_nii, shared by all the Data Preparation steps (see init_volume_cache).
+import os
+import time
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+import utils
+from utils import sitk
+from profiling import profile_io
+
+class VolumeCache:
+    """
+    Persistent cache of decoded NIfTI volumes, stored as raw C-contiguous .npy files that are memory-mapped on read.
+
+    Entries are keyed by the absolute source path, its size and mtime and the transpose layout, so a rewritten source is decoded again.
+    The least recently used entries are deleted once the cache grows beyond max_GB, and the last hot_items volumes are kept open in memory.
+    The size and mtime of the entries are kept in a ledger, so a miss does not list the cache directory. Every process has its own ledger: the entries
+    that other processes write after it starts are only counted once it reads them.
+    Volumes are returned read-only.
+    """
+    def __init__(self, cache_dir, max_GB=100, hot_items=16):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_GB * 2**30)
+        self.hot_items = hot_items
+        self.hot = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+        #Ledger of the entries on disk {cache_path: (mtime, size)}, scanned once here and then kept up to date by read and evict
+        self.entries = {}
+        self.total = 0
+        for root, _, files in os.walk(cache_dir):
+            for f in files:
+                if f.endswith(".npy"):
+                    self.record(os.path.join(root, f))
+
+    def record(self, cache_path, mtime=None):
+        """
+        Add an entry to the ledger, or update its size and mtime (default: its mtime on disk, which may be coarser than time.time()).
+        """
+        stat = os.stat(cache_path)
+        self.total += stat.st_size - self.entries.get(cache_path, (0, 0))[1]
+        self.entries[cache_path] = (stat.st_mtime if mtime is None else mtime, stat.st_size)
+
+    def key(self, path, layout=(2,1,0)):
+        stat = os.stat(path)
+        return hashlib.sha1("{}|{}|{}|{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, layout).encode()).hexdigest()
+
+    def read(self, path, layout=(2,1,0)):
+        key = self.key(path, layout)
+        if key in self.hot:
+            self.hot.move_to_end(key)
+            return self.hot[key]
+
+        cache_path = os.path.join(self.cache_dir, key[:2], key + ".npy")
+        if os.path.isfile(cache_path):
+            now = time.time()
+            os.utime(cache_path, (now, now)) #Mark as recently used
+            self.record(cache_path, now)
+            profile_io(cache_path, "read")
+        else:
+            profile_io(path, "read")
+            img_arr = np.ascontiguousarray(np.transpose(sitk.GetArrayFromImage(sitk.ReadImage(path)), layout))
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            path_temp = "{}.{}.tmp".format(cache_path, os.getpid())
+            with open(path_temp, "wb") as f:
+                np.save(f, img_arr)
+            os.replace(path_temp, cache_path)
+            profile_io(cache_path, "written")
+            self.record(cache_path, time.time())
+            if self.total > self.max_bytes:
+                self.evict()
+
+        img_arr = np.load(cache_path, mmap_mode="r")
+        self.hot[key] = img_arr
+        if len(self.hot) > self.hot_items:
+            self.hot.popitem(last=False)
+        return img_arr
+
+    def evict(self):
+        """
+        Delete the least recently used entries of the ledger until the cache fits in max_GB.
+        """
+        for cache_path, (_, size) in sorted(self.entries.items(), key=lambda entry: entry[1][0]):
+            if self.total <= self.max_bytes:
+                break
+            try:
+                os.remove(cache_path)
+            except FileNotFoundError:
+                pass
+            del self.entries[cache_path]
+            self.total -= size
+
+def init_volume_cache(args):
+    """
+    Make read_nii go through a VolumeCache in args.volume_cache_dir (if set). Safe to call again in every worker process.
+    """
+    if args.volume_cache_dir and (utils.VOLUME_CACHE is None or utils.VOLUME_CACHE.cache_dir != args.volume_cache_dir):
+        utils.VOLUME_CACHE = VolumeCache(args.volume_cache_dir, max_GB=args.volume_cache_GB)
+    return utils.VOLUME_CACHE